@@ -0,0 +1,43 @@
+"""
+Queue artists for the running recommender without rebuilding the model
+
+    python add_artists.py --U new_U.npz --ids new_ids.npz
+    python add_artists.py --remove 1234 5678
+
+The npz files have the layout of U_path and otherdata_path: raw embedding
+rows and their artist ids. Rows are appended to DELTA_PATH, which every
+worker polls (see delta.py); an artist already in the model is replaced.
+"""
+
+import argparse
+import numpy as np
+import config
+from delta import append_delta
+
+def main():
+	parser = argparse.ArgumentParser(description='queue added, updated or removed artists for the recommender')
+	parser.add_argument('--U',dest='U_path',help='npz holding the raw embedding rows')
+	parser.add_argument('--ids',dest='otherdata_path',help='npz holding their artist ids')
+	parser.add_argument('--remove',nargs='+',default=[],metavar='ID',help='artist ids to remove')
+	parser.add_argument('--delta',dest='delta_path',default=config.DELTA_PATH,help='delta file (default: config.DELTA_PATH)')
+	args = parser.parse_args()
+
+	if not args.delta_path:
+		parser.error('set DELTA_PATH in config.py or pass --delta')
+
+	if args.U_path or args.otherdata_path:
+		if not (args.U_path and args.otherdata_path):
+			parser.error('--U and --ids go together')
+		U = np.load(args.U_path)['arr_0']
+		ids = np.load(args.otherdata_path)['arr_0']
+		if len(U) != len(ids):
+			parser.error('%d rows but %d ids' % (len(U),len(ids)))
+		append_delta(args.delta_path,ids,U)
+		print "queued %d artists" % len(ids)
+
+	if args.remove:
+		append_delta(args.delta_path,args.remove)
+		print "queued removal of %d artists" % len(args.remove)
+
+if __name__ == "__main__":
+	main()
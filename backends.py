@@ -0,0 +1,226 @@
+"""
+Nearest-neighbour backends for ArtistRecommender
+
+Every backend is built over the normalized U and answers batched queries with
+query(points,k) -> [dist,inxes], both shaped (len(points),k). Missing
+neighbours are reported the way cKDTree does it: distance inf and index N.
+ball(point,r,p) returns every row within distance r of point, exactly.
+
+	exact	scipy cKDTree, the default
+	ivf	inverted file: k-means buckets over U, only the nprobe buckets closest
+		to a query are scanned; raise nprobe for recall, lower it for speed
+"""
+
+from scipy.spatial import cKDTree
+import numpy as np
+import scipy
+import os
+
+# cKDTree.query spreads a batch of points over all cores with workers= (scipy 1.6+) or n_jobs= (0.16+)
+_scipy_version = tuple(int(''.join(c for c in v if c.isdigit()) or 0) for v in scipy.__version__.split('.')[:2])
+if _scipy_version >= (1,6):
+	PARALLEL_QUERY = {'workers':-1}
+elif _scipy_version >= (0,16):
+	PARALLEL_QUERY = {'n_jobs':-1}
+else:
+	PARALLEL_QUERY = {}
+
+class NeighborBackend(object):
+	""" the interface ArtistRecommender relies on """
+
+	name = None
+
+	def query(self,points,k):
+		""" the k nearest rows of U to each of points, as [dist,inxes] shaped (len(points),k) """
+		raise NotImplementedError
+
+	def ball(self,point,r,p=2):
+		""" rows of U within Minkowski p-distance r of point, in no particular order """
+		raise NotImplementedError
+
+	def save(self,path):
+		""" write whatever is needed to skip the build next time into the artifact directory """
+		pass
+
+	def arrays(self):
+		""" name -> array of what the backend holds besides U, for memory reports """
+		return {}
+
+class ExactBackend(NeighborBackend):
+	""" exact search with scipy's cKDTree """
+
+	name = 'exact'
+
+	def __init__(self,U,tree=None):
+		self.n = U.shape[0]
+		self.tree = tree if tree is not None else cKDTree(U)
+
+	def query(self,points,k):
+		points = np.atleast_2d(points)
+		[dist,inxes] = self.tree.query(points,k=k,**PARALLEL_QUERY)
+		return [dist.reshape(len(points),k),inxes.reshape(len(points),k)]
+
+	def ball(self,point,r,p=2):
+		return np.asarray(self.tree.query_ball_point(point,r,p=p),dtype=np.int64)
+
+	def arrays(self):
+		return {'tree.data':self.tree.data,'tree.indices':self.tree.indices}
+
+def nearest_centroid(X,centroids,chunk=65536):
+	""" index of the closest centroid for every row of X, in chunks to bound the temporaries """
+	labels = np.empty(X.shape[0],dtype=np.int32)
+	cc = (centroids**2).sum(1)
+	for a in xrange(0,X.shape[0],chunk):
+		x = np.asarray(X[a:a+chunk],dtype=np.float64)
+		labels[a:a+chunk] = (cc[None,:]-2*np.dot(x,centroids.T)).argmin(1)
+	return labels
+
+def kmeans(X,n,iters=10,sample=100000,seed=0):
+	""" plain Lloyd's k-means on a random sample of X """
+	rng = np.random.RandomState(seed)
+	if X.shape[0] > sample:
+		X = X[np.sort(rng.choice(X.shape[0],sample,replace=False))]
+	X = np.asarray(X,dtype=np.float64)
+
+	centroids = X[rng.choice(X.shape[0],n,replace=False)].copy()
+	for i in xrange(iters):
+		labels = nearest_centroid(X,centroids)
+		counts = np.bincount(labels,minlength=n)
+		nonempty = counts > 0
+		for d in xrange(X.shape[1]):
+			sums = np.bincount(labels,weights=X[:,d],minlength=n)
+			centroids[nonempty,d] = sums[nonempty]/counts[nonempty]
+	return centroids
+
+class IVFBackend(NeighborBackend):
+	"""
+		approximate search over k-means buckets
+
+		nlist buckets (default sqrt(N)) are found by k-means; a query scans the
+		rows of its nprobe closest buckets exactly
+	"""
+
+	name = 'ivf'
+
+	def __init__(self,U,nlist=None,nprobe=8,iters=10,seed=0,path=None):
+		self.U = U
+		self.n = U.shape[0]
+		self.nprobe = nprobe
+
+		if path is not None and os.path.exists(os.path.join(path,'ivf_centroids.npy')):
+			self.centroids = np.load(os.path.join(path,'ivf_centroids.npy'))
+			self.order = np.load(os.path.join(path,'ivf_order.npy'),mmap_mode='r')
+			self.offsets = np.load(os.path.join(path,'ivf_offsets.npy'))
+			return
+
+		nlist = int(nlist or max(1,np.sqrt(self.n)))
+		self.centroids = kmeans(U,min(nlist,self.n),iters=iters,seed=seed)
+
+		labels = nearest_centroid(U,self.centroids)
+		self.order = np.argsort(labels,kind='mergesort').astype(np.int64)
+		self.offsets = np.concatenate([[0],np.cumsum(np.bincount(labels,minlength=len(self.centroids)))])
+
+	def save(self,path):
+		np.save(os.path.join(path,'ivf_centroids.npy'),self.centroids)
+		np.save(os.path.join(path,'ivf_order.npy'),self.order)
+		np.save(os.path.join(path,'ivf_offsets.npy'),self.offsets)
+
+	def arrays(self):
+		return {'ivf.centroids':self.centroids,'ivf.order':self.order,'ivf.offsets':self.offsets}
+
+	def candidates(self,point,nprobe=None):
+		""" rows of U in the buckets closest to point """
+		nprobe = min(nprobe or self.nprobe,len(self.centroids))
+		cd = ((self.centroids-point)**2).sum(1)
+		probes = np.argpartition(cd,nprobe-1)[:nprobe] if nprobe < len(cd) else np.arange(len(cd))
+		return np.concatenate([self.order[self.offsets[c]:self.offsets[c+1]] for c in probes])
+
+	def query(self,points,k):
+		points = np.atleast_2d(points)
+
+		dist = np.empty((len(points),k))
+		dist.fill(np.inf)
+		inxes = np.empty((len(points),k),dtype=np.int64)
+		inxes.fill(self.n)
+
+		for j in xrange(len(points)):
+			cand = self.candidates(points[j])
+			d = np.sqrt(((self.U[cand,:]-points[j])**2).sum(1))
+			m = min(k,len(cand))
+			if m == 0:
+				continue
+			top = np.argpartition(d,m-1)[:m] if m < len(cand) else np.arange(len(cand))
+			top = top[np.argsort(d[top])]
+			dist[j,:m] = d[top]
+			inxes[j,:m] = cand[top]
+
+		return [dist,inxes]
+
+	def ball(self,point,r,p=2,chunk=65536):
+		# buckets do not bound a region, so this scans U in chunks
+		found = []
+		for a in xrange(0,self.n,chunk):
+			diff = np.abs(np.asarray(self.U[a:a+chunk],dtype=np.float64)-point)
+			d = diff.max(1) if p == np.inf else (diff**p).sum(1)**(1.0/p)
+			found.append(a+np.flatnonzero(d <= r))
+		return np.concatenate(found) if found else np.zeros(0,dtype=np.int64)
+
+class RerankBackend(NeighborBackend):
+	"""
+		candidates from a backend built over a compact approximation of U (uint8 codes,
+		see recommender.QuantizedMatrix), re-ranked by their exact distance in U
+
+		every query fetches shortlist*k candidates; error is the largest per-dimension
+		error of the approximation, by which ball queries are widened so none are missed
+	"""
+
+	def __init__(self,inner,U,error,shortlist=4):
+		self.inner = inner
+		self.name = inner.name
+		self.U = U
+		self.n = U.shape[0]
+		self.error = np.asarray(error,dtype=np.float64)
+		self.shortlist = shortlist
+
+	def query(self,points,k):
+		points = np.atleast_2d(points)
+		m = min(k*self.shortlist,self.n)
+		[dist,inxes] = self.inner.query(points,m)
+
+		valid = inxes < self.n
+		rows = np.where(valid,inxes,0)
+		exact = np.asarray(self.U[rows.ravel(),:],dtype=np.float64).reshape(rows.shape+(-1,))
+		exact = np.sqrt(((exact-points[:,None,:])**2).sum(2))
+		exact[~valid] = np.inf
+
+		top = np.argsort(exact,1,kind='mergesort')[:,:k]
+		j = np.arange(len(points))[:,None]
+
+		dist = np.empty((len(points),k))
+		dist.fill(np.inf)
+		found = np.empty((len(points),k),dtype=np.int64)
+		found.fill(self.n)
+		dist[:,:top.shape[1]] = exact[j,top]
+		found[:,:top.shape[1]] = np.where(valid[j,top],inxes[j,top],self.n)
+		return [dist,found]
+
+	def ball(self,point,r,p=2):
+		slack = self.error.max() if p == np.inf else (self.error**p).sum()**(1.0/p)
+		rows = self.inner.ball(point,r+slack,p)
+		diff = np.abs(np.asarray(self.U[rows,:],dtype=np.float64)-point)
+		d = diff.max(1) if p == np.inf else (diff**p).sum(1)**(1.0/p)
+		return rows[d <= r]
+
+	def arrays(self):
+		return self.inner.arrays()
+
+BACKENDS = {
+	'exact':ExactBackend,
+	'ivf':IVFBackend
+}
+
+def make_backend(name,U,**params):
+	""" build the backend registered under name over U """
+	if name not in BACKENDS:
+		raise ValueError('unknown nearest-neighbour backend %r (choose from %s)' % (name,', '.join(sorted(BACKENDS))))
+	return BACKENDS[name](U,**params)
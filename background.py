@@ -0,0 +1,44 @@
+"""
+Periodically refreshed in-memory components
+"""
+
+import os
+import sys
+import threading
+import time
+import metrics
+
+class Refreshing(object):
+	"""
+		base for components that rebuild themselves in a background thread
+
+		subclasses implement refresh(); start() launches the refresher once per
+		process, since threads started in the gunicorn master do not survive the fork
+	"""
+
+	refresh_interval = 900
+	loaded = False
+	_thread_pid = None
+
+	def start(self):
+		if self._thread_pid == os.getpid():
+			return
+		self._thread_pid = os.getpid()
+		t = threading.Thread(target=self._run,name=self.__class__.__name__)
+		t.daemon = True
+		t.start()
+
+	def _run(self):
+		# a generation loaded before the fork or by the first request is still fresh
+		if self.loaded:
+			time.sleep(self.refresh_interval)
+		while True:
+			try:
+				with metrics.timer('refresh',self.__class__.__name__):
+					self.refresh()
+			except Exception:
+				print "%s refresh failed:" % self.__class__.__name__, sys.exc_info()[1]
+			time.sleep(self.refresh_interval)
+
+	def refresh(self):
+		raise NotImplementedError
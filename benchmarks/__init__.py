@@ -0,0 +1,13 @@
+"""
+Benchmarks for the recommender and the web hot paths
+
+    python -m benchmarks.run --sizes 10k,100k --out before.json
+    python -m benchmarks.run --sizes 10k,100k --out after.json
+    python -m benchmarks.compare before.json after.json
+
+Everything runs on synthetic data (see synthetic.py): a clustered U and its
+artist ids at each size, and a sqlite stand-in for the MySQL Artists,
+ArtistAlias, Songs and SubTables schema (see standins.py) behind a stubbed
+Discogs, so a run needs neither MySQL nor the network and is reproducible
+from its seed.
+"""
@@ -0,0 +1,47 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare before.json after.json
+
+Prints every timing and memory figure present in both runs with its relative
+change, matching recommender results by size.
+"""
+
+import argparse
+import json
+
+def figures(run):
+	""" flat {name: value} of the numbers worth comparing in a run """
+	out = {}
+	def walk(prefix,d):
+		for k,v in d.items():
+			name = prefix+'.'+k if prefix else k
+			if isinstance(v,dict):
+				walk(name,v)
+			elif isinstance(v,(int,float)) and (k.endswith('_ms') or k.endswith('_s') or k.endswith('_mb') or k.endswith('_bytes') or k == 'ids_per_s'):
+				out[name] = v
+	for r in run.get('recommender',[]):
+		if 'size' in r:
+			walk('recommender.%d' % r['size'],r)
+	if run.get('web') and 'size' in run['web']:
+		walk('web.%d' % run['web']['size'],run['web'])
+	return out
+
+def main():
+	parser = argparse.ArgumentParser(description='relative change between two benchmark runs')
+	parser.add_argument('before')
+	parser.add_argument('after')
+	args = parser.parse_args()
+
+	with open(args.before) as f:
+		before = figures(json.load(f))
+	with open(args.after) as f:
+		after = figures(json.load(f))
+
+	for name in sorted(set(before) & set(after)):
+		a,b = before[name],after[name]
+		change = '%+.1f%%' % (100.0*(b-a)/a) if a else 'n/a'
+		print '%-60s %12s %12s %9s' % (name,a,b,change)
+
+if __name__ == "__main__":
+	main()
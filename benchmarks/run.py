@@ -0,0 +1,254 @@
+"""
+Run the benchmarks and write the results as JSON
+
+    python -m benchmarks.run --sizes 10k,100k,1m --web-size 10k --out results.json
+
+Each size is generated and measured in its own child process, so the peak
+memory of one does not leak into the next. The recommender is measured with
+whatever config.py selects (ANN_BACKEND, MODEL_STORAGE, ...), which the run
+records next to its results.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import numpy as np
+import scipy
+import config
+from benchmarks.synthetic import make_embedding, write_model, make_databases
+from benchmarks.standins import SqliteMySQLdb, StubDiscogsSession
+
+def parse_size(text):
+	""" '10k' -> 10000, '1m' -> 1000000 """
+	text = text.strip().lower()
+	scale = {'k':1000,'m':1000000}.get(text[-1:],1)
+	return int(float(text.rstrip('km'))*scale)
+
+def peak_rss_mb():
+	""" the peak resident set size of this process so far """
+	return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,1)
+
+def percentiles(times):
+	""" summary of latencies given in seconds, in milliseconds """
+	ms = np.array(times)*1000
+	return {
+		'n':len(ms),
+		'mean_ms':round(float(np.mean(ms)),3),
+		'p50_ms':round(float(np.percentile(ms,50)),3),
+		'p90_ms':round(float(np.percentile(ms,90)),3),
+		'p99_ms':round(float(np.percentile(ms,99)),3),
+		'max_ms':round(float(np.max(ms)),3)
+	}
+
+def timed(fn,args):
+	""" run fn(*a) for every a in args; returns the latency of each call """
+	times = []
+	for a in args:
+		t = time.time()
+		fn(*a)
+		times.append(time.time()-t)
+	return times
+
+def in_child(fn,*args):
+	""" fn(*args) in a fresh process; its result, or the error it raised """
+	queue = multiprocessing.Queue()
+	def target():
+		try:
+			queue.put(fn(*args))
+		except Exception:
+			queue.put({'error':traceback.format_exc()})
+	p = multiprocessing.Process(target=target)
+	p.start()
+	result = queue.get()
+	p.join()
+	return result
+
+def generate(n,workdir,seed):
+	U,ids = make_embedding(n,seed=seed)
+	write_model(workdir,U,ids)
+	return {'peak_rss_mb':peak_rss_mb()}
+
+def bench_recommender(n,workdir,n_queries,batch,seed):
+	""" construction time and memory, then per-call latency of the recommender's query methods """
+	from recommender import ArtistRecommender
+
+	config.U_path = os.path.join(workdir,'U.npz')
+	config.otherdata_path = os.path.join(workdir,'ids.npz')
+	config.MODEL_ARTIFACT_PATH = ''
+
+	baseline = peak_rss_mb()
+	t = time.time()
+	rec = ArtistRecommender()
+	construct = time.time()-t
+	memory = rec.memory_report()
+
+	rng = np.random.RandomState(seed)
+	ids = [rec.artist_list[i] for i in rng.randint(0,n,n_queries)]
+	points = rng.rand(n_queries,rec.U.shape[1])
+
+	result = {
+		'size':n,
+		'construct_s':round(construct,3),
+		'baseline_rss_mb':baseline,
+		'peak_rss_mb':peak_rss_mb(),
+		'private_bytes':memory['private_bytes'],
+		'mapped_bytes':memory['mapped_bytes'],
+		'recommend':percentiles(timed(rec.recommend,[(i,20) for i in ids])),
+		'searchnear':percentiles(timed(rec.searchnear,[(p,25) for p in points])),
+		'getlocationof':percentiles(timed(rec.getlocationof,[(i,) for i in ids]))
+	}
+
+	batches = [[rec.artist_list[i] for i in rng.randint(0,n,batch)] for j in xrange(max(1,n_queries//batch))]
+	times = timed(rec.recommend_many,[(b,20) for b in batches])
+	result['recommend_many'] = dict(percentiles(times),batch=batch,ids_per_s=round(batch*len(batches)/sum(times),1))
+	return result
+
+def bench_web(n,workdir,n_requests,discogs_delay,seed):
+	""" drive the Flask routes through the test client against the sqlite stand-ins """
+	main_db = os.path.join(workdir,'mysql.db')
+	sub_db = os.path.join(workdir,'subtables.db')
+	t = time.time()
+	names = make_databases(main_db,sub_db,np.load(os.path.join(workdir,'ids.npz'))['arr_0'],seed=seed)
+	setup = time.time()-t
+
+	config.U_path = os.path.join(workdir,'U.npz')
+	config.otherdata_path = os.path.join(workdir,'ids.npz')
+	config.MODEL_ARTIFACT_PATH = ''
+	config.DELTA_PATH = ''
+	config.CACHE_SHARED_PATH = ''
+	config.COVER_STORE_PATH = os.path.join(workdir,'covers.db')
+	config.SECRET_KEY = 'benchmark'
+	sys.modules['MySQLdb'] = SqliteMySQLdb({config.MYSQL_DATABASE:main_db,'SubTables':sub_db})
+
+	import reco
+	reco.app.config['DATABASE'] = os.path.join(workdir,'reco.db')
+	reco.app.config['WTF_CSRF_ENABLED'] = False
+	reco.init_db()
+	reco.cooccurrence.path = reco.app.config['DATABASE']
+	session = StubDiscogsSession(discogs_delay)
+	reco.discogs._ensure_pool()
+	reco.discogs.session = session
+
+	startup = {}
+	for label,fn in [('recommender',reco.get_recommender),('catalog',reco.catalog.refresh),('search_index',reco.search_index.refresh),('home_snapshot',reco.get_home_snapshot)]:
+		t = time.time()
+		fn()
+		startup[label+'_s'] = round(time.time()-t,3)
+
+	rng = np.random.RandomState(seed)
+	rec = reco.get_recommender()
+	ids = list(names)
+	def some_id():
+		return ids[rng.randint(len(ids))]
+	def some_point():
+		return np.clip(rec.getlocationof(some_id())+rng.randn(rec.U.shape[1])*0.02,0,1)
+	def point_form(prefix='x'):
+		return dict(('%s%d' % (prefix,d),repr(float(x))) for d,x in enumerate(some_point()))
+
+	routes = [
+		('home',lambda: ('get','/',{})),
+		('artist_page',lambda: ('get','/artist/%s' % some_id(),{})),
+		('recommend_id',lambda: ('post','/json/recommend/id',{'data':{'aid':some_id()}})),
+		('searchnear',lambda: ('post','/json/recommend/searchnear',{'data':point_form()})),
+		('recommend_batch',lambda: ('post','/json/recommend/batch',{'data':json.dumps({'ids':[some_id() for j in range(100)],'k':20}),'content_type':'application/json'})),
+		('rising',lambda: ('post','/json/recommend/rising',{'data':{'aid':some_id()}})),
+		('radius',lambda: ('post','/json/recommend/radius',{'data':dict(point_form(),r='0.05',limit='100')})),
+		('soundslike',lambda: ('post','/json/artistid/soundslike',{'data':{'search_term':names[some_id()]}})),
+		('autocomplete',lambda: ('get','/json/artistid/autocomplete?search_term=%s' % names[some_id()][:4],{})),
+		('artist_search',lambda: ('post','/artistsearch/',{'data':{'searchbox':names[some_id()]}})),
+		('albumcovers_batch',lambda: ('post','/albumcovers/batch',{'data':json.dumps({'ids':[some_id() for j in range(24)],'N':1}),'content_type':'application/json'})),
+		('favorites',lambda: ('post','/favorites',{'data':dict(('a%d' % j,names[some_id()]) for j in (1,2,3))}))
+	]
+
+	client = reco.app.test_client()
+	results = {}
+	for label,make in routes:
+		times = []
+		statuses = {}
+		for j in xrange(n_requests):
+			method,url,kwargs = make()
+			t = time.time()
+			r = getattr(client,method)(url,**kwargs)
+			r.get_data()
+			times.append(time.time()-t)
+			statuses[str(r.status_code)] = statuses.get(str(r.status_code),0)+1
+		results[label] = dict(percentiles(times),status=statuses)
+
+	return {
+		'size':n,
+		'setup_s':round(setup,3),
+		'startup':startup,
+		'routes':results,
+		'discogs_calls':session.calls,
+		'cache':reco.cache.stats(),
+		'peak_rss_mb':peak_rss_mb()
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='benchmark the recommender and the web hot paths on synthetic data')
+	parser.add_argument('--sizes',default='10k,100k',help='comma separated numbers of artists, e.g. 10k,100k,1m,10m (default: 10k,100k)')
+	parser.add_argument('--queries',type=int,default=1000,help='calls per recommender method (default: 1000)')
+	parser.add_argument('--batch',type=int,default=1000,help='ids per recommend_many call (default: 1000)')
+	parser.add_argument('--web-size',default='10k',help='number of artists for the web benchmark, or 0 to skip it (default: 10k)')
+	parser.add_argument('--requests',type=int,default=200,help='requests per route (default: 200)')
+	parser.add_argument('--discogs-delay',type=float,default=0.0,help='seconds the stubbed Discogs takes per search (default: 0)')
+	parser.add_argument('--seed',type=int,default=0)
+	parser.add_argument('--workdir',help='keep the generated files here instead of a temporary directory')
+	parser.add_argument('--out',help='write the JSON results here instead of stdout')
+	args = parser.parse_args()
+
+	run = {
+		'started_at':time.time(),
+		'python':platform.python_version(),
+		'numpy':np.__version__,
+		'scipy':scipy.__version__,
+		'platform':platform.platform(),
+		'cpus':multiprocessing.cpu_count(),
+		'seed':args.seed,
+		'config':dict((k,getattr(config,k)) for k in ['ANN_BACKEND','ANN_PARAMS','MODEL_STORAGE','NEIGHBOR_TABLE_K','SEARCHNEAR_GRID_STEP']),
+		'recommender':[],
+		'web':None
+	}
+
+	root = args.workdir or tempfile.mkdtemp(prefix='reco-bench-')
+	try:
+		for size in [parse_size(s) for s in args.sizes.split(',') if s.strip()]:
+			workdir = os.path.join(root,str(size))
+			if not os.path.exists(os.path.join(workdir,'U.npz')):
+				if not os.path.exists(workdir):
+					os.makedirs(workdir)
+				in_child(generate,size,workdir,args.seed)
+			print >>sys.stderr, 'recommender, %d artists' % size
+			run['recommender'].append(in_child(bench_recommender,size,workdir,args.queries,args.batch,args.seed))
+
+		web_size = parse_size(args.web_size)
+		if web_size > 0:
+			workdir = os.path.join(root,str(web_size))
+			if not os.path.exists(os.path.join(workdir,'U.npz')):
+				if not os.path.exists(workdir):
+					os.makedirs(workdir)
+				in_child(generate,web_size,workdir,args.seed)
+			print >>sys.stderr, 'web, %d artists' % web_size
+			run['web'] = in_child(bench_web,web_size,workdir,args.requests,args.discogs_delay,args.seed)
+	finally:
+		if not args.workdir:
+			shutil.rmtree(root,ignore_errors=True)
+
+	run['finished_at'] = time.time()
+	out = json.dumps(run,indent=1,sort_keys=True)
+	if args.out:
+		with open(args.out,'w') as f:
+			f.write(out+'\n')
+	else:
+		print out
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,107 @@
+"""
+Stand-ins for the services the app talks to
+
+MySQLdb is replaced by a module-like object whose connections are sqlite files
+(one per database name); queries are translated from MySQL's format
+paramstyle, and the splitname() function of our MySQL server is registered
+with sqlite. Discogs is replaced by a session that answers every search with
+canned results after an optional delay.
+"""
+
+import sqlite3
+import time
+from search import phonetic_key
+
+def _concat(*parts):
+	return ''.join(u'' if p is None else unicode(p) for p in parts)
+
+class Cursor(object):
+
+	def __init__(self,conn):
+		self._cur = conn.cursor()
+		self.rowcount = -1
+
+	def execute(self,q,args=None):
+		self._cur.execute(q.replace('%s','?').replace('%%','%'),tuple(args or ()))
+		self.rowcount = self._cur.rowcount
+		return self.rowcount
+
+	def executemany(self,q,args):
+		self._cur.executemany(q.replace('%s','?').replace('%%','%'),args)
+
+	def fetchone(self):
+		return self._cur.fetchone()
+
+	def fetchmany(self,size=1):
+		return self._cur.fetchmany(size)
+
+	def fetchall(self):
+		return self._cur.fetchall()
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def close(self):
+		self._cur.close()
+
+class Connection(object):
+
+	def __init__(self,path):
+		self._conn = sqlite3.connect(path,check_same_thread=False)
+		self._conn.create_function('concat',-1,_concat)
+		self._conn.create_function('splitname',1,phonetic_key)
+
+	def cursor(self):
+		return Cursor(self._conn)
+
+	def ping(self,*args):
+		pass
+
+	def autocommit(self,on):
+		self._conn.isolation_level = None if on else ''
+
+	def commit(self):
+		self._conn.commit()
+
+	def rollback(self):
+		self._conn.rollback()
+
+	def close(self):
+		self._conn.close()
+
+class SqliteMySQLdb(object):
+	""" put in sys.modules['MySQLdb'] before reco is imported """
+
+	Error = sqlite3.Error
+	OperationalError = sqlite3.OperationalError
+
+	def __init__(self,paths):
+		self.paths = paths # database name -> sqlite file
+
+	def connect(self,db=None,**kwargs):
+		return Connection(self.paths[db])
+
+class StubResponse(object):
+
+	status_code = 200
+	headers = {}
+
+	def __init__(self,payload):
+		self.payload = payload
+
+	def json(self):
+		return self.payload
+
+class StubDiscogsSession(object):
+	""" answers Discogs searches with three covers after delay seconds, and counts them """
+
+	def __init__(self,delay=0.0):
+		self.delay = delay
+		self.calls = 0
+
+	def get(self,url,params=None,timeout=None):
+		self.calls += 1
+		if self.delay:
+			time.sleep(self.delay)
+		artist = params.get('artist','')
+		return StubResponse({'results':[{'thumb':'https://img.example.com/%s/%d.jpg' % (artist.replace(' ','_'),j)} for j in range(3)]})
@@ -0,0 +1,107 @@
+"""
+Synthetic models and databases of any size
+"""
+
+import os
+import sqlite3
+import numpy as np
+from search import phonetic_key
+
+WORDS = ['red','blue','night','city','river','ghost','golden','electric','young','wild',
+	'silver','black','sun','moon','echo','velvet','stone','crystal','neon','paper']
+
+def make_embedding(n,dims=5,clusters=64,seed=0,chunk=1000000):
+	"""
+		n artists in a dims-dimensional embedding: gaussian clusters of very different
+		sizes (like genres) plus a few far outliers for the clipping to deal with;
+		returns [U,artist_ids] with the ids as shuffled unique numeric strings
+	"""
+	rng = np.random.RandomState(seed)
+	centres = rng.randn(clusters,dims)*4
+	spread = rng.uniform(0.2,1.5,clusters)
+	weights = rng.pareto(1.5,clusters)+1
+	weights /= weights.sum()
+
+	U = np.empty((n,dims))
+	for a in xrange(0,n,chunk):
+		m = min(chunk,n-a)
+		c = rng.choice(clusters,m,p=weights)
+		U[a:a+m] = centres[c]+rng.randn(m,dims)*spread[c][:,None]
+	outliers = rng.choice(n,max(1,n//100000),replace=False)
+	U[outliers] *= 1000
+
+	ids = rng.permutation(n)*7+1
+	return [U,np.array([str(i) for i in ids])]
+
+def write_model(workdir,U,ids):
+	""" the npz files ArtistRecommender reads through config.U_path and config.otherdata_path """
+	U_path = os.path.join(workdir,'U.npz')
+	ids_path = os.path.join(workdir,'ids.npz')
+	np.savez(U_path,U)
+	np.savez(ids_path,ids)
+	return [U_path,ids_path]
+
+def artist_name(rng,aid):
+	return '%s %s %s' % (WORDS[rng.randint(len(WORDS))].title(),WORDS[rng.randint(len(WORDS))].title(),aid)
+
+def make_databases(main_path,sub_path,ids,seed=0,songs_per_artist=3,chunk=100000):
+	"""
+		sqlite files with the tables and columns the app reads from MySQL: Artists,
+		ArtistAlias, Songs and Genres in main_path, the home page tables of SubTables in
+		sub_path; returns the artist names by id
+	"""
+	rng = np.random.RandomState(seed)
+	for path in (main_path,sub_path):
+		if os.path.exists(path):
+			os.remove(path)
+
+	db = sqlite3.connect(main_path)
+	db.executescript('''
+		create table Artists (artistId integer primary key, artistName text, artistPopularityAll real, artistPopularityRecent real, soundName text);
+		create table ArtistAlias (artistId integer, artistAlias text, AliasSound text);
+		create index ArtistAlias_artistId on ArtistAlias (artistId);
+		create table Songs (artistId integer, youtubeId text, songName text, url text, viewCount integer);
+		create index Songs_artistId on Songs (artistId);
+		create table Genres (name text, level integer);
+	''')
+
+	names = {}
+	for a in xrange(0,len(ids),chunk):
+		artists = []
+		aliases = []
+		songs = []
+		for aid in ids[a:a+chunk]:
+			aid = int(aid)
+			name = artist_name(rng,aid)
+			names[str(aid)] = name
+			popularity = rng.pareto(1.2)*10
+			artists.append((aid,name,popularity,popularity*rng.uniform(0.5,1.5),phonetic_key(name)))
+			aliases.append((aid,name,phonetic_key(name)))
+			if rng.rand() < 0.2:
+				alias = 'The '+name
+				aliases.append((aid,alias,phonetic_key(alias)))
+			for s in xrange(songs_per_artist):
+				songs.append((aid,'yt%d_%d' % (aid,s),'Song %d' % s,'https://www.youtube.com/watch?v=%d%d' % (aid,s),int(rng.pareto(1.0)*1000)))
+		db.executemany('insert into Artists values (?,?,?,?,?);',artists)
+		db.executemany('insert into ArtistAlias values (?,?,?);',aliases)
+		db.executemany('insert into Songs values (?,?,?,?,?);',songs)
+	db.executemany('insert into Genres values (?,1);',[(w.title(),) for w in WORDS])
+	db.commit()
+
+	sample = [str(i) for i in rng.choice(ids,min(len(ids),200),replace=False)]
+	sub = sqlite3.connect(sub_path)
+	sub.executescript('''
+		create table trenSong (youtubeId text, songName text, url text, viewCount integer);
+		create table popuSong (youtubeId text, songName text, url text, viewCount integer);
+		create table recArtist (artistName text, artistId integer, artistPopularityRecent real);
+		create table popuArtist (artistName text, artistId integer, artistPopularityAll real);
+	''')
+	for table in ('trenSong','popuSong'):
+		sub.executemany('insert into '+table+' values (?,?,?,?);',[('yt%s' % i,'Song','https://www.youtube.com/watch?v=%s' % i,j) for j,i in enumerate(sample)])
+	for table in ('recArtist','popuArtist'):
+		sub.executemany('insert into '+table+' values (?,?,?);',[(names[i],int(i),j) for j,i in enumerate(sample)])
+	sub.commit()
+
+	db.close()
+	sub.close()
+	return names
@@ -0,0 +1,51 @@
+"""
+Build the on-disk recommender artifact
+
+    python build_model.py /srv/reco/model
+
+Runs the outlier clipping and normalization of ArtistRecommender once
+(plus the index of a non-exact ANN_BACKEND), precomputes every artist's nearest neighbours, and writes the result to <out_dir>/<version>/,
+then points <out_dir>/CURRENT at it. Set MODEL_ARTIFACT_PATH in config.py
+to <out_dir> to have the app memory-map it. Artists queued in DELTA_PATH are
+folded in, and the workers replay only the ones queued after the build.
+
+Workers never fold the delta into a mapped artifact themselves, so run this
+from cron to compact it, e.g. every few minutes with
+
+    python build_model.py /srv/reco/model --min-delta 10000
+
+which only builds once that many artists were queued since the live version.
+"""
+
+import argparse
+import os
+import sys
+import time
+import config
+from recommender import build_artifact, artifact_meta, STORAGE
+from delta import count_delta
+
+def main():
+	parser = argparse.ArgumentParser(description='build the memory-mappable recommender artifact')
+	parser.add_argument('out_dir')
+	parser.add_argument('--U',dest='U_path',default=config.U_path,help='npz holding U (default: config.U_path)')
+	parser.add_argument('--ids',dest='otherdata_path',default=config.otherdata_path,help='npz holding the artist ids (default: config.otherdata_path)')
+	parser.add_argument('--neighbors',dest='neighbor_k',type=int,default=config.NEIGHBOR_TABLE_K,help='width of the precomputed neighbour table, 0 to skip it (default: config.NEIGHBOR_TABLE_K)')
+	parser.add_argument('--hot-cells',dest='hot_cells',type=int,default=config.SEARCHNEAR_HOT_CELLS,help='precompute searchnear for this many of the most crowded grid cells (default: config.SEARCHNEAR_HOT_CELLS)')
+	parser.add_argument('--storage',default=config.MODEL_STORAGE,choices=STORAGE,help='how U is stored (default: config.MODEL_STORAGE)')
+	parser.add_argument('--delta',dest='delta_path',default=config.DELTA_PATH,help='fold the queued artists of this delta file into the model (default: config.DELTA_PATH)')
+	parser.add_argument('--min-delta',dest='min_delta',type=int,default=0,help='do nothing unless the delta file holds at least this many rows the current version of out_dir lacks (default: 0, always build)')
+	args = parser.parse_args()
+
+	if args.min_delta > 0 and os.path.exists(os.path.join(args.out_dir,'CURRENT')):
+		pending = count_delta(args.delta_path,artifact_meta(args.out_dir).get('delta_seq',0)) if args.delta_path else 0
+		if pending < args.min_delta:
+			print "%d queued artists since the current version, fewer than %d; nothing to do" % (pending,args.min_delta)
+			sys.exit(0)
+
+	started = time.time()
+	path = build_artifact(args.out_dir,args.U_path,args.otherdata_path,args.neighbor_k,args.hot_cells,args.storage,args.delta_path)
+	print "wrote %s in %.1fs" % (path,time.time()-started)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,268 @@
+"""
+In-process caches
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+MISSING = object() # default returned by ResponseCache.get for a miss, so None can be cached
+
+class LRUCache(object):
+	""" a bounded, thread-safe mapping that evicts the least recently used entries """
+
+	def __init__(self,maxsize=100000):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._data)
+
+	def __contains__(self,key):
+		return key in self._data
+
+	def get(self,key,default=None):
+		with self._lock:
+			try:
+				value = self._data.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self._data[key] = value
+			self.hits += 1
+			return value
+
+	def get_many(self,keys):
+		""" dict of the keys that are cached """
+		found = {}
+		with self._lock:
+			for key in keys:
+				if key in self._data:
+					found[key] = self._data.pop(key)
+					self._data[key] = found[key]
+					self.hits += 1
+				else:
+					self.misses += 1
+		return found
+
+	def set(self,key,value):
+		with self._lock:
+			self._data.pop(key,None)
+			self._data[key] = value
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def set_many(self,items):
+		for key,value in items.items():
+			self.set(key,value)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+class SingleFlight(object):
+	"""
+		coalesces concurrent work on the same keys: a key that is already being computed
+		by another thread is waited for instead of computed a second time
+	"""
+
+	def __init__(self,timeout=30):
+		self.timeout = timeout
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def do_many(self,keys,fn):
+		"""
+			dict of key -> result, where fn(keys) returns one result per key and is only
+			called with the keys nobody else is computing; failed keys map to None
+		"""
+		mine = []
+		theirs = {}
+		with self._lock:
+			for key in set(keys):
+				if key in self._calls:
+					theirs[key] = self._calls[key]
+				else:
+					self._calls[key] = [threading.Event(),None]
+					mine.append(key)
+
+		results = {}
+		try:
+			if len(mine) > 0:
+				results.update(zip(mine,fn(mine)))
+		finally:
+			with self._lock:
+				for key in mine:
+					call = self._calls.pop(key)
+					call[1] = results.get(key)
+					call[0].set()
+
+		for key,call in theirs.items():
+			call[0].wait(self.timeout)
+			results[key] = call[1]
+		return results
+
+class ResponseCache(object):
+	"""
+		a namespaced LRU for parsed API payloads and query results
+
+		every namespace has its own TTL; the total size of the cached values, measured
+		as their pickled length, is kept under max_bytes by evicting the least recently
+		used entries. An optional shared backend (SqliteCacheBackend) is consulted on a
+		local miss so that workers can reuse each other's answers.
+	"""
+
+	def __init__(self,max_bytes=64*1024*1024,ttls=None,default_ttl=3600,shared=None):
+		self.max_bytes = max_bytes
+		self.ttls = ttls or {}
+		self.default_ttl = default_ttl
+		self.shared = shared
+		self.bytes = 0
+		self._data = collections.OrderedDict() # (namespace,key) -> (value,expires,size)
+		self._counters = collections.defaultdict(lambda: collections.defaultdict(int))
+		self._lock = threading.Lock()
+
+	def ttl(self,namespace):
+		return self.ttls.get(namespace,self.default_ttl)
+
+	def _drop(self,k):
+		""" remove an entry; the caller holds the lock """
+		entry = self._data.pop(k)
+		self.bytes -= entry[2]
+		return entry
+
+	def get(self,namespace,key,default=MISSING):
+		k = (namespace,key)
+		now = time.time()
+		with self._lock:
+			counters = self._counters[namespace]
+			if k in self._data:
+				entry = self._drop(k)
+				if entry[1] > now:
+					self._data[k] = entry
+					self.bytes += entry[2]
+					counters['hits'] += 1
+					return entry[0]
+				counters['expirations'] += 1
+
+		if self.shared is not None:
+			found = self.shared.get(namespace,key,now)
+			if found is not None:
+				[blob,expires] = found
+				value = pickle.loads(blob)
+				self._store(k,value,expires,len(blob))
+				with self._lock:
+					counters['shared_hits'] += 1
+				return value
+
+		with self._lock:
+			counters['misses'] += 1
+		return default
+
+	def set(self,namespace,key,value,ttl=None):
+		expires = time.time()+(self.ttl(namespace) if ttl is None else ttl)
+		blob = pickle.dumps(value,pickle.HIGHEST_PROTOCOL)
+		self._store((namespace,key),value,expires,len(blob))
+		if self.shared is not None:
+			self.shared.set(namespace,key,blob,expires)
+
+	def _store(self,k,value,expires,size):
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			if k in self._data:
+				self._drop(k)
+			self._data[k] = (value,expires,size)
+			self.bytes += size
+			while self.bytes > self.max_bytes:
+				self._drop(next(iter(self._data)))
+				self._counters[k[0]]['evictions'] += 1
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.bytes = 0
+
+	def stats(self):
+		""" hit/miss/eviction counters per namespace plus the current size """
+		with self._lock:
+			entries = collections.Counter(ns for ns,key in self._data)
+			return {
+				'bytes':self.bytes,
+				'max_bytes':self.max_bytes,
+				'entries':len(self._data),
+				'namespaces':dict((ns,dict(c,entries=entries[ns])) for ns,c in self._counters.items())
+			}
+
+class LocalSqlite(object):
+	"""
+		sqlite connections to one file, one per thread and process (never inherited
+		from the gunicorn master), in WAL mode so that readers do not block the writer
+	"""
+
+	def __init__(self,path,schema):
+		self.path = path
+		self.schema = schema
+		self._local = threading.local()
+
+	def __call__(self):
+		conn = getattr(self._local,'conn',None)
+		if conn is None or self._local.pid != os.getpid():
+			conn = sqlite3.connect(self.path,timeout=1)
+			conn.execute('pragma journal_mode=wal;')
+			conn.executescript(self.schema)
+			self._local.conn = conn
+			self._local.pid = os.getpid()
+		return conn
+
+class SqliteCacheBackend(object):
+	"""
+		a cache table in a local sqlite file shared by all workers on the box
+
+		keys are stored hashed, so secrets in request URLs do not end up on disk
+	"""
+
+	def __init__(self,path,max_entries=200000,purge_every=1000):
+		self.path = path
+		self.max_entries = max_entries
+		self.purge_every = purge_every
+		self._writes = 0
+		self._conn = LocalSqlite(path,'create table if not exists cache (k text primary key, v blob not null, expires real not null);')
+
+	def _hash(self,namespace,key):
+		return hashlib.sha1(pickle.dumps((namespace,key),2)).hexdigest()
+
+	def get(self,namespace,key,now):
+		""" (blob,expires) for a live entry, otherwise None """
+		try:
+			row = self._conn().execute('select v, expires from cache where k = ? and expires > ?;',[self._hash(namespace,key),now]).fetchone()
+		except sqlite3.Error:
+			print "Shared cache read failed:", sys.exc_info()[1]
+			return None
+		return None if row is None else (str(row[0]),row[1])
+
+	def set(self,namespace,key,blob,expires):
+		try:
+			conn = self._conn()
+			conn.execute('insert or replace into cache values (?, ?, ?);',[self._hash(namespace,key),sqlite3.Binary(blob),expires])
+			conn.commit()
+			self._writes += 1
+			if self._writes % self.purge_every == 0:
+				self.purge()
+		except sqlite3.Error:
+			print "Shared cache write failed:", sys.exc_info()[1]
+
+	def purge(self):
+		""" drop expired entries, then the ones closest to expiry beyond max_entries """
+		conn = self._conn()
+		conn.execute('delete from cache where expires <= ?;',[time.time()])
+		conn.execute('delete from cache where k in (select k from cache order by expires desc limit -1 offset ?);',[self.max_entries])
+		conn.commit()
@@ -0,0 +1,179 @@
+"""
+In-memory artist catalog
+
+Loads artistId, artistName, artistPopularityAll and artistPopularityRecent from
+the Artists table into NumPy arrays aligned with the recommender's rows, so name
+lookups, trending scores and the mean popularity ratio are answered without
+touching MySQL. Artists that are not part of the model are kept in a small
+overflow dict.
+
+The trending score of every artist, artistPopularityRecent minus
+artistPopularityAll times the catalog-wide mean ratio of the two, is computed
+for all rows at once whenever a generation is built.
+
+A background thread reloads the table every refresh_interval seconds into new
+arrays and swaps them in; readers never wait on a refresh. If config names an
+"updated at" column (CATALOG_UPDATED_COLUMN) only rows changed since the last
+refresh are fetched and patched into copies of the arrays.
+"""
+
+import threading
+import time
+import numpy as np
+from background import Refreshing
+
+class CatalogSnapshot(object):
+	""" one consistent, read-only generation of the catalog """
+
+	def __init__(self,recommender,names,pop_all,pop_recent,present,overflow,watermark):
+		self.recommender = recommender
+		self.names = names
+		self.pop_all = pop_all
+		self.pop_recent = pop_recent
+		self.present = present
+		self.overflow = overflow
+		self.watermark = watermark
+		self.loaded_at = time.time()
+
+		# avg(artistPopularityRecent)/avg(artistPopularityAll) over the whole table, NULLs ignored
+		recent = np.concatenate([pop_recent[present],[o[2] for o in overflow.values() if o[2] is not None]])
+		theall = np.concatenate([pop_all[present],[o[1] for o in overflow.values() if o[1] is not None]])
+		recent = recent[~np.isnan(recent)]
+		theall = theall[~np.isnan(theall)]
+		self.mean_popularity_ratio = float(np.mean(recent)/np.mean(theall)) if len(recent) and len(theall) else None
+
+		# NaN where either popularity is unknown
+		self.trending = pop_recent-pop_all*(np.nan if self.mean_popularity_ratio is None else self.mean_popularity_ratio)
+
+	def lookup(self,ids):
+		""" (name,popularityAll,popularityRecent) per id, None for ids the catalog does not know """
+		rows = self.recommender.rows_of(ids)
+		out = []
+		for i,r in zip(ids,rows):
+			if 0 <= r < len(self.present) and self.present[r]:
+				out.append((self.names[r],self.pop_all[r],self.pop_recent[r]))
+			else:
+				out.append(self.overflow.get(str(i)))
+		return out
+
+	def trending_of(self,ids):
+		""" trending scores for a sequence of ids as a float array, NaN where unknown """
+		ids = list(ids)
+		rows = self.recommender.rows_of(ids)
+		inmain = (rows >= 0) & (rows < len(self.present))
+		scores = np.empty(len(ids))
+		scores.fill(np.nan)
+		scores[inmain] = self.trending[rows[inmain]]
+
+		mu = self.mean_popularity_ratio
+		for j in np.flatnonzero(~inmain):
+			entry = self.overflow.get(str(ids[j]))
+			if entry is not None and entry[1] is not None and entry[2] is not None and mu is not None:
+				scores[j] = entry[2]-entry[1]*mu
+		return scores
+
+	def rising(self,ids,dist,n=10,distance_weight=0.5):
+		"""
+			the n most trending of a neighbourhood of artists given as ids and distances
+
+			each artist scores its trending relative to the most trending one in the
+			neighbourhood, less distance_weight times its distance relative to the farthest;
+			artists that are not trending up are left out. returns [positions into ids,score,trending]
+			best first
+		"""
+		dist = np.asarray(dist,dtype=np.float64)
+		trending = self.trending_of(ids)
+		with np.errstate(invalid='ignore'):
+			up = np.flatnonzero((trending > 0) & np.isfinite(dist)) # NaN compares False
+		if len(up) == 0:
+			return [up,np.zeros(0),np.zeros(0)]
+
+		farthest = dist[up].max()
+		score = trending[up]/trending[up].max()-distance_weight*(dist[up]/farthest if farthest > 0 else 0)
+
+		best = np.argsort(-score,kind='mergesort')[:n]
+		return [up[best],score[best],trending[up[best]]]
+
+class ArtistCatalog(Refreshing):
+
+	def __init__(self,connect,get_recommender,refresh_interval=900,updated_column='',chunk=50000):
+		self.connect = connect
+		self.get_recommender = get_recommender
+		self.refresh_interval = refresh_interval
+		self.updated_column = updated_column
+		self.chunk = chunk
+		self._snapshot = None
+		self._refresh_lock = threading.Lock()
+
+	@property
+	def loaded(self):
+		return self._snapshot is not None
+
+	def snapshot(self):
+		""" the current generation, or None until the first load finished """
+		return self._snapshot
+
+	def _fetch(self,where='',args=()):
+		""" stream (artistId,artistName,artistPopularityAll,artistPopularityRecent,watermark) in artistId order """
+		watermark = self.updated_column or 'NULL'
+		q = "select artistId, artistName, artistPopularityAll, artistPopularityRecent, "+watermark+" from Artists where artistId > %s"+where+" order by artistId limit %s;"
+		conn = self.connect()
+		try:
+			cur = conn.cursor()
+			last = -1
+			while True:
+				cur.execute(q,(last,)+tuple(args)+(self.chunk,))
+				rows = cur.fetchall()
+				for row in rows:
+					yield row
+				if len(rows) < self.chunk:
+					break
+				last = rows[-1][0]
+		finally:
+			conn.close()
+
+	def refresh(self):
+		""" load the table (or just its changed rows) and swap the new arrays in """
+		with self._refresh_lock:
+			rec = self.get_recommender()
+			old = self._snapshot
+			if old is not None and old.recommender is rec and self.updated_column and old.watermark is not None:
+				self._snapshot = self._patched(old,self._fetch(' and '+self.updated_column+' > %s',(old.watermark,)))
+			else:
+				self._snapshot = self._patched(self._empty(rec),self._fetch())
+			return self._snapshot
+
+	def _empty(self,rec):
+		n = rec.U.shape[0]
+		pop_all = np.empty(n)
+		pop_all.fill(np.nan)
+		return CatalogSnapshot(rec,np.empty(n,dtype=object),pop_all,pop_all.copy(),np.zeros(n,dtype=bool),{},None)
+
+	def _patched(self,base,rows):
+		""" a new snapshot with rows written over copies of base's arrays """
+		rows = list(rows)
+		if len(rows) == 0 and base is self._snapshot:
+			return base
+
+		names = base.names.copy()
+		pop_all = base.pop_all.copy()
+		pop_recent = base.pop_recent.copy()
+		present = base.present.copy()
+		overflow = dict(base.overflow)
+		watermark = base.watermark
+
+		ids = [str(r[0]) for r in rows]
+		inxes = base.recommender.rows_of(ids)
+		nan = float('nan')
+		for i,inx,(aid,name,theall,recent,mark) in zip(ids,inxes,rows):
+			if inx >= 0:
+				names[inx] = name
+				pop_all[inx] = nan if theall is None else theall
+				pop_recent[inx] = nan if recent is None else recent
+				present[inx] = True
+			else:
+				overflow[i] = (name,theall,recent)
+			if mark is not None and (watermark is None or mark > watermark):
+				watermark = mark
+
+		return CatalogSnapshot(base.recommender,names,pop_all,pop_recent,present,overflow,watermark)
@@ -8,14 +8,120 @@ SECRET_KEY=''
 DISCOGS_CONSUMER_KEY=''
 DISCOGS_CONSUMER_SECRET=''
 DISCOGS_APP_USER_AGENT=''
+DISCOGS_POOL_SIZE=8 # concurrent Discogs requests (and pooled connections) per worker
+DISCOGS_MAX_RETRIES=3
+
+# album cover urls are kept in a local sqlite file (default: covers.db next to reco.db)
+COVER_STORE_PATH=''
+COVER_STORE_N=3 # covers stored per artist
+COVER_MAX_AGE=7*24*3600 # seconds before a stored entry is refreshed
 
 MYSQL_HOST=''
 MYSQL_DATABASE=''
 MYSQL_USER=''
 MYSQL_PASSWORD=''
 MYSQL_PORT=3306
+MYSQL_POOL_SIZE=10 # pooled connections per worker, for each of the main database and SubTables
 
 U_path = ''
 otherdata_path = ''
 
 dimlabels=[['',''],['',''],['',''],['',''],['','']]
+
+# pin a model version string; when empty it is derived from the model files
+MODEL_VERSION = ''
+
+# directory written by build_model.py; when set it is memory-mapped instead of U_path/otherdata_path
+MODEL_ARTIFACT_PATH = ''
+
+# workers check MODEL_ARTIFACT_PATH/CURRENT this often (seconds) and swap in a newly
+# built version without a restart once it passes validation; 0 disables it
+MODEL_WATCH_SECONDS = 60
+
+# how the normalized U is held: 'float64', 'float32' or 'uint8' (per-dimension codes that
+# non-exact backends scan, with the best MODEL_RERANK_SHORTLIST*k candidates re-ranked
+# against a float32 U); with MODEL_COMPACT_IDS numeric artist ids are kept as integers.
+# Only non-exact backends take the smaller storages: the exact backend's tree keeps float64
+# coordinates, so loading a model refuses anything but 'float64' with it
+MODEL_STORAGE = 'float64'
+MODEL_RERANK_SHORTLIST = 4
+MODEL_COMPACT_IDS = False
+
+# artists added or re-embedded since the model was built are queued in this sqlite file
+# (see add_artists.py); workers poll it and, without MODEL_ARTIFACT_PATH, fold the delta
+# into a new index in memory once it adds or hides DELTA_COMPACT_ROWS rows. With an
+# artifact, build_model.py --delta --min-delta N (from cron) folds it into a new version
+# instead. empty disables it
+DELTA_PATH = ''
+DELTA_POLL_SECONDS = 30
+DELTA_COMPACT_ROWS = 10000
+
+# limits for /json/recommend/batch
+BATCH_MAX_IDS = 1000
+BATCH_MAX_K = 100
+
+# width of the precomputed neighbour table in the model artifact (0 disables it)
+NEIGHBOR_TABLE_K = 25
+
+# Genre Vision queries are snapped to a grid with this spacing in [0,1] space (0 disables it)
+# and whole /json/recommend/searchnear responses are cached per cell; build_model.py
+# precomputes the answers of the SEARCHNEAR_HOT_CELLS cells holding the most artists
+SEARCHNEAR_K = 25
+SEARCHNEAR_GRID_STEP = 0.02
+SEARCHNEAR_CACHE_SIZE = 50000
+SEARCHNEAR_HOT_CELLS = 0
+
+# /json/recommend/radius and /json/recommend/box: default and largest page of results
+REGION_PAGE_SIZE = 100
+REGION_MAX_RESULTS = 10000
+# largest radius and box side accepted, and most artists a region may hold before it is
+# refused, since the whole region is gathered and sorted before a page is cut from it
+REGION_MAX_RADIUS = 0.2
+REGION_MAX_EXTENT = 0.4
+REGION_MAX_CANDIDATES = 200000
+
+# /json/recommend/rising ranks the TRENDING_NEAR_K artists nearest to an artist or point by
+# their trending score less TRENDING_DISTANCE_WEIGHT times their relative distance, and
+# returns the best TRENDING_NEAR_N; the scores are recomputed with every catalog refresh
+TRENDING_NEAR_K = 200
+TRENDING_NEAR_N = 10
+TRENDING_DISTANCE_WEIGHT = 0.5
+
+# nearest-neighbour backend for the recommender: 'exact' (cKDTree) or 'ivf' (approximate, see backends.py)
+ANN_BACKEND = 'exact'
+ANN_PARAMS = {} # e.g. {'nlist':2048,'nprobe':8} for 'ivf'
+
+# number of artistId -> artistName entries kept in memory per worker
+ARTIST_NAME_CACHE_SIZE = 200000
+
+# the in-memory artist catalog is reloaded from the Artists table this often (seconds);
+# name a last-modified column of Artists to fetch only changed rows on each refresh
+CATALOG_REFRESH_SECONDS = 900
+CATALOG_UPDATED_COLUMN = ''
+
+# the in-memory artist name search index is rebuilt from ArtistAlias this often (seconds)
+SEARCH_INDEX_REFRESH_SECONDS = 3600
+
+# response cache: total size per worker, TTL (seconds) per namespace, and an optional
+# sqlite file shared by all workers on the box (e.g. next to reco.db)
+CACHE_MAX_BYTES = 64*1024*1024
+CACHE_TTLS = {'discogs':7*24*3600,'search':600}
+CACHE_SHARED_PATH = ''
+
+# requests slower than this (seconds) are logged with the time each stage (db query,
+# recommender call, Discogs, template, ...) took; 0 disables the log
+SLOW_REQUEST_SECONDS = 0
+
+# directory where every worker writes its metrics (at most every METRICS_FLUSH_SECONDS,
+# after a request) so that /metrics adds up those of all workers; without it /metrics
+# reports only the worker that answers. gunicorn.conf.py uses a temporary one if unset
+METRICS_SHARED_PATH = ''
+METRICS_FLUSH_SECONDS = 5
+
+# the home page candidate lists are reloaded from SubTables this often (seconds)
+HOME_SNAPSHOT_REFRESH_SECONDS = 300
+
+# /favorites submissions are written to sqlite this often (seconds), and every worker
+# reloads the whole co-occurrence graph from sqlite to see the others' submissions
+COOCCURRENCE_FLUSH_SECONDS = 2
+COOCCURRENCE_RELOAD_SECONDS = 60
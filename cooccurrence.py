@@ -0,0 +1,172 @@
+"""
+Artist co-occurrence graph for /favorites
+
+The a2a link weights and the a display names live in memory: one neighbour
+map per artist, plus every artist's total link weight. The top artists for a
+submission are then found in O(degree) of the submitted artists. The
+popularity fallback walks a ranking that is sorted once per load, rescoring
+the few artists whose weight changed since.
+
+Submissions are applied in memory immediately and written behind to sqlite
+by a background thread, batched with executemany, with the database in WAL
+mode. The graph is reloaded from sqlite every reload_interval seconds so that
+each worker also sees the others' submissions. Submissions that were not yet
+flushed are lost if the process dies, which is at most flush_interval seconds.
+"""
+
+import atexit
+import collections
+import sqlite3
+import threading
+import time
+from background import Refreshing
+
+class CooccurrenceGraph(Refreshing):
+
+	def __init__(self,path,flush_interval=2,reload_interval=60):
+		self.path = path
+		self.refresh_interval = flush_interval
+		self.reload_interval = reload_interval
+		self.loaded = False
+		self._lock = threading.RLock()
+		self._io_lock = threading.RLock() # serializes flushes and loads
+		self._links = collections.defaultdict(float) # (aid1,aid2) -> weight to add
+		self._artists = {} # aid -> display, for artists not written yet
+		self._reset()
+		atexit.register(self.flush)
+
+	def _reset(self):
+		self.adj = collections.defaultdict(dict) # aid -> {aid: w}
+		self.strength = collections.defaultdict(float) # aid -> sum of its link weights
+		self.ranking = [] # (-strength,aid) sorted as of the last load
+		self.changed = set() # aids whose strength changed since the ranking was sorted
+		self.display = {} # aid -> display
+		self.loaded_at = None
+
+	def _connect(self):
+		conn = sqlite3.connect(self.path,timeout=5)
+		conn.execute('pragma journal_mode=wal;')
+		return conn
+
+	def load(self):
+		"""
+			replace the graph with the contents of sqlite, after writing out our own pending
+			submissions; the new graph is built without holding the lock, so /favorites is
+			only blocked for the swap
+		"""
+		with self._io_lock:
+			self.flush()
+			adj = collections.defaultdict(dict)
+			strength = collections.defaultdict(float)
+			display = {}
+			conn = self._connect()
+			try:
+				for aid,name in conn.execute('select aid, display from a;'):
+					display[aid] = name
+				for aid1,aid2,w in conn.execute('select aid1, aid2, w from a2a;'):
+					adj[aid1][aid2] = adj[aid1].get(aid2,0)+w
+					adj[aid2][aid1] = adj[aid2].get(aid1,0)+w
+					strength[aid1] += w
+					strength[aid2] += w
+			finally:
+				conn.close()
+			ranking = sorted((-s,aid) for aid,s in strength.iteritems())
+
+			with self._lock:
+				self._reset()
+				self.adj = adj
+				self.strength = strength
+				self.ranking = ranking
+				self.display = display
+				# submissions made since the flush are not in sqlite yet
+				self.display.update(self._artists)
+				for (aid1,aid2),w in self._links.items():
+					self._add_link(aid1,aid2,w)
+				self.loaded = True
+				self.loaded_at = time.time()
+
+	def _add_link(self,aid1,aid2,w):
+		""" add w to a link in memory; the caller holds the lock """
+		self.adj[aid1][aid2] = self.adj[aid1].get(aid2,0)+w
+		self.adj[aid2][aid1] = self.adj[aid2].get(aid1,0)+w
+		for aid in (aid1,aid2):
+			self.strength[aid] += w
+			self.changed.add(aid)
+
+	def add(self,pairs,artists):
+		"""
+			record a submission: add 1 to the weight of every (aid1,aid2) pair and remember
+			the display names of previously unknown artists
+		"""
+		with self._lock:
+			for aid,display in artists:
+				if aid not in self.display:
+					self.display[aid] = display
+					self._artists[aid] = display
+			for aid1,aid2 in pairs:
+				self._add_link(aid1,aid2,1)
+				self._links[(aid1,aid2)] += 1
+
+	def top_linked(self,aids,n=5):
+		""" (display,weight) of the n artists with the strongest links to aids, aids themselves excluded """
+		with self._lock:
+			scores = collections.defaultdict(float)
+			for aid in aids:
+				for other,w in self.adj.get(aid,{}).iteritems():
+					scores[other] += w
+			for aid in aids:
+				scores.pop(aid,None)
+			top = sorted(scores.iteritems(),key=lambda x:(-x[1],x[0]))
+			return [(self.display[aid],s) for aid,s in top if aid in self.display][:n]
+
+	def top_overall(self,exclude=(),n=5):
+		""" (display,weight) of the n artists with the most link weight overall """
+		with self._lock:
+			# strengths only grow, so the ranking still orders the artists that did not change
+			candidates = [(-self.strength[aid],aid) for aid in self.changed]
+			found = 0
+			for s,aid in self.ranking:
+				if found >= n:
+					break
+				if aid in self.changed or aid in exclude or aid not in self.display:
+					continue
+				candidates.append((s,aid))
+				found += 1
+			top = sorted((s,aid) for s,aid in candidates if aid not in exclude and aid in self.display)[:n]
+			return [(self.display[aid],-s) for s,aid in top]
+
+	def flush(self):
+		""" write pending submissions to sqlite in one transaction """
+		with self._io_lock:
+			with self._lock:
+				links = self._links
+				artists = self._artists
+				self._links = collections.defaultdict(float)
+				self._artists = {}
+			if len(links) == 0 and len(artists) == 0:
+				return
+
+			try:
+				conn = self._connect()
+				try:
+					conn.executemany('insert or ignore into a2a values (?, ?, 0);',list(links.keys()))
+					conn.executemany('update a2a set w = w + ? where aid1 = ? and aid2 = ?;',[(w,a1,a2) for (a1,a2),w in links.items()])
+					conn.executemany('insert or ignore into a (aid, display) values (?, ?);',artists.items())
+					conn.commit()
+				finally:
+					conn.close()
+			except sqlite3.Error:
+				# put them back so the next flush retries
+				with self._lock:
+					for k,w in links.items():
+						self._links[k] += w
+					for aid,display in artists.items():
+						self._artists.setdefault(aid,display)
+				raise
+
+	def refresh(self):
+		""" the background thread flushes every flush_interval and reloads every reload_interval """
+		if self.loaded_at is None or time.time()-self.loaded_at > self.reload_interval:
+			self.load()
+		else:
+			self.flush()
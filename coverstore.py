@@ -0,0 +1,108 @@
+"""
+Album cover store
+
+Cover urls are kept in a local sqlite file (covers.db next to reco.db by
+default), so they survive restarts and are shared by every worker on the box.
+Each entry records when it was fetched; entries older than max_age (or
+empty_max_age for artists Discogs had nothing for) are stale and get refreshed.
+
+CoverPrefetcher warms the store in a background thread for artists that are
+about to be shown, so page thumbnails do not wait on Discogs.
+"""
+
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+from caching import LocalSqlite
+
+class CoverStore(object):
+
+	def __init__(self,path,max_age=7*24*3600,empty_max_age=24*3600):
+		self.max_age = max_age
+		self.empty_max_age = empty_max_age
+		self._conn = LocalSqlite(path,'create table if not exists covers (artist text primary key, urls text not null, fetched_at real not null);')
+
+	def get_many(self,artists,chunk=500):
+		""" artist -> (urls,fresh) for the artists that are stored """
+		artists = list(set(artists))
+		now = time.time()
+		found = {}
+		conn = self._conn()
+		for a in xrange(0,len(artists),chunk):
+			part = artists[a:a+chunk]
+			cur = conn.execute('select artist, urls, fetched_at from covers where artist in ('+','.join('?'*len(part))+');',part)
+			for artist,urls,fetched_at in cur.fetchall():
+				urls = json.loads(urls)
+				max_age = self.max_age if len(urls) > 0 else self.empty_max_age
+				found[artist] = (urls,now-fetched_at < max_age)
+		return found
+
+	def put_many(self,covers):
+		""" store artist -> urls """
+		now = time.time()
+		conn = self._conn()
+		conn.executemany('insert or replace into covers values (?, ?, ?);',[(a,json.dumps(urls),now) for a,urls in covers.items()])
+		conn.commit()
+
+class CoverPrefetcher(object):
+	"""
+		fetches covers for queued artists in the background
+
+		fetch(names) fetches and stores the covers of names; the queue is bounded
+		and artists that are already fresh in the store are skipped
+	"""
+
+	def __init__(self,store,fetch,batch=16,maxsize=2000):
+		self.store = store
+		self.fetch = fetch
+		self.batch = batch
+		self._queue = Queue.Queue(maxsize)
+		self._pending = set()
+		self._lock = threading.Lock()
+		self._thread_pid = None
+
+	def enqueue(self,artists):
+		""" ask for covers of these artists to be stored soon; never blocks """
+		self._start()
+		with self._lock:
+			for a in artists:
+				if a is None or a in self._pending:
+					continue
+				try:
+					self._queue.put_nowait(a)
+				except Queue.Full:
+					break
+				self._pending.add(a)
+
+	def _start(self):
+		if self._thread_pid == os.getpid():
+			return
+		self._thread_pid = os.getpid()
+		t = threading.Thread(target=self._run,name='cover-prefetcher')
+		t.daemon = True
+		t.start()
+
+	def _run(self):
+		while True:
+			artists = [self._queue.get()]
+			while len(artists) < self.batch:
+				try:
+					artists.append(self._queue.get_nowait())
+				except Queue.Empty:
+					break
+			try:
+				self.prefetch(artists)
+			except Exception:
+				print "Cover prefetch failed:", sys.exc_info()[1]
+			finally:
+				with self._lock:
+					self._pending.difference_update(artists)
+
+	def prefetch(self,artists):
+		stored = self.store.get_many(artists)
+		todo = [a for a in artists if not (a in stored and stored[a][1])]
+		if len(todo) > 0:
+			self.fetch(todo)
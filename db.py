@@ -0,0 +1,119 @@
+"""
+MySQL connection pooling and query helpers
+
+Every worker keeps a bounded pool of connections per database instead of
+connecting (and running SET NAMES) on every request. Connections that sat idle
+for a while are pinged before they are handed out again, and broken ones are
+replaced. All statements go through fetchall/fetchone with %s placeholders, so
+values are escaped by the driver rather than concatenated into the SQL, and
+each is timed under the 'db' stage with a short label naming the query.
+"""
+
+import contextlib
+import os
+import re
+import threading
+import time
+import metrics
+
+class PoolTimeout(Exception):
+	""" raised when no connection became free within the pool's timeout """
+	pass
+
+class ConnectionPool(object):
+
+	def __init__(self,connect,max_size=10,timeout=5,check_after=30):
+		self.connect = connect
+		self.max_size = max_size
+		self.timeout = timeout
+		self.check_after = check_after # seconds idle after which a connection is pinged before reuse
+		self._idle = [] # (connection,last used)
+		self._size = 0
+		self._pid = os.getpid()
+		self._cond = threading.Condition(threading.Lock())
+
+	def _check_pid(self):
+		""" connections inherited from the gunicorn master must not be shared with it; the caller holds the lock """
+		if self._pid != os.getpid():
+			self._idle = []
+			self._size = 0
+			self._pid = os.getpid()
+
+	def acquire(self):
+		deadline = time.time()+self.timeout
+		with self._cond:
+			self._check_pid()
+			while len(self._idle) == 0 and self._size >= self.max_size:
+				remaining = deadline-time.time()
+				if remaining <= 0:
+					raise PoolTimeout('no free connection after %ss (max_size=%d)' % (self.timeout,self.max_size))
+				self._cond.wait(remaining)
+			if len(self._idle) > 0:
+				[conn,last_used] = self._idle.pop()
+			else:
+				[conn,last_used] = [None,None]
+				self._size += 1
+
+		try:
+			if conn is not None and time.time()-last_used > self.check_after:
+				try:
+					conn.ping()
+				except Exception:
+					self._close(conn)
+					conn = None
+			if conn is None:
+				conn = self.connect()
+		except Exception:
+			with self._cond:
+				self._size -= 1
+				self._cond.notify()
+			raise
+		return conn
+
+	def release(self,conn,discard=False):
+		""" return a connection to the pool; discard it if it may be broken """
+		with self._cond:
+			if self._pid != os.getpid():
+				return
+			if discard:
+				self._size -= 1
+			else:
+				self._idle.append((conn,time.time()))
+			self._cond.notify()
+		if discard:
+			self._close(conn)
+
+	def _close(self,conn):
+		try:
+			conn.close()
+		except Exception:
+			pass
+
+	@contextlib.contextmanager
+	def connection(self):
+		conn = self.acquire()
+		try:
+			yield conn
+		except Exception:
+			self.release(conn,discard=True)
+			raise
+		self.release(conn)
+
+def query_label(q):
+	""" 'select Artists' for a select from Artists, when the caller names no label """
+	m = re.search(r'\bfrom\s+`?(\w+)',q,re.I)
+	return q.split(None,1)[0].lower()+(' '+m.group(1) if m else '')
+
+def fetchall(db,q,args=(),label=None):
+	""" run a parameterized statement and return all rows """
+	with metrics.timer('db',label or query_label(q)):
+		cur = db.cursor()
+		cur.execute(q,args)
+		return cur.fetchall()
+
+def fetchone(db,q,args=(),label=None):
+	""" run a parameterized statement and return the first row, or None """
+	with metrics.timer('db',label or query_label(q)):
+		cur = db.cursor()
+		cur.execute(q,args)
+		return cur.fetchone()
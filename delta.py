@@ -0,0 +1,219 @@
+"""
+Incremental updates to the recommender
+
+Artists added or re-embedded after the model was built are written as raw
+embedding vectors to the embedding_delta table of a small sqlite file
+(see add_artists.py). Every worker polls the table and hands new rows to
+ArtistRecommender.update_artists / remove_artists, which keep them in a delta
+buffer next to the main index:
+
+	- delta rows are normalized with the parameters of the main index and
+	  numbered after its rows, len(U), len(U)+1, ...
+	- a main row whose artist was updated or removed is hidden, and so is a
+	  delta row that was superseded; rows are never renumbered
+	- queries scan the delta by brute force and merge it with the backend's
+	  results by distance
+
+Once the delta buffer holds compact_rows rows, or hides that many, the feed
+folds it into a new main index in memory. Workers that map an artifact leave
+that to build_model.py --delta instead, run out of band (e.g. from cron): it
+builds a new version with the table folded in and records the last seq it
+holds, the model watcher swaps it in, and the feed replays only newer rows.
+"""
+
+import collections
+import sqlite3
+import threading
+import numpy as np
+from background import Refreshing
+
+class DeltaIndex(object):
+	""" one immutable generation of the delta buffer of a recommender with n_main rows """
+
+	def __init__(self,n_main,ids,U,hidden,rows):
+		self.n_main = n_main
+		self.ids = ids # artist id per delta row
+		self.U = U # normalized vectors, float64
+		self.hidden = hidden # sorted rows (main or delta) that queries must skip
+		self.rows = rows # artist id -> its current delta row
+
+	@classmethod
+	def empty(cls,n_main,dims,id_dtype):
+		return cls(n_main,np.zeros(0,dtype=id_dtype),np.zeros((0,dims)),np.zeros(0,dtype=np.int64),{})
+
+	def __len__(self):
+		return len(self.ids)
+
+	@property
+	def changes(self):
+		""" delta rows plus hidden rows; 0 when this generation changes nothing about the main index """
+		return len(self.ids)+len(self.hidden)
+
+	@property
+	def hidden_main(self):
+		""" number of hidden rows that belong to the main index """
+		return int(np.searchsorted(self.hidden,self.n_main))
+
+	@property
+	def live(self):
+		""" number of delta rows that are not hidden """
+		return len(self.rows)
+
+	def changed(self,keys,U,main_rows):
+		"""
+			a new generation where the artists keys (already coerced to the id dtype) are
+			replaced by the rows of U, or removed when U is None; main_rows are their rows
+			in the main index, -1 where they have none
+		"""
+		hide = [main_rows[main_rows >= 0]]
+		hide.append(np.array([self.n_main+self.rows[k] for k in keys if k in self.rows],dtype=np.int64))
+
+		rows = dict(self.rows)
+		ids = self.ids
+		delta_U = self.U
+		if U is None:
+			for k in keys:
+				rows.pop(k,None)
+		else:
+			# the last vector of an id given twice wins
+			last = dict((k,j) for j,k in enumerate(keys))
+			order = sorted(last.values())
+			for j,inx in enumerate(order):
+				rows[keys[inx]] = len(self.ids)+j
+			ids = np.concatenate([self.ids,np.array([keys[inx] for inx in order])])
+			delta_U = np.vstack([self.U,np.asarray(U,dtype=np.float64)[order]])
+
+		hidden = np.union1d(self.hidden,np.concatenate(hide)).astype(np.int64)
+		return DeltaIndex(self.n_main,ids,delta_U,hidden,rows)
+
+	def is_hidden(self,rows):
+		""" boolean mask of rows (any shape) that queries must skip """
+		rows = np.asarray(rows)
+		if len(self.hidden) == 0:
+			return np.zeros(rows.shape,dtype=bool)
+		# hidden is sorted, so a binary search beats np.in1d's sort of both arrays
+		j = np.minimum(np.searchsorted(self.hidden,rows),len(self.hidden)-1)
+		return self.hidden[j] == rows
+
+	def distances(self,points):
+		""" (len(points),len(self)) euclidean distances to the delta rows, hidden ones inf """
+		points = np.atleast_2d(np.asarray(points,dtype=np.float64))
+		d2 = (points**2).sum(1)[:,None] - 2*np.dot(points,self.U.T) + (self.U**2).sum(1)[None,:]
+		dist = np.sqrt(np.maximum(d2,0))
+		dist[:,self.is_hidden(self.n_main+np.arange(len(self)))] = np.inf
+		return dist
+
+SCHEMA = '''create table if not exists embedding_delta (
+seq integer primary key autoincrement,
+artistId text not null,
+removed integer not null default 0,
+vector blob
+);'''
+
+def connect(path):
+	conn = sqlite3.connect(path,timeout=5)
+	conn.execute('pragma journal_mode=wal;')
+	conn.execute(SCHEMA)
+	return conn
+
+def append_delta(path,artist_ids,vectors=None):
+	""" queue raw embedding vectors for artist_ids, or their removal when vectors is None """
+	conn = connect(path)
+	try:
+		if vectors is None:
+			conn.executemany('insert into embedding_delta (artistId, removed) values (?, 1);',[(str(a),) for a in artist_ids])
+		else:
+			vectors = np.asarray(vectors,dtype=np.float64)
+			conn.executemany('insert into embedding_delta (artistId, vector) values (?, ?);',[(str(a),buffer(v.tostring())) for a,v in zip(artist_ids,vectors)])
+		conn.commit()
+	finally:
+		conn.close()
+
+def read_delta(path,after=0):
+	""" (seq,artistId,removed,vector) rows of the table with seq > after, in order """
+	conn = connect(path)
+	try:
+		return conn.execute('select seq, artistId, removed, vector from embedding_delta where seq > ? order by seq;',(after,)).fetchall()
+	finally:
+		conn.close()
+
+def count_delta(path,after=0):
+	""" number of rows of the table with seq > after """
+	conn = connect(path)
+	try:
+		return conn.execute('select count(*) from embedding_delta where seq > ?;',(after,)).fetchone()[0]
+	finally:
+		conn.close()
+
+def fold_delta(U,artist_ids,rows):
+	"""
+		raw U and its artist ids with delta rows applied, for building a new model:
+		updated artists are dropped from U and appended with their last vector, removed
+		ones are dropped; returns [U,ids as strings,last seq]
+	"""
+	last = collections.OrderedDict() # artist id -> raw vector or None, in order of last change
+	for seq,aid,removed,vector in rows:
+		last.pop(aid,None)
+		last[aid] = None if removed else np.frombuffer(vector,dtype=np.float64)
+
+	ids = np.array([str(a) for a in artist_ids])
+	keep = ~np.in1d(ids,np.array(last.keys(),dtype=ids.dtype)) if len(last) else np.ones(len(ids),dtype=bool)
+	added = [(a,v) for a,v in last.items() if v is not None]
+
+	U = np.vstack([np.asarray(U)[keep],np.array([v for a,v in added]).reshape(len(added),U.shape[1])])
+	ids = np.concatenate([ids[keep],np.array([str(a) for a,v in added])]) if len(added) else ids[keep]
+	return [U,ids,rows[-1][0] if len(rows) else 0]
+
+class DeltaFeed(Refreshing):
+	"""
+		applies new embedding_delta rows to the live recommender every refresh_interval
+		seconds and compacts it once its delta buffer holds compact_rows rows (0 never
+		compacts, leaving it to a rebuilt artifact)
+
+		get_recommender/set_recommender read and replace the live recommender; a
+		recommender the feed has not seen before (a fresh process, a new model) gets
+		the rows after its delta_seq (0 unless its artifact recorded one) replayed onto it
+	"""
+
+	def __init__(self,path,get_recommender,set_recommender,refresh_interval=30,compact_rows=10000):
+		self.path = path
+		self.get_recommender = get_recommender
+		self.set_recommender = set_recommender
+		self.refresh_interval = refresh_interval
+		self.compact_rows = compact_rows
+		self.seq = 0
+		self._applied_to = None
+		self._lock = threading.Lock()
+
+	def refresh(self):
+		with self._lock:
+			rec = self.get_recommender()
+			if rec is not self._applied_to:
+				self.seq = getattr(rec,'delta_seq',0)
+
+			rows = read_delta(self.path,self.seq)
+
+			# consecutive updates (or removals) are applied together
+			start = 0
+			for j in xrange(1,len(rows)+1):
+				if j == len(rows) or rows[j][2] != rows[start][2]:
+					batch = rows[start:j]
+					ids = [r[1] for r in batch]
+					if batch[0][2]:
+						rec.remove_artists(ids)
+					else:
+						rec.update_artists(ids,np.vstack([np.frombuffer(r[3],dtype=np.float64) for r in batch]))
+					start = j
+
+			if len(rows):
+				self.seq = rows[-1][0]
+			rec.delta_seq = self.seq
+			self._applied_to = rec
+			self.loaded = True
+
+			# hidden rows count too: every query asks the backend for extra neighbours to skip them
+			if self.compact_rows and rec.delta.changes >= self.compact_rows:
+				new = rec.compacted('%s+%d' % (rec.version.split('+')[0],self.seq))
+				new.delta_seq = self.seq
+				self.set_recommender(new)
+				self._applied_to = new
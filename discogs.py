@@ -0,0 +1,144 @@
+"""
+Discogs API client
+
+One pooled requests.Session per worker and a bounded thread pool, so the album
+covers for many artists (and their alias fallbacks) are fetched concurrently
+over reused connections. Rate limiting (HTTP 429) and server errors are retried
+with exponential backoff, and a 429 pauses every thread of the worker until
+the Retry-After time has passed.
+
+Note: Discogs does not cooperate unless you pass an arbitrary user-agent!
+"""
+
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from caching import MISSING
+import metrics
+
+SEARCH_URL = 'https://api.discogs.com/database/search'
+
+responses = metrics.registry.counter('reco_discogs_responses_total','Discogs API responses by HTTP status (error: no response)',('status',))
+
+class DiscogsClient(object):
+
+	def __init__(self,key,secret,user_agent,cache=None,pool_size=8,max_retries=3,backoff=1.0,timeout=10):
+		self.key = key
+		self.secret = secret
+		self.user_agent = user_agent
+		self.cache = cache
+		self.pool_size = pool_size
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self._pid = None
+		self._lock = threading.Lock()
+		self._resume_at = 0
+
+	def _ensure_pool(self):
+		""" the session and threads are created per process, never inherited from the gunicorn master """
+		if self._pid != os.getpid():
+			with self._lock:
+				if self._pid != os.getpid():
+					session = requests.Session()
+					session.mount('https://',HTTPAdapter(pool_connections=1,pool_maxsize=self.pool_size))
+					session.headers['user-agent'] = self.user_agent
+					self.session = session
+					self.pool = ThreadPool(self.pool_size)
+					self._pid = os.getpid()
+
+	def _get(self,url,params):
+		""" GET with retries; the parsed JSON payload, or None """
+		self._ensure_pool()
+		for attempt in xrange(self.max_retries+1):
+			pause = self._resume_at-time.time()
+			if pause > 0:
+				time.sleep(pause)
+
+			try:
+				with metrics.timer('discogs','search'):
+					r = self.session.get(url,params=params,timeout=self.timeout)
+			except requests.RequestException:
+				print "Discogs request failed:", sys.exc_info()[1]
+				r = None
+			responses.inc(1,str(r.status_code) if r is not None else 'error')
+
+			if r is not None and r.status_code == 200:
+				try:
+					return r.json()
+				except ValueError:
+					# e.g. an HTML error page from a proxy; a bad answer for this artist only
+					print "Discogs returned a response that is not JSON:", sys.exc_info()[1]
+					return None
+			if r is not None and r.status_code not in (429,500,502,503,504):
+				return None
+
+			delay = self.backoff*(2**attempt)
+			if r is not None and r.status_code == 429:
+				try:
+					delay = max(delay,float(r.headers.get('retry-after',0)))
+				except ValueError:
+					pass
+				self._resume_at = max(self._resume_at,time.time()+delay)
+			if attempt < self.max_retries:
+				time.sleep(delay)
+		return None
+
+	def search_artist(self,name):
+		""" the Discogs search results for an artist, cached by name """
+		if self.cache is not None:
+			payload = self.cache.get('discogs',name)
+			if payload is not MISSING:
+				return payload
+
+		payload = self._get(SEARCH_URL,{'artist':name,'key':self.key,'secret':self.secret})
+
+		if payload is not None and self.cache is not None:
+			self.cache.set('discogs',name,payload)
+		return payload
+
+	def covers(self,name,N=3):
+		""" the first N album cover thumbnails in the search results for an artist """
+		d = self.search_artist(name)
+		try:
+			return [i['thumb'] for i in d['results'] if i.get('thumb','') != ''][:int(N)]
+		except (TypeError,KeyError):
+			return []
+
+	def map(self,fn,items):
+		""" fn over items on the thread pool """
+		self._ensure_pool()
+		return self.pool.map(fn,items) if len(items) > 1 else [fn(i) for i in items]
+
+	def covers_for_artists(self,names,N=3,aliases_for=None):
+		"""
+			album covers for many artists at once
+
+			artists without results are retried under their aliases, all probed in
+			parallel; the first alias (in the order aliases_for lists them) with covers wins.
+			aliases_for is called on the calling thread, so it may use the request's db connection
+		"""
+		names = list(names)
+		results = self.map(lambda a: self.covers(a,N),names)
+
+		if aliases_for is None:
+			return results
+
+		aliases = {}
+		for a,r in zip(names,results):
+			if len(r) < 1 and a not in aliases:
+				aliases[a] = aliases_for(a)
+
+		probes = sorted(set(al for als in aliases.values() for al in als))
+		found = dict(zip(probes,self.map(lambda al: self.covers(al,N),probes)))
+
+		for j,a in enumerate(names):
+			for al in aliases.get(a,[]):
+				if len(found[al]) > 0:
+					results[j] = found[al]
+					break
+		return results
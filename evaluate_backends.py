@@ -0,0 +1,98 @@
+"""
+Recall/latency comparison of the nearest-neighbour backends on our own U
+
+    python evaluate_backends.py ivf:nprobe=4 ivf:nprobe=16 ivf:nlist=4096,nprobe=32
+
+Each backend spec is name[:param=value,...]. Queries are a sample of artist rows
+(what recommend asks) and uniform points in [0,1]^d (what searchnear asks);
+recall@k is measured against the exact cKDTree results.
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+from backends import ExactBackend, make_backend
+from recommender import ArtistRecommender
+
+def parse_spec(spec):
+	""" 'ivf:nlist=1024,nprobe=8' -> ('ivf',{'nlist':1024,'nprobe':8}) """
+	name,_,params = spec.partition(':')
+	kwargs = {}
+	for p in filter(None,params.split(',')):
+		key,_,value = p.partition('=')
+		kwargs[key] = json.loads(value)
+	return name,kwargs
+
+def recall(truth,found):
+	""" mean fraction of the true neighbours that were found, per query """
+	return np.mean([len(np.intersect1d(t,f))/float(len(t)) for t,f in zip(truth,found)])
+
+def latency(backend,queries,k):
+	""" per-query latencies in milliseconds, one point at a time like the web views """
+	times = []
+	for q in queries:
+		t = time.time()
+		backend.query(q,k)
+		times.append((time.time()-t)*1000)
+	return times
+
+def evaluate(U,specs,k,n_queries,seed=0):
+	rng = np.random.RandomState(seed)
+	queries = {
+		'rows':np.asarray(U[rng.choice(U.shape[0],n_queries,replace=False),:]),
+		'points':rng.rand(n_queries,U.shape[1])
+	}
+
+	exact = ExactBackend(U)
+	truth = dict((kind,exact.query(q,k)[1]) for kind,q in queries.items())
+
+	results = []
+	for spec in ['exact']+specs:
+		name,params = parse_spec(spec)
+		t = time.time()
+		backend = exact if spec == 'exact' else make_backend(name,U,**params)
+		build = time.time()-t
+
+		for kind,q in queries.items():
+			times = latency(backend,q,k)
+			t = time.time()
+			[dist,inxes] = backend.query(q,k)
+			batch = time.time()-t
+			results.append({
+				'backend':spec,
+				'queries':kind,
+				'k':k,
+				'build_s':round(build,3),
+				'recall':round(recall(truth[kind],inxes),4),
+				'p50_ms':round(np.percentile(times,50),3),
+				'p95_ms':round(np.percentile(times,95),3),
+				'p99_ms':round(np.percentile(times,99),3),
+				'batch_qps':round(len(q)/batch,1)
+			})
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='compare nearest-neighbour backends against exact search')
+	parser.add_argument('specs',nargs='*',default=['ivf'])
+	parser.add_argument('-k',type=int,default=20)
+	parser.add_argument('--queries',type=int,default=1000)
+	parser.add_argument('--json',action='store_true',help='print one JSON object per result instead of a table')
+	args = parser.parse_args()
+
+	U = ArtistRecommender().U
+
+	results = evaluate(U,args.specs,args.k,min(args.queries,U.shape[0]))
+
+	if args.json:
+		for r in results:
+			print json.dumps(r)
+		return
+
+	columns = ['backend','queries','recall','p50_ms','p95_ms','p99_ms','batch_qps','build_s']
+	print '\t'.join(columns)
+	for r in results:
+		print '\t'.join(str(r[c]) for c in columns)
+
+if __name__ == "__main__":
+	main()
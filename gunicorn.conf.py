@@ -0,0 +1,56 @@
+"""
+Gunicorn settings
+
+    gunicorn -c gunicorn.conf.py application
+
+The app is imported once in the master (preload_app) and the artist recommender
+is built there before the workers are forked, so all workers share its arrays
+copy-on-write instead of each loading their own. The same goes for the first
+generation of the in-memory artist catalog and search index. The master starts
+no background threads; each worker starts its own after the fork.
+
+Workers write their metrics to METRICS_SHARED_PATH (a temporary directory
+unless config.py names one), so that /metrics adds up all of them.
+"""
+
+import shutil
+import tempfile
+
+bind = '0.0.0.0:8000'
+workers = 4
+preload_app = True
+
+_metrics_tmp = None
+
+def when_ready(server):
+	global _metrics_tmp
+	from reco import get_recommender, catalog, search_index, delta_feed
+	import config
+	import metrics
+	if not config.METRICS_SHARED_PATH:
+		config.METRICS_SHARED_PATH = _metrics_tmp = tempfile.mkdtemp(prefix='reco-metrics-')
+	metrics.clear_shared(config.METRICS_SHARED_PATH)
+
+	rec = get_recommender()
+	server.log.info("artist recommender %s loaded in %.1fs" % (rec.version,rec.load_seconds))
+
+	# artists queued since the model was built are applied once here rather than in every worker
+	if config.DELTA_PATH:
+		delta_feed.refresh()
+
+	# the first catalog generation and search index are loaded here too, so workers start with them shared
+	catalog.refresh()
+	search_index.refresh()
+
+	# the timings of the loads above; workers start from zero (post_fork) so they are counted once
+	metrics.registry.flush(config.METRICS_SHARED_PATH,collectors=False)
+
+def post_fork(server,worker):
+	from reco import start_model_threads
+	import metrics
+	metrics.registry.reset()
+	start_model_threads()
+
+def on_exit(server):
+	if _metrics_tmp:
+		shutil.rmtree(_metrics_tmp,ignore_errors=True)
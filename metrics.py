@@ -0,0 +1,328 @@
+"""
+Stage timers and histograms, exposed in the Prometheus text format
+
+Code that does something worth watching wraps it in timer(stage,label), e.g.
+timer('db','songs') around a query or timer('render','artist_page.html') around
+a template. Every timing goes into the histogram of its stage and label. While
+a request is being served (between begin_request and end_request on the same
+thread), its timings are also summed per stage, so that a slow request can be
+logged with a breakdown of where its time went.
+
+Every worker keeps its own figures. Given a directory shared by the workers,
+each one also writes them there (flush), and /metrics adds up the histograms
+and counters of all of them (render_shared), dead workers included so that
+totals never go backwards. Figures kept elsewhere (collectors) describe a
+single worker, so they are reported per live worker with its pid as a label.
+"""
+
+import collections
+import contextlib
+import cPickle as pickle
+import errno
+import functools
+import glob
+import math
+import os
+import threading
+import time
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+def _escape(value):
+	return unicode(value).replace('\\','\\\\').replace('\n','\\n').replace('"','\\"')
+
+def _labels(pairs):
+	if len(pairs) == 0:
+		return ''
+	return '{'+','.join('%s="%s"' % (k,_escape(v)) for k,v in pairs)+'}'
+
+def _number(x):
+	if math.isinf(x):
+		return '+Inf' if x > 0 else '-Inf'
+	return repr(float(x))
+
+class Histogram(object):
+	""" cumulative bucket counts, sum and count of observations per combination of label values """
+
+	def __init__(self,name,help,labelnames=(),buckets=BUCKETS):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(sorted(buckets))
+		self._series = {} # label values -> [bucket counts,sum,count]
+		self._lock = threading.Lock()
+
+	def observe(self,value,*labels):
+		with self._lock:
+			series = self._series.get(labels)
+			if series is None:
+				series = self._series[labels] = [[0]*len(self.buckets),0.0,0]
+			for j,le in enumerate(self.buckets):
+				if value <= le:
+					series[0][j] += 1
+			series[1] += value
+			series[2] += 1
+
+	def snapshot(self):
+		""" {label values:[bucket counts,sum,count]}, a copy """
+		with self._lock:
+			return dict((k,[list(v[0]),v[1],v[2]]) for k,v in self._series.items())
+
+	@staticmethod
+	def merge(snapshots):
+		""" the sum of several snapshots """
+		total = {}
+		for s in snapshots:
+			for labels,(counts,sum_,n) in s.items():
+				t = total.get(labels)
+				if t is None:
+					total[labels] = [list(counts),sum_,n]
+				else:
+					t[0] = [a+b for a,b in zip(t[0],counts)]
+					t[1] += sum_
+					t[2] += n
+		return total
+
+	def reset(self):
+		with self._lock:
+			self._series = {}
+
+	def samples(self,extra=(),series=None):
+		if series is None:
+			series = self.snapshot()
+		for labels,(counts,total,n) in sorted(series.items()):
+			pairs = list(extra)+zip(self.labelnames,labels)
+			for le,c in zip(self.buckets,counts):
+				yield '%s_bucket%s %d' % (self.name,_labels(pairs+[('le',_number(le))]),c)
+			yield '%s_bucket%s %d' % (self.name,_labels(pairs+[('le','+Inf')]),n)
+			yield '%s_sum%s %s' % (self.name,_labels(pairs),_number(total))
+			yield '%s_count%s %d' % (self.name,_labels(pairs),n)
+
+	def render(self,extra=(),series=None):
+		return ['# HELP %s %s' % (self.name,self.help),'# TYPE %s histogram' % self.name]+list(self.samples(extra,series))
+
+class Counter(object):
+	""" a monotonically increasing count per combination of label values """
+
+	def __init__(self,name,help,labelnames=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._values = collections.defaultdict(float)
+		self._lock = threading.Lock()
+
+	def inc(self,n=1,*labels):
+		with self._lock:
+			self._values[labels] += n
+
+	def snapshot(self):
+		""" {label values:count}, a copy """
+		with self._lock:
+			return dict(self._values)
+
+	@staticmethod
+	def merge(snapshots):
+		""" the sum of several snapshots """
+		total = collections.defaultdict(float)
+		for s in snapshots:
+			for labels,v in s.items():
+				total[labels] += v
+		return total
+
+	def reset(self):
+		with self._lock:
+			self._values = collections.defaultdict(float)
+
+	def render(self,extra=(),series=None):
+		if series is None:
+			series = self.snapshot()
+		values = sorted(series.items())
+		lines = ['# HELP %s %s' % (self.name,self.help),'# TYPE %s counter' % self.name]
+		for labels,v in values:
+			lines.append('%s%s %s' % (self.name,_labels(list(extra)+zip(self.labelnames,labels)),_number(v)))
+		return lines
+
+class Registry(object):
+	"""
+		the metrics of this process; collectors are functions called at render time
+		that return (name,type,help,[(label pairs,value)]) for figures kept elsewhere,
+		such as the hit counters of a cache
+	"""
+
+	def __init__(self):
+		self.metrics = []
+		self.collectors = []
+		self._flushed_at = 0
+
+	def histogram(self,name,help,labelnames=(),buckets=BUCKETS):
+		h = Histogram(name,help,labelnames,buckets)
+		self.metrics.append(h)
+		return h
+
+	def counter(self,name,help,labelnames=()):
+		c = Counter(name,help,labelnames)
+		self.metrics.append(c)
+		return c
+
+	def collector(self,fn):
+		""" register fn as a collector; usable as a decorator """
+		self.collectors.append(fn)
+		return fn
+
+	def collect(self):
+		""" the output of every collector, [(name,type,help,samples)] """
+		out = []
+		for fn in self.collectors:
+			try:
+				out.extend(fn())
+			except Exception as e:
+				print "Metrics collector %s failed:" % fn.__name__, e
+		return out
+
+	def reset(self):
+		""" forget every figure, e.g. in a worker just forked from a master that recorded some """
+		for m in self.metrics:
+			m.reset()
+		self._flushed_at = 0
+
+	def flush(self,path,every=0,collectors=True):
+		"""
+			write this process's figures to path/<pid>.pkl, unless the last flush was less
+			than every seconds ago; collectors=False leaves out the per-worker figures
+		"""
+		now = time.time()
+		if now-self._flushed_at < every:
+			return
+		self._flushed_at = now
+		state = {
+			'pid':os.getpid(),
+			'metrics':dict((m.name,m.snapshot()) for m in self.metrics),
+			'collected':self.collect() if collectors else []
+		}
+		target = os.path.join(path,'%d.pkl' % os.getpid())
+		try:
+			with open(target+'.tmp','wb') as f:
+				pickle.dump(state,f,pickle.HIGHEST_PROTOCOL)
+			os.rename(target+'.tmp',target)
+		except (IOError,OSError) as e:
+			print "Could not write metrics to %s:" % target, e
+
+	def render(self):
+		""" this process's figures in the Prometheus text exposition format """
+		extra = [('pid',os.getpid())]
+		lines = []
+		for m in self.metrics:
+			lines.extend(m.render(extra))
+		lines.extend(_render_collected([(os.getpid(),self.collect())]))
+		return '\n'.join(lines)+'\n'
+
+	def render_shared(self,path):
+		""" the figures every process flushed to path, added up, in the Prometheus text exposition format """
+		self.flush(path)
+		states = []
+		for name in glob.glob(os.path.join(path,'*.pkl')):
+			try:
+				with open(name,'rb') as f:
+					states.append(pickle.load(f))
+			except (IOError,EOFError,pickle.UnpicklingError) as e:
+				print "Could not read metrics from %s:" % name, e
+
+		lines = []
+		for m in self.metrics:
+			lines.extend(m.render(series=m.merge([s['metrics'].get(m.name,{}) for s in states])))
+		lines.extend(_render_collected(sorted((s['pid'],s['collected']) for s in states if _alive(s['pid']))))
+		return '\n'.join(lines)+'\n'
+
+def _alive(pid):
+	try:
+		os.kill(pid,0)
+	except OSError as e:
+		return e.errno == errno.EPERM
+	return True
+
+def _render_collected(per_pid):
+	""" collector output of several processes, [(pid,[(name,type,help,samples)])], grouped by name """
+	groups = collections.OrderedDict()
+	for pid,collected in per_pid:
+		for name,kind,help,samples in collected:
+			if name not in groups:
+				groups[name] = ['# HELP %s %s' % (name,help),'# TYPE %s %s' % (name,kind)]
+			for pairs,v in samples:
+				groups[name].append('%s%s %s' % (name,_labels([('pid',pid)]+list(pairs)),_number(v)))
+	return [line for group in groups.values() for line in group]
+
+def clear_shared(path):
+	""" remove the figures flushed to path by earlier runs """
+	for name in glob.glob(os.path.join(path,'*.pkl'))+glob.glob(os.path.join(path,'*.pkl.tmp')):
+		try:
+			os.remove(name)
+		except OSError:
+			pass
+
+registry = Registry()
+
+stage_seconds = registry.histogram('reco_stage_seconds','Time spent in each stage (database query, recommender, Discogs, template, ...)',('stage','label'))
+
+request_seconds = registry.histogram('reco_request_seconds','Time to serve a request, by endpoint and status',('endpoint','method','status'))
+
+slow_requests = registry.counter('reco_slow_requests_total','Requests slower than SLOW_REQUEST_SECONDS, by endpoint',('endpoint',))
+
+_local = threading.local()
+
+def record(stage,label,seconds):
+	""" add a timing to the histogram and to the breakdown of the request on this thread """
+	stage_seconds.observe(seconds,stage,label)
+	breakdown = getattr(_local,'breakdown',None)
+	if breakdown is not None:
+		entry = breakdown[(stage,label)]
+		entry[0] += seconds
+		entry[1] += 1
+
+@contextlib.contextmanager
+def timer(stage,label=''):
+	""" time the block; a block nested in another of the same stage is part of the outer one and not recorded """
+	active = getattr(_local,'active',None)
+	if active is None:
+		active = _local.active = set()
+	if stage in active:
+		yield
+		return
+
+	active.add(stage)
+	started = time.time()
+	try:
+		yield
+	finally:
+		active.discard(stage)
+		record(stage,label,time.time()-started)
+
+def timed(stage,label=None):
+	""" decorator timing every call of a function; the label defaults to the function's name """
+	def decorate(fn):
+		name = label or fn.__name__
+		@functools.wraps(fn)
+		def wrapper(*args,**kwargs):
+			with timer(stage,name):
+				return fn(*args,**kwargs)
+		return wrapper
+	return decorate
+
+def begin_request():
+	""" start collecting the breakdown of the request served by this thread """
+	_local.breakdown = collections.defaultdict(lambda: [0.0,0])
+	_local.started = time.time()
+
+def end_request():
+	""" [elapsed seconds,{(stage,label):[seconds,calls]}] of this thread's request, or None outside one """
+	breakdown = getattr(_local,'breakdown',None)
+	if breakdown is None:
+		return None
+	elapsed = time.time()-_local.started
+	_local.breakdown = None
+	return [elapsed,dict(breakdown)]
+
+def format_breakdown(breakdown):
+	""" 'db songs 0.412s x1, render artist_page.html 0.020s x1, ...', slowest first """
+	parts = sorted(breakdown.items(),key=lambda x:-x[1][0])
+	return ', '.join('%s%s %.3fs x%d' % (stage,' '+label if label else '',s,n) for (stage,label),(s,n) in parts)
@@ -13,12 +13,22 @@ version 0.03
 import os, sys
 import json
 import sqlite3, MySQLdb
-from flask import Flask, render_template, g, request, flash, redirect, url_for
+from flask import Flask, Response, render_template as render_flask_template, g, request, flash, redirect, url_for, stream_with_context, has_app_context
 from forms import FavoritesForm,ArtistSearchForm
-import requests
 import config
 import numpy as np
-from recommender import ArtistRecommender
+from recommender import UnknownArtistError, RegionTooLargeError, grid_cells
+from caching import LRUCache, ResponseCache, SqliteCacheBackend, SingleFlight, MISSING
+from catalog import ArtistCatalog
+from discogs import DiscogsClient
+from db import ConnectionPool, fetchall, fetchone
+from snapshot import HomeSnapshot
+from cooccurrence import CooccurrenceGraph
+from delta import DeltaFeed
+from registry import ModelRegistry, ModelWatcher
+from coverstore import CoverStore, CoverPrefetcher
+from search import ArtistSearchIndex, normalize
+import metrics
 import json
 import itertools
 import random
@@ -43,7 +53,33 @@ app.config.update(dict(
 	MYSQL_PASSWORD=config.MYSQL_PASSWORD
 ))
 
-cache = {} # a place to store API responses so we can avoid asking the same question twice
+# a place to store API responses and search results so we can avoid asking the same question twice
+cache = ResponseCache(
+	max_bytes=config.CACHE_MAX_BYTES,
+	ttls=config.CACHE_TTLS,
+	shared=SqliteCacheBackend(config.CACHE_SHARED_PATH) if config.CACHE_SHARED_PATH else None
+)
+
+discogs = DiscogsClient(
+	config.DISCOGS_CONSUMER_KEY,
+	config.DISCOGS_CONSUMER_SECRET,
+	config.DISCOGS_APP_USER_AGENT,
+	cache=cache,
+	pool_size=config.DISCOGS_POOL_SIZE,
+	max_retries=config.DISCOGS_MAX_RETRIES
+)
+
+cover_store = CoverStore(config.COVER_STORE_PATH or os.path.join(app.root_path, 'covers.db'),max_age=config.COVER_MAX_AGE)
+
+cover_flight = SingleFlight() # cover lookups in flight in this worker
+
+cover_prefetcher = CoverPrefetcher(cover_store,lambda names: prefetch_album_cover_urls(names))
+
+artist_names = LRUCache(config.ARTIST_NAME_CACHE_SIZE) # artistId -> artistName
+
+searchnear_responses = LRUCache(config.SEARCHNEAR_CACHE_SIZE) # (model version,delta generation,grid cell) -> response body
+
+cover_lookups = metrics.registry.counter('reco_cover_store_lookups_total','Cover store lookups made while serving requests, by result',('result',))
 
 """
 SQLite
@@ -82,19 +118,22 @@ MYSQL
 def mysql_connect_db():
 	""" connect to the specific database """
 	c = MySQLdb.connect(host=app.config['MYSQL_HOST'],port=app.config['MYSQL_PORT'],db=app.config['MYSQL_DATABASE'],user=app.config['MYSQL_USER'],passwd=app.config['MYSQL_PASSWORD'],use_unicode=True,charset='utf8', init_command='SET NAMES UTF8')
+	c.autocommit(True) # pooled connections must not keep reading an old transaction snapshot
 	return c
 
+mysql_pool = ConnectionPool(mysql_connect_db,max_size=config.MYSQL_POOL_SIZE)
+
 def mysql_get_db():
-	"""	open a new database connection if there is none yet for the current application context """
+	"""	borrow a pooled database connection if there is none yet for the current application context """
 	if not hasattr(g, 'mysql_db'):
-		g.mysql_db = mysql_connect_db()
+		g.mysql_db = mysql_pool.acquire()
 	return g.mysql_db
 
 @app.teardown_appcontext
 def mysql_close_db(error):
-	""" close the database connection """
+	""" return the database connection to the pool """
 	if hasattr(g, 'mysql_db'):
-		g.mysql_db.close()
+		mysql_pool.release(g.mysql_db,discard=isinstance(error,MySQLdb.Error))
 
 """
 General recommendation database setting, use table SubTables
@@ -103,134 +142,272 @@ General recommendation database setting, use table SubTables
 def mysql_connect_subdb():
 	""" connect to the specific database """
 	c = MySQLdb.connect(host=app.config['MYSQL_HOST'],port=app.config['MYSQL_PORT'],db='SubTables',user=app.config['MYSQL_USER'],passwd=app.config['MYSQL_PASSWORD'],use_unicode=True,charset='utf8', init_command='SET NAMES UTF8')
+	c.autocommit(True)
 	return c
 
+mysql_subpool = ConnectionPool(mysql_connect_subdb,max_size=config.MYSQL_POOL_SIZE)
+
 def mysql_get_subdb():
-	"""	open a new database connection if there is none yet for the current application context """
+	"""	borrow a pooled database connection if there is none yet for the current application context """
 	if not hasattr(g, 'mysql_subdb'):
-		g.mysql_subdb = mysql_connect_subdb()
+		g.mysql_subdb = mysql_subpool.acquire()
 	return g.mysql_subdb
 
+@app.teardown_appcontext
+def mysql_close_subdb(error):
+	""" return the database connection to the pool """
+	if hasattr(g, 'mysql_subdb'):
+		mysql_subpool.release(g.mysql_subdb,discard=isinstance(error,MySQLdb.Error))
+
+"""
+Instrumentation
+"""
+
+@app.before_request
+def start_request_timer():
+	metrics.begin_request()
+
+@app.after_request
+def note_response_status(response):
+	g.response_status = response.status_code
+	return response
+
+@app.teardown_request
+def finish_request_timer(error):
+	"""
+	Record how long the request took, and log the per-stage breakdown of requests
+	slower than SLOW_REQUEST_SECONDS
+	"""
+	timing = metrics.end_request()
+	if timing is None:
+		return
+	[elapsed,breakdown] = timing
+	
+	endpoint = request.endpoint or 'unmatched'
+	status = 500 if error is not None else getattr(g,'response_status',200)
+	metrics.request_seconds.observe(elapsed,endpoint,request.method,str(status))
+	
+	if config.SLOW_REQUEST_SECONDS and elapsed>=config.SLOW_REQUEST_SECONDS:
+		metrics.slow_requests.inc(1,endpoint)
+		print "Slow request: %s %s -> %s in %.3fs: %s" % (request.method,request.full_path.rstrip('?'),status,elapsed,metrics.format_breakdown(breakdown) or 'no timed stages')
+
+	if config.METRICS_SHARED_PATH:
+		metrics.registry.flush(config.METRICS_SHARED_PATH,every=config.METRICS_FLUSH_SECONDS)
+
+@metrics.registry.collector
+def cache_metrics():
+	""" hit and miss counters of the response cache namespaces and the in-process LRUs """
+	stats = cache.stats()
+	lookups = []
+	entries = []
+	for ns,c in sorted(stats['namespaces'].items()):
+		name = 'response:'+ns
+		for result in ('hits','shared_hits','misses','expirations'):
+			lookups.append(([('cache',name),('result',result)],c.get(result,0)))
+		entries.append(([('cache',name)],c.get('entries',0)))
+	for name,lru in [('artist_names',artist_names),('searchnear',searchnear_responses)]:
+		lookups.append(([('cache',name),('result','hits')],lru.hits))
+		lookups.append(([('cache',name),('result','misses')],lru.misses))
+		entries.append(([('cache',name)],len(lru)))
+	return [
+		('reco_cache_lookups_total','counter','Cache lookups by cache and result',lookups),
+		('reco_cache_entries','gauge','Entries held by each cache',entries),
+		('reco_cache_bytes','gauge','Pickled size of the response cache',[([],stats['bytes'])])
+	]
+
+@metrics.registry.collector
+def model_metrics():
+	""" the model version this worker serves and how long it took to load """
+	recommender = registry.current() if registry.loaded else None
+	if recommender is None:
+		return []
+	version = [('version',recommender.version)]
+	return [
+		('reco_model_info','gauge','The live model version',[(version,1)]),
+		('reco_model_rows','gauge','Artists in the live model, delta buffer included',[(version,recommender.U.shape[0]+len(recommender.delta))]),
+		('reco_model_load_seconds','gauge','Time it took to load the live model',[(version,recommender.load_seconds)])
+	]
+
+@app.route('/metrics')
+def metrics_text():
+	""" the metrics of all workers (or of this one without METRICS_SHARED_PATH) in the Prometheus text format """
+	if config.METRICS_SHARED_PATH:
+		text = metrics.registry.render_shared(config.METRICS_SHARED_PATH)
+	else:
+		text = metrics.registry.render()
+	return Response(text,mimetype='text/plain; version=0.0.4')
+
 """
 Helper functions
 """
 
+def render_template(template,**context):
+	""" render a template, timed as the 'render' stage """
+	with metrics.timer('render',template):
+		return render_flask_template(template,**context)
+
+def batch_arguments(option,default):
+	"""
+	the artist ids and one option of a batch request, given as a JSON list of ids, a JSON
+	object {"ids":[...],option:...} or form fields aid=...&aid=...&option=...
+
+	returns [artist_ids,value,error], where error is a 400 response for any other body
+	"""
+	body = request.get_json(silent=True)
+	if body is None:
+		return [request.form.getlist('aid'),request.form.get(option,default),None]
+	
+	if isinstance(body,list):
+		body = {'ids':body}
+	if not isinstance(body,dict):
+		return [None,None,(json.dumps({'status':'error','error':'the body must be a list of ids or an object with "ids"'}),400)]
+	artist_ids = body.get('ids',[])
+	if not isinstance(artist_ids,list) or any(isinstance(i,(dict,list)) for i in artist_ids):
+		return [None,None,(json.dumps({'status':'error','error':'ids must be a list of artist ids'}),400)]
+	return [[unicode(i) for i in artist_ids],body.get(option,default),None]
+
 def arthash(a):
 	""" conveniently normalize artist name """
 	return a.lower().replace(' ','')
 
-def cached_request(url,headers=None):
-	"""	keep API responses in a dict and only make requests for new information	"""
-	
-	if url in cache:
-		return cache[url]
-	else:
-		r = requests.get(url,headers=headers)
-	
-		if r.status_code==200:
-			cache[url] = r
-	
-		return r
-
 def discogs_search_artist(a):
 	"""
 	Make a request to the Discogs API search endpoint for information about a particular artist
-
-	Note: Discogs does not cooperate unless you pass an arbitrary user-agent!
 	"""
-	
-	request_url = 'https://api.discogs.com/database/search?artist='+a+'&key='+config.DISCOGS_CONSUMER_KEY+'&secret='+config.DISCOGS_CONSUMER_SECRET
-
-	try:
-		r = cached_request(request_url,headers = {'user-agent': config.DISCOGS_APP_USER_AGENT})
-		return r.json()
-		
-	except Exception as e:
-		print "Unexpected error:", sys.exc_info()[0]
-		return None
+	return discogs.search_artist(a)
 
 def get_album_cover_urls_for_artist(a,N=3):
-	result = try_get_album_cover_urls_for_artist(a,N)
-
-	if len(result)<1:
-		aliases = artist_aliases_lookup(a,by='name')
-		for al in aliases:
-			result = try_get_album_cover_urls_for_artist(al,N)
-			if len(result)>0:
-				break
-	return result
-		
-			
+	return get_album_cover_urls_for_artists([a],N)[0]
 
-def try_get_album_cover_urls_for_artist(a,N=3):
+def get_album_cover_urls_for_artists(names,N=3):
 	"""
-	Grab the first N (default is 3) album cover urls from the Discogs search results for an artist
+	Grab the first N (default is 3) album cover urls for each artist
+
+	Covers come from the cover store when it has them; stale entries are served as they are
+	and queued for a background refresh. Only artists the store has never seen wait on Discogs.
 	"""
-	
-	d = discogs_search_artist(a)
-	
-	thumbs = []
-	
-	N=int(N)
-	
-	try:
-		if 'results' in d:
-			for i in d['results']:
-				if i['thumb'] != '':
-					thumbs.append(i['thumb'])
-			return thumbs[:N]
-	except:
-		print "Unexpected error:", sys.exc_info()[0]
-	return []
-	
+	names = list(names)
+	N = int(N)
+	
+	if N>config.COVER_STORE_N:
+		return fetch_album_cover_urls(names,N)
+	
+	with metrics.timer('covers','store'):
+		stored = cover_store.get_many(n for n in names if n is not None)
+	
+	stale = [n for n in stored if not stored[n][1]]
+	if len(stale)>0:
+		cover_prefetcher.enqueue(stale)
+	
+	missing = [n for n in names if n is not None and n not in stored]
+	cover_lookups.inc(len(stored)-len(stale),'fresh')
+	cover_lookups.inc(len(stale),'stale')
+	cover_lookups.inc(len(set(missing)),'missing')
+	
+	fetched = {}
+	if len(missing)>0:
+		with metrics.timer('covers','fetch'):
+			fetched = fetch_and_store_album_cover_urls(missing)
+	
+	results = []
+	for n in names:
+		if fetched.get(n) is not None:
+			results.append(fetched[n][:N])
+		elif n in stored:
+			results.append(stored[n][0][:N])
+		else:
+			results.append([])
+	return results
+
+def fetch_album_cover_urls(names,N=None):
+	"""
+	Grab the first N (default COVER_STORE_N) album cover urls from the Discogs search results for each artist,
+	falling back to the artist's aliases when a name has no results
+	"""
+	return discogs.covers_for_artists(names,N or config.COVER_STORE_N,aliases_for=lambda a: artist_aliases_lookup(a,by='name'))
+
+def fetch_and_store_album_cover_urls(names):
+	"""
+	fetch covers from Discogs into the cover store, returning a dict of name -> urls
+
+	artists whose covers another request or the prefetcher is already fetching are waited for,
+	so a burst of page loads makes at most one upstream lookup per artist
+	"""
+	def fetch(todo):
+		covers = fetch_album_cover_urls(todo)
+		cover_store.put_many(dict(itertools.izip(todo,covers)))
+		return covers
+	return cover_flight.do_many(names,fetch)
+
+def prefetch_album_cover_urls(names):
+	"""	runs on the prefetcher's thread, which needs its own app context for the alias lookups """
+	with app.app_context():
+		fetch_and_store_album_cover_urls(names)
 
 def get_genres_list():
 	db = mysql_get_db()
 	
 	q="select distinct name from (select name from Genres where level=1 and name!='Unknown genre' limit 2000) as t;"
-		
-	cur = db.cursor()
-	
-	cur.execute(q)
 	
-	dbresults = [i[0] for i in cur.fetchall()]
+	dbresults = [i[0] for i in fetchall(db,q,label='genres')]
 	
 	return dbresults
 
 def artist_name_lookup(id):
-	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select artistName from Artists where artistId='"+str(id)+"' limit 1;")
-	name = cur.fetchone()
-	if name is not None:
-		return name[0]
-	else:
-		return None
+	return artist_names_lookup([id])[0]
+
+def artist_names_lookup(ids,chunk=500):
+	"""
+	names for a list of artist ids, None for unknown ids
+
+	names come from the artist catalog or the in-process LRU; the rest are fetched with one IN (...) query per chunk of ids
+	"""
+	ids = [str(i) for i in ids]
+	names = {}
+	
+	snapshot = get_catalog().snapshot()
+	if snapshot is not None:
+		for i,entry in itertools.izip(ids,snapshot.lookup(ids)):
+			if entry is not None:
+				names[i] = entry[0]
+	
+	names.update(artist_names.get_many([i for i in ids if i not in names]))
+	
+	missing = distinctify([i for i in ids if i not in names])
+	if len(missing)>0:
+		db = mysql_get_db()
+		for a in xrange(0,len(missing),chunk):
+			part = missing[a:a+chunk]
+			found = dict((str(i),n) for i,n in fetchall(db,"select artistId, artistName from Artists where artistId in ("+",".join(["%s"]*len(part))+");",part,label='artist_names'))
+			artist_names.set_many(found)
+			names.update(found)
+	
+	return [names.get(i) for i in ids]
 
 def artist_name_popularity_lookup(id):
+	snapshot = get_catalog().snapshot()
+	if snapshot is not None:
+		entry = snapshot.lookup([id])[0]
+		if entry is not None:
+			return (entry[0],entry[1])
+	
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select artistName, artistPopularityAll from Artists where artistId='"+id+"' limit 1;")
-	data = cur.fetchone()
-	return data
+	return fetchone(db,"select artistName, artistPopularityAll from Artists where artistId=%s limit 1;",[id],label='artist_name_popularity')
 
 def artist_id_lookup(name):
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select artistId from Artists where lower(artistName) like lower('"+name+"') limit 1;")
-	name = cur.fetchone()
-	return str(name[0])
+	name = fetchone(db,"select artistId from Artists where lower(artistName) like lower(%s) limit 1;",[name],label='artist_id')
+	if name is not None:
+		return str(name[0])
+	else:
+		return None
 
 def artist_id_lookup_soundslike(name):
 	
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select concat('%',splitname('"+name+"'),'%') limit 1;")
-	soundex = cur.fetchone()[0]
+	soundex = fetchone(db,"select concat('%%',splitname(%s),'%%') limit 1;",[name],label='soundex')[0]
 	
-	cur = db.cursor()
-	cur.execute("select artistId from Artists where soundName like '"+soundex+"' order by artistPopularityAll desc limit 1;")
-	artist_id = cur.fetchone()
+	artist_id = fetchone(db,"select artistId from Artists where soundName like %s order by artistPopularityAll desc limit 1;",[soundex],label='artist_id_soundslike')
 	if artist_id is not None:
 		return str(artist_id[0])
 	else:
@@ -239,13 +416,9 @@ def artist_id_lookup_soundslike(name):
 def artist_id_search_soundslike(name,N=20):
 	
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select concat('%',splitname('"+name+"'),'%') limit 1;")
-	soundex = cur.fetchone()[0]
+	soundex = fetchone(db,"select concat('%%',splitname(%s),'%%') limit 1;",[name],label='soundex')[0]
 	
-	cur = db.cursor()
-	cur.execute("select distinct artistId from Artists where soundName like '"+soundex+"' order by artistPopularityAll desc limit "+str(N)+";")
-	artist_ids = cur.fetchall()
+	artist_ids = fetchall(db,"select distinct artistId from Artists where soundName like %s order by artistPopularityAll desc limit %s;",[soundex,int(N)],label='artist_search_soundslike')
 	
 	return [str(i[0]) for i in artist_ids][:N]
 
@@ -261,30 +434,32 @@ def artist_aliases_lookup(x,by='id'):
 
 	if(by!='id'): # then assume searching by name
 		x = artist_id_lookup(x)
+		if x is None:
+			return []
 	
-	cur = db.cursor()
-	cur.execute("select distinct artistAlias from ArtistAlias where artistId='"+str(x)+"';")
-	aliases = cur.fetchall()
+	aliases = fetchall(db,"select distinct artistAlias from ArtistAlias where artistId=%s;",[str(x)],label='artist_aliases')
 	
 	aliases = [i[0] for i in aliases]		
 	return aliases
 
 def artist_id_search_cached(name,N=20,feelinglucky=False):
-	q=name+str(N)+str(feelinglucky)
+	q=(name,N,feelinglucky)
 	
-	if( q in cache ):
-		return cache[q]
-	else:
-		return artist_id_search(name,N,feelinglucky)
+	result = cache.get('search',q)
+	if result is MISSING:
+		result = artist_id_search(name,N,feelinglucky)
+		cache.set('search',q,result)
+	return result
 
 def artist_id_search(name,N=20,feelinglucky=False):
 	
+	index = get_search_index()
+	if index.loaded:
+		return index.search(name,N,feelinglucky)
 
 	# first search for an exact match
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("SELECT distinct ArtistId from ArtistAlias where replace(artistAlias,' ','') = '"+name.replace(' ','')+"' limit "+str(N)+";")
-	exact = cur.fetchall()
+	exact = fetchall(db,"SELECT distinct ArtistId from ArtistAlias where replace(artistAlias,' ','') = %s limit %s;",[name.replace(' ',''),int(N)],label='alias_exact')
 	
 	exact_match = distinctify([str(i[0]) for i in exact])
 	
@@ -296,15 +471,10 @@ def artist_id_search(name,N=20,feelinglucky=False):
 		return exact_match[:N]
 	
 	# now search for soundex in ArtistAlias table
-	cur = db.cursor()
-	cur.execute("select concat('%',splitname('"+name+"'),'%') limit 1;")
-	soundex = cur.fetchone()[0]
+	soundex = fetchone(db,"select concat('%%',splitname(%s),'%%') limit 1;",[name],label='soundex')[0]
 	soundex = soundex.replace(' ','')
 	
-	cur = db.cursor()
-	cur.execute("SELECT distinct ArtistId from ArtistAlias where replace(AliasSound,' ','') like '"+soundex+"' limit "+str(N)+";")
-	
-	approx = cur.fetchall()
+	approx = fetchall(db,"SELECT distinct ArtistId from ArtistAlias where replace(AliasSound,' ','') like %s limit %s;",[soundex,int(N)],label='alias_soundex')
 	
 	approx_match = [str(i[0]) for i in approx]
 	
@@ -319,18 +489,21 @@ def artist_id_search(name,N=20,feelinglucky=False):
 def lookup_songs_of_artist(id,N=10):
 
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select youtubeId,songName,url from Songs where artistId='"+id+"' order by viewCount desc limit "+str(N)+";")
-	songs = cur.fetchall()
+	songs = fetchall(db,"select youtubeId,songName,url from Songs where artistId=%s order by viewCount desc limit %s;",[id,int(N)],label='songs')
 	
 	return songs
 
 def get_trending_status(id):
+	""" recent popularity less what the catalog-wide mean ratio predicts from all-time popularity """
+	
+	snapshot = get_catalog().snapshot()
+	if snapshot is not None:
+		score = snapshot.trending_of([id])[0]
+		if not np.isnan(score):
+			return int(score)
 	
 	db = mysql_get_db()
-	cur = db.cursor()
-	cur.execute("select artistPopularityRecent,artistPopularityAll from Artists where artistId='"+id+"' limit 1;")
-	[recent,theall] = cur.fetchone()
+	[recent,theall] = fetchone(db,"select artistPopularityRecent,artistPopularityAll from Artists where artistId=%s limit 1;",[id],label='trending_status')
 
 	mu = get_mean_popularity_ratio()
 
@@ -338,12 +511,14 @@ def get_trending_status(id):
 	
 def get_mean_popularity_ratio():
 	"""	get the ratio of mean popularity (recent / all) """
+	snapshot = get_catalog().snapshot()
+	if snapshot is not None and snapshot.mean_popularity_ratio is not None:
+		return snapshot.mean_popularity_ratio
+	
 	if not hasattr(g, 'mean_popularity_ratio'):
 		
 		db = mysql_get_db()
-		cur = db.cursor()
-		cur.execute("select avg(artistPopularityRecent)/avg(artistPopularityAll) from Artists limit 1;")
-		mu = cur.fetchone()[0]
+		mu = fetchone(db,"select avg(artistPopularityRecent)/avg(artistPopularityAll) from Artists limit 1;",label='mean_popularity_ratio')[0]
 		
 		g.mean_popularity_ratio = mu
 	return g.mean_popularity_ratio
@@ -352,95 +527,142 @@ def get_mean_popularity_ratio():
 KDTree / SVD stuff
 """
 
+registry = ModelRegistry()
+
 def get_recommender():
-	"""	returns the artist recommender object """
-	if not hasattr(g, 'recommender'):
-		g.recommender = ArtistRecommender()
-	return g.recommender
+	"""
+	returns the artist recommender, building it on first use
+
+	Within a request the version that was live when the request first asked for it is
+	leased and returned until the request ends, even if a new version is swapped in.
+
+	When gunicorn runs with preload_app (see gunicorn.conf.py) this is called once
+	in the master before forking, so every worker shares the same arrays copy-on-write.
+	The threads that keep it up to date are started per worker (see start_model_threads).
+	"""
+	if not has_app_context():
+		return registry.current()
+	
+	recommender = getattr(g,'_recommender',None)
+	if recommender is None:
+		recommender = g._recommender = registry.acquire()
+	return recommender
+
+@app.before_request
+def start_model_threads():
+	"""
+	Start this process's delta feed and model watcher. Only workers serve requests (and
+	gunicorn.conf.py calls this in post_fork), so the master never runs them: it would
+	keep loading models for nobody, and fork while they hold locks
+	"""
+	if config.DELTA_PATH:
+		delta_feed.start()
+	if config.MODEL_ARTIFACT_PATH and config.MODEL_WATCH_SECONDS:
+		model_watcher.start()
+
+@app.teardown_appcontext
+def release_recommender(error):
+	""" Give back the request's lease on its model version """
+	recommender = getattr(g,'_recommender',None)
+	if recommender is not None:
+		registry.release(recommender)
+		g._recommender = None
+
+@app.after_request
+def add_model_version(response):
+	""" Report which model version answered a recommendation request """
+	recommender = getattr(g,'_recommender',None)
+	if recommender is not None and request.path.startswith('/json/recommend'):
+		response.headers['X-Model-Version'] = recommender.version
+	return response
+
+def set_recommender(recommender):
+	""" validate a new recommender (e.g. a compacted one) and make it live """
+	registry.swap(recommender)
+
+@registry.on_swap
+def model_swapped(new,old):
+	searchnear_responses.clear()
+	if catalog.loaded:
+		# the catalog arrays are aligned with the rows of one model
+		catalog.refresh()
+
+model_watcher = ModelWatcher(registry,config.MODEL_ARTIFACT_PATH,refresh_interval=config.MODEL_WATCH_SECONDS)
+
+# workers that map an artifact never compact the delta themselves: build_model.py --delta
+# folds it into a new version out of band, and the model watcher loads that
+delta_feed = DeltaFeed(config.DELTA_PATH,get_recommender,set_recommender,refresh_interval=config.DELTA_POLL_SECONDS,compact_rows=0 if config.MODEL_ARTIFACT_PATH else config.DELTA_COMPACT_ROWS)
+
+"""
+Home page
+"""
+
+home_snapshot = HomeSnapshot(
+	mysql_subpool.connection,
+	refresh_interval=config.HOME_SNAPSHOT_REFRESH_SECONDS,
+	on_refresh=lambda snapshot: cover_prefetcher.enqueue(snapshot.artist_names())
+)
+
+def get_home_snapshot():
+	"""	returns the home page snapshot, loading it now if this process has none yet """
+	if not home_snapshot.loaded:
+		home_snapshot.refresh()
+	home_snapshot.start()
+	return home_snapshot
+
+"""
+Favorites co-occurrence graph
+"""
+
+cooccurrence = CooccurrenceGraph(app.config['DATABASE'],flush_interval=config.COOCCURRENCE_FLUSH_SECONDS,reload_interval=config.COOCCURRENCE_RELOAD_SECONDS)
+
+def get_cooccurrence():
+	"""	returns the in-memory co-occurrence graph, loading it now if this process has none yet """
+	if not cooccurrence.loaded:
+		cooccurrence.load()
+	cooccurrence.start()
+	return cooccurrence
+
+"""
+Artist catalog
+"""
+
+catalog = ArtistCatalog(mysql_connect_db,get_recommender,refresh_interval=config.CATALOG_REFRESH_SECONDS,updated_column=config.CATALOG_UPDATED_COLUMN)
+
+def get_catalog():
+	"""	returns the in-memory artist catalog, starting its background refresher in this process """
+	catalog.start()
+	return catalog
+
+search_index = ArtistSearchIndex(mysql_connect_db,refresh_interval=config.SEARCH_INDEX_REFRESH_SECONDS)
+
+def get_search_index():
+	"""	returns the in-memory artist name search index, starting its background refresher in this process """
+	search_index.start()
+	return search_index
 
 """
 View functions
 """
 
+@app.errorhandler(UnknownArtistError)
+def unknown_artist(error):
+	""" an artist id that is not part of the model is a 404, not a 500 """
+	if request.path.startswith('/json/'):
+		return json.dumps({'id':error.args[0],'status':'error','error':'unknown artist id'}), 404
+	return 'Unknown artist', 404
+
 @app.route("/")
 def index():
 	form = ArtistSearchForm()
 	
 	""" Display the general recommendation """
-	db = mysql_get_subdb()	
-	cur = db.cursor()
 	
 	Nlim = 8 # number of items to show
-		
-	#Trending Songs
-	q = "select youtubeId,songName,url from trenSong order by viewCount desc limit 30;"
-	cur.execute(q)
-	songs_t = cur.fetchall()
-	songs_list = [i for i in songs_t]
-	slen = len(songs_list)
-	w = [1.2 * slen - i for i in range(slen)]
-	sum_w = sum(w)
-	weight = [float(i)/sum_w for i in w]
-	
-	song_ind = np.random.choice([i for i in range(slen)], Nlim, replace = False, p = weight)	
-	songs = [songs_list[i] for i in song_ind]	
-		
-	tren_song = []
-	for song in songs:
-		tren_song.append({'youtubeId':song[0],'songName':song[1],'url':song[2]})
-	
-	
-	#Trending Artists
-	q = "select distinct artistName, artistId from recArtist order by artistPopularityRecent Desc limit 50;"
-	cur.execute(q)	
-	dbresults_t = cur.fetchall()
-
-	artist_list = [i for i in dbresults_t]
-	alen = len(artist_list)
-	w = [1.2 * alen - i for i in range(alen)]
-	sum_w = sum(w)
-	weight = [float(i)/sum_w for i in w]
 	
-	artist_ind = np.random.choice([i for i in range(alen)], Nlim, replace = False, p = weight)	
-	dbresults = [artist_list[i] for i in artist_ind ]
-
-	tren_artist = [ {'name':n,'id':i} for (n,i) in dbresults]
-	
-	#popular Songs
-	q = "select youtubeId,songName,url from popuSong order by viewCount desc limit 30;"
-	cur.execute(q)
-	songs_t = cur.fetchall()
-
-	songs_list = [i for i in songs_t]
-	slen = len(songs_list)
-	w = [1.2 * slen - i for i in range(slen)]
-	sum_w = sum(w)
-	weight = [float(i)/sum_w for i in w]
-	
-	song_ind = np.random.choice([i for i in range(slen)], Nlim, replace = False, p = weight)	
-	songs = [songs_list[i] for i in song_ind]
+	sample = get_home_snapshot().sample(Nlim)
 	
-	popu_song = []
-	for song in songs:
-		popu_song.append({'youtubeId':song[0],'songName':song[1],'url':song[2]})
-	
-	#Popular Artists
-	q = "select distinct artistName, artistId from popuArtist group by artistName order by artistPopularityAll Desc limit 50;"
-	cur.execute(q)	
-	dbresults_t = cur.fetchall()
-	
-	artist_list = [i for i in dbresults_t]
-	alen = len(artist_list)
-	w = [1.2 * alen - i for i in range(alen)]
-	sum_w = sum(w)
-	weight = [float(i)/sum_w for i in w]
-	
-	artist_ind = np.random.choice([i for i in range(alen)], Nlim, replace = False, p = weight)	
-	dbresults = [artist_list[i] for i in artist_ind]	
-
-	popu_artist = [ {'name':n,'id':i} for (n,i) in dbresults]	
-	
-	return render_template('index.html', form=form, popu_artist=popu_artist,popu_song=popu_song, tren_artist=tren_artist, tren_song = tren_song)
+	return render_template('index.html', form=form, popu_artist=sample['popu_artist'],popu_song=sample['popu_song'], tren_artist=sample['tren_artist'], tren_song = sample['tren_song'])
 	
 @app.route('/favorites', methods=['GET'])
 def askfavorites():
@@ -452,8 +674,20 @@ def askfavorites():
 def recommend(artist_name):
 	artist_id=artist_id_lookup(artist_name)
 	[dist,ids,points]=get_recommender().recommend(artist_id,k=10)
-	names = [artist_name_lookup(i) for i in ids]
-	return render_template('recommend.html',artist_name=artist_name_lookup(artist_id),names=names,dist=dist)
+	names = artist_names_lookup([artist_id]+ids.tolist())
+	return render_template('recommend.html',artist_name=names[0],names=names[1:],dist=dist)
+
+@app.route('/json/recommender/info')
+def recommender_info_json():
+	""" report which model version this worker holds and when it was loaded """
+	info = get_recommender().info()
+	info['registry'] = registry.info()
+	return json.dumps(info)
+
+@app.route('/json/recommender/memory')
+def recommender_memory_json():
+	""" bytes held by each part of this worker's recommender """
+	return json.dumps(get_recommender().memory_report())
 
 @app.route('/json/location/id',methods=['POST'])
 def get_location_from_id_json():
@@ -463,32 +697,206 @@ def get_location_from_id_json():
 	
 	return json.dumps(x.tolist())
 
+def recommendation_rows(dist,ids,points,names):
+	""" rows of (x0..x4,name,relative distance,id) as consumed by the Genre Vision page """
+	
+	dist = (dist/np.max(dist)) # return relative normalize distance (scale of 0-1)
+	
+	return [ (p[0],p[1],p[2],p[3],p[4],n,d,i) for p,n,d,i in itertools.izip(points.tolist(),names,dist.tolist(),ids.tolist())]
+
 @app.route('/json/recommend/id',methods=['POST'])
 def recommend_json():
 	artist_id = request.form['aid']
 	
 	[dist,ids,points]=get_recommender().recommend(artist_id,k=20)
-	names = [artist_name_lookup(i) for i in ids]
+	names = artist_names_lookup(ids)
 	
-	dist = (dist/np.max(dist)) # return relative normalize distance (scale of 0-1)
+	return json.dumps(recommendation_rows(dist,ids,points,names))
+
+@app.route('/json/recommend/batch',methods=['POST'])
+def recommend_batch_json():
+	"""
+	recommendations for many artists at once
+
+	takes a JSON body {"ids":[...],"k":20} or form fields aid=...&aid=...&k=20
+	"""
+	[artist_ids,k,error] = batch_arguments('k',20)
+	if error is not None:
+		return error
 	
-	data = [ (p[0],p[1],p[2],p[3],p[4],n,d,i) for p,n,d,i in itertools.izip(points.tolist(),names,dist.tolist(),ids.tolist())]
+	try:
+		k = min(max(int(k),1),config.BATCH_MAX_K)
+	except (TypeError,ValueError):
+		return json.dumps({'status':'error','error':'k must be an integer'}), 400
+	
+	if len(artist_ids)>config.BATCH_MAX_IDS:
+		return json.dumps({'status':'error','error':'at most %d ids per request' % config.BATCH_MAX_IDS}), 400
+	
+	[dist,ids,points,found]=get_recommender().recommend_many(artist_ids,k=k)
+	
+	unique_ids = list(set(ids.ravel().tolist()))
+	names = dict(itertools.izip(unique_ids,artist_names_lookup(unique_ids)))
 	
-	return json.dumps(data)
+	known = [a for a,f in itertools.izip(artist_ids,found) if f]
+	results = {}
+	for j,a in enumerate(known):
+		results[a] = recommendation_rows(dist[j],ids[j],points[j],[names[i] for i in ids[j].tolist()])
+	
+	unknown = [a for a,f in itertools.izip(artist_ids,found) if not f]
+	
+	return json.dumps({'status':'success','k':k,'results':results,'unknown':unknown})
 	
 @app.route('/json/recommend/searchnear',methods=['POST'])
 def recommend_searchnear_json():
 	xs = [float(request.form[x]) for x in ['x0','x1','x2','x3','x4']]
+	
+	recommender = get_recommender()
+	step = config.SEARCHNEAR_GRID_STEP
+	
+	if step <= 0:
+		[dist,ids,points]=recommender.searchnear(xs,k=config.SEARCHNEAR_K)
+		return json.dumps(recommendation_rows(dist,ids,points,artist_names_lookup(ids)))
+	
+	# nearby slider positions share a grid cell and therefore a response
+	cell = int(grid_cells(xs,step)[0])
+	# delta.changes only grows while artists are added or removed, so it tells the delta generations apart
+	key = (recommender.version,recommender.delta.changes,cell)
+	
+	body = searchnear_responses.get(key)
+	if body is None:
+		[dist,ids,points]=recommender.searchnear_cell(cell,step,k=config.SEARCHNEAR_K)
+		body = json.dumps(recommendation_rows(dist,ids,points,artist_names_lookup(ids)))
+		searchnear_responses.set(key,body)
+	
+	return body
+
+def region_page(dist,rows,order,limit,offset):
+	"""
+		one page of a region result given nearest first as [dist,rows]; returns
+		[dist,rows,order] with the order actually used
+	"""
+	snapshot = get_catalog().snapshot() if order=='popularity' else None
+	if snapshot is not None and snapshot.recommender is get_recommender():
+		# most popular first, nearest first among equals; unknown popularity (and artists
+		# added since the model was built) goes last
+		inmain = rows < len(snapshot.pop_all)
+		pop = np.empty(len(rows))
+		pop.fill(-np.inf)
+		pop[inmain] = snapshot.pop_all[rows[inmain]]
+		pop[np.isnan(pop)] = -np.inf
+		page = np.lexsort((dist,-pop))[offset:offset+limit]
+	else:
+		order = 'distance'
+		page = np.arange(offset,min(offset+limit,len(rows)))
+	
+	return [dist[page],rows[page],order]
 
-	[dist,ids,points]=get_recommender().searchnear(xs,k=25)
+def stream_region(dist,rows,order,offset,total,chunk=500):
+	"""
+		write a region result as JSON piece by piece, naming the artists one chunk at a time,
+		so that a large page is never held as one list of rows
+	"""
+	recommender = get_recommender()
+	yield '{"status": "success", "order": %s, "total": %d, "offset": %d, "results": [' % (json.dumps(order),total,offset)
+	for a in xrange(0,len(rows),chunk):
+		part = rows[a:a+chunk]
+		ids = recommender.ids_of(part)
+		names = artist_names_lookup(ids)
+		points = recommender.unmapped(recommender.points_of(part))
+		body = ', '.join(json.dumps([p[0],p[1],p[2],p[3],p[4],n,d,i]) for p,n,d,i in itertools.izip(points.tolist(),names,dist[a:a+chunk].tolist(),ids.tolist()))
+		yield (', ' if a>0 else '') + body
+	yield ']}'
+
+def region_response(dist,rows):
+	""" the requested page of a region result, streamed """
+	order = request.values.get('order','distance')
+	try:
+		limit = min(max(int(request.values.get('limit',config.REGION_PAGE_SIZE)),1),config.REGION_MAX_RESULTS)
+		offset = max(int(request.values.get('offset',0)),0)
+	except ValueError:
+		return json.dumps({'status':'error','error':'limit and offset must be integers'}), 400
+	
+	total = len(rows)
+	[dist,rows,order] = region_page(dist,rows,order,limit,offset)
+	return Response(stream_with_context(stream_region(dist,rows,order,offset,total)),mimetype='application/json')
 
-	names = [artist_name_lookup(i) for i in ids]
+@app.route('/json/recommend/radius',methods=['POST'])
+def recommend_radius_json():
+	"""
+	every artist within r of x0..x4 in Genre Vision ([0,1]) space
+
+	paged with limit and offset, ordered by distance or, with order=popularity, by artistPopularityAll
+	"""
+	try:
+		xs = [float(request.values[x]) for x in ['x0','x1','x2','x3','x4']]
+		r = float(request.values['r'])
+	except (KeyError,ValueError):
+		return json.dumps({'status':'error','error':'x0..x4 and r are required numbers'}), 400
+	if not 0 <= r <= config.REGION_MAX_RADIUS:
+		return json.dumps({'status':'error','error':'r must be between 0 and %g' % config.REGION_MAX_RADIUS}), 400
 	
-	dist = (dist/np.max(dist)) # return relative normalize distance (scale of 0-1)
+	try:
+		[dist,rows] = get_recommender().within_radius(xs,r,max_rows=config.REGION_MAX_CANDIDATES)
+	except RegionTooLargeError as e:
+		return json.dumps({'status':'error','error':str(e)}), 400
+	return region_response(dist,rows)
+
+@app.route('/json/recommend/box',methods=['POST'])
+def recommend_box_json():
+	"""
+	every artist with lo0..lo4 <= x <= hi0..hi4 in Genre Vision ([0,1]) space
+
+	paged and ordered like /json/recommend/radius; distance is to the centre of the box
+	"""
+	try:
+		lo = [float(request.values['lo%d' % d]) for d in range(5)]
+		hi = [float(request.values['hi%d' % d]) for d in range(5)]
+	except (KeyError,ValueError):
+		return json.dumps({'status':'error','error':'lo0..lo4 and hi0..hi4 are required numbers'}), 400
+	if not all(0 <= h-l <= config.REGION_MAX_EXTENT for l,h in zip(lo,hi)):
+		return json.dumps({'status':'error','error':'every hi-lo must be between 0 and %g' % config.REGION_MAX_EXTENT}), 400
+	
+	try:
+		[dist,rows] = get_recommender().within_box(lo,hi,max_rows=config.REGION_MAX_CANDIDATES)
+	except RegionTooLargeError as e:
+		return json.dumps({'status':'error','error':str(e)}), 400
+	return region_response(dist,rows)
+
+@app.route('/json/recommend/rising',methods=['POST'])
+def recommend_rising_json():
+	"""
+	the most trending artists around an artist (aid) or a Genre Vision point (x0..x4)
+
+	the TRENDING_NEAR_K nearest artists are ranked by their catalog trending score,
+	fused with their closeness; rows are those of /json/recommend/id plus the trending score
+	"""
+	snapshot = get_catalog().snapshot()
+	if snapshot is None:
+		return json.dumps({'status':'loading','results':[]})
 	
-	data = [ (p[0],p[1],p[2],p[3],p[4],n,d,i) for p,n,d,i in itertools.izip(points.tolist(),names,dist.tolist(),ids.tolist())]
+	try:
+		n = min(max(int(request.values.get('n',config.TRENDING_NEAR_N)),1),config.TRENDING_NEAR_K)
+	except ValueError:
+		return json.dumps({'status':'error','error':'n must be an integer'}), 400
+	
+	recommender = get_recommender()
+	if 'aid' in request.values:
+		[dist,ids,points] = recommender.recommend(request.values['aid'],k=config.TRENDING_NEAR_K)
+	else:
+		try:
+			xs = [float(request.values[x]) for x in ['x0','x1','x2','x3','x4']]
+		except (KeyError,ValueError):
+			return json.dumps({'status':'error','error':'aid or x0..x4 are required'}), 400
+		[dist,ids,points] = recommender.searchnear(xs,k=config.TRENDING_NEAR_K)
+		points = recommender.unmapped(points)
 	
-	return json.dumps(data)	
+	[best,score,trending] = snapshot.rising(ids,dist,n=n,distance_weight=config.TRENDING_DISTANCE_WEIGHT)
+	if len(best)==0:
+		return json.dumps({'status':'success','results':[]})
+	
+	rows = recommendation_rows(dist[best],ids[best],points[best],artist_names_lookup(ids[best]))
+	
+	return json.dumps({'status':'success','results':[row+(int(t),) for row,t in itertools.izip(rows,trending.tolist())]})
 
 @app.route('/json/artistid/soundslike',methods=['POST'])
 def search_artist_id_lookup_soundslike():
@@ -504,6 +912,25 @@ def search_artist_id_lookup_soundslike():
 	
 	
 
+@app.route('/json/artistid/autocomplete',methods=['GET','POST'])
+def search_artist_id_autocomplete():
+	""" artists with an alias starting with the search term, most popular first """
+	
+	search = request.values.get('search_term','')
+	
+	index = get_search_index()
+	if not index.loaded:
+		return json.dumps({'results':[],'status':'loading'})
+	
+	ids = index.prefix(search,N=10)
+	
+	return json.dumps({'results':[{'id':i,'name':n} for i,n in itertools.izip(ids,artist_names_lookup(ids))],'status':'success'})
+
+@app.route('/json/cache/stats')
+def cache_stats_json():
+	""" hit/miss/eviction counters of this worker's response cache """
+	return json.dumps(cache.stats())
+
 @app.route("/artists")	
 def artists():
 	""" list known artists """
@@ -520,11 +947,12 @@ def artist_page(id=None):
 	if id is None:
 		id = artist_id_lookup('Rihanna')
 	
-	artist_name = artist_name_lookup(id)
-	
 	# find similar artists
 	[dist,ids,points] = get_recommender().recommend(id,k=11)
-	names = [artist_name_lookup(i) for i in ids]
+	names = artist_names_lookup([id]+ids.tolist())
+	artist_name = names.pop(0)
+	
+	cover_prefetcher.enqueue(names)
 	
 	order=np.argsort(dist)
 	names = np.array(names)[order].tolist()
@@ -546,8 +974,8 @@ def artist_search_page():
 	search_term = request.form['searchbox']
 		
 	artist_ids = artist_id_search_cached(search_term,N=15,feelinglucky=False)
-	artist_names = [artist_name_lookup(str(i)) for i in artist_ids]
-	return render_template('artist_search.html',search_term=search_term,artists=itertools.izip(artist_ids,artist_names))
+	names = artist_names_lookup(artist_ids)
+	return render_template('artist_search.html',search_term=search_term,artists=itertools.izip(artist_ids,names))
 
 @app.route("/albumcovers/<by>/<artist>/<N>")
 @app.route("/albumcovers/<by>/<artist>")
@@ -561,6 +989,30 @@ def json_get_album_cover_urls_for_artist(by,artist,N=1):
 		
 	return json.dumps(results)
 
+@app.route("/albumcovers/batch",methods=['POST'])
+def json_get_album_cover_urls_for_artists():
+	"""
+	album covers for many artists in one response
+
+	takes a JSON body [...] or {"ids":[...],"N":1}, or form fields aid=...&aid=...&N=1, and returns {id: [urls]}
+	"""
+	[artist_ids,N,error] = batch_arguments('N',1)
+	if error is not None:
+		return error
+	
+	if len(artist_ids)>config.BATCH_MAX_IDS:
+		return json.dumps({'status':'error','error':'at most %d ids per request' % config.BATCH_MAX_IDS}), 400
+	
+	try:
+		N = min(max(int(N),1),config.COVER_STORE_N)
+	except (TypeError,ValueError):
+		return json.dumps({'status':'error','error':'N must be an integer'}), 400
+	
+	names = artist_names_lookup(artist_ids)
+	covers = get_album_cover_urls_for_artists(names,N=N)
+	
+	return json.dumps(dict(itertools.izip(artist_ids,covers)))
+
 @app.route("/genres")	
 def genres():
 	""" list genres """
@@ -579,10 +1031,39 @@ def genrevision(by=None,x=None):
 	
 	return render_template('genre_vision.html',initial_point=searchpoint,dimlabels=config.dimlabels)
 
+def favorites_from_embedding(names,n=10):
+	""" names of the n artists nearest to all of the named artists together in the embedding """
+	
+	seeds = [artist_id_search_cached(name,N=1,feelinglucky=True) for name in names]
+	seeds = [aid for aid in seeds if isinstance(aid,basestring)]
+	if len(seeds)==0:
+		return []
+	
+	[score,ids,points,found]=get_recommender().recommend_for_seeds(seeds,k=n)
+	
+	return artist_names_lookup(ids.tolist())
+
+def fuse_rankings(rankings,n=5,c=60):
+	"""
+		reciprocal rank fusion of several ranked lists of artist names: each list adds
+		1/(c+rank) to a name, so names near the top of more than one list come first
+	"""
+	scores = {}
+	display = {}
+	for ranking in rankings:
+		for rank,name in enumerate(ranking):
+			if name is None:
+				continue
+			key = normalize(name)
+			display.setdefault(key,name)
+			scores[key] = scores.get(key,0) + 1.0/(c+rank)
+	
+	top = sorted(scores.iteritems(),key=lambda x:(-x[1],x[0]))[:n]
+	return [display[key] for key,s in top]
+
 @app.route('/favorites', methods=['POST'])
 def postfavorites():
 	""" process the user's favorites list """
-	db = get_db()
 	arts = [request.form['a1'],request.form['a2'],request.form['a3']]
 	
 	if all(a is not u'' for a in arts):	# make sure that none of the fields were left empty
@@ -591,49 +1072,49 @@ def postfavorites():
 		
 		ahs = [arthash(a) for a in arts]
 		
+		graph = get_cooccurrence()
+		
 		# assimulate new data
 		
 		"""
 			Add 1 to the weighting between each pair of artists selected
 			by the user. If the link did not already exist, add it.
+			Also add these artists to the list of known artists (if any were previously unknown).
 		"""
 		
-		q="insert or replace into a2a values (?, ?,coalesce( (SELECT w FROM a2a WHERE aid1=? AND aid2=?), 0) + 1);"
-		
-		db.execute(q,[ahs[0],ahs[1],ahs[0],ahs[1]])
-		db.execute(q,[ahs[1],ahs[2],ahs[1],ahs[2]])
-		db.execute(q,[ahs[0],ahs[2],ahs[0],ahs[2]])
-		
-		# add these artists to the list of known artists (if any were previously unknown)
-		
-		q="insert or ignore into a (aid, display) values (?, ?);"
-		
-		db.execute(q,[ahs[0],arts[0]])
-		db.execute(q,[ahs[1],arts[1]])
-		db.execute(q,[ahs[2],arts[2]])
-		db.commit()
+		graph.add([(ahs[0],ahs[1]),(ahs[1],ahs[2]),(ahs[0],ahs[2])],zip(ahs,arts))
 		
 		"""
 			Return the top 5 artists with the strongest connection to the
 			artists selected by the user.
 		"""
 		
-		cur = db.execute('select B.display, sum(w) as s from (select aid2 as aidA, aid1 as aidB, w from a2a where aid1 = ? or aid1=? or aid1=? union select aid1 as aidA, aid2 as aidB, w from a2a where aid2 = ? or aid2=? or aid2=? ) as A join a as B on A.aidA = B.aid where A.aidA != ? and A.aidA != ? and A.aidA != ? group by aidA order by s desc limit 5;', [ahs[0],ahs[1],ahs[2], ahs[0],ahs[1],ahs[2], ahs[0],ahs[1],ahs[2]])
+		linked = graph.top_linked(ahs,n=10)
 		
-		dbresults = cur.fetchall()
+		"""
+			Ask the embedding for the artists closest to all three at once
+			and fuse both rankings.
+		"""
+		
+		similar = favorites_from_embedding(arts,n=10)
+		
+		dbresults = fuse_rankings([similar,[display for display,w in linked]],n=5)
 		
 		"""
-			If there weren't any known artists connected to those
-			selected by the user, return the top 5 most popular artists in the database.
+			If neither knew anything about the artists selected by the user,
+			return the top 5 most popular artists in the database.
 		"""
 		
 		if(len(dbresults)<1):
-			cur = db.execute('select B.display,sum(w) as s from (select aid2 as aidA, aid1 as aidB, w from a2a union select aid1 as aidA, aid2 as aidB, w from a2a) as A join a as B on A.aidA = B.aid where A.aidA != ? and A.aidA != ? and A.aidA != ? group by aidA order by s desc limit 5;',[ahs[0],ahs[1],ahs[2]])
-			dbresults = cur.fetchall()
+			dbresults = [display for display,w in graph.top_overall(exclude=set(ahs),n=5)]
+	
+		dbresults = [{'display':display} for display in dbresults]
 	
+		covers = get_album_cover_urls_for_artists([dbr['display'] for dbr in dbresults])
+		
 		results = []
-		for dbr in dbresults:
-			results.append({'display':dbr['display'],'album_covers':get_album_cover_urls_for_artist(dbr['display'])})
+		for dbr,album_covers in itertools.izip(dbresults,covers):
+			results.append({'display':dbr['display'],'album_covers':album_covers})
 			
 		return render_template('results.html',results=results)
 
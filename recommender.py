@@ -1,41 +1,557 @@
 from scipy.spatial import cKDTree
+from backends import ExactBackend, RerankBackend, make_backend, PARALLEL_QUERY
+from delta import DeltaIndex, read_delta, fold_delta
 import numpy as np
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import threading
+import time
 import config
+import metrics
+
+ARTIFACT_FORMAT = 1
+
+STORAGE = ('float64','float32','uint8')
+
+def model_version(paths):
+	"""
+		a short fingerprint of the model files, unless config pins one explicitly
+	"""
+	if getattr(config,'MODEL_VERSION',''):
+		return config.MODEL_VERSION
+
+	h = hashlib.sha1()
+	for p in paths:
+		st = os.stat(p)
+		h.update('%s:%d:%d;' % (os.path.abspath(p),st.st_size,int(st.st_mtime)))
+	return h.hexdigest()[:12]
+
+def normalize_embedding(U,copy=True,chunk=65536):
+	"""
+		move outliers to within 25 standard deviations of the mean, then
+		transform every dimension of U to be from 0 to 1
+
+		returns the normalized U and the parameters used, so that new raw vectors
+		can be put through the same transformation later; with copy=False a float64
+		U is normalized in place. the statistics are accumulated in chunks of rows,
+		so no full-size temporaries are made
+	"""
+	U = np.array(U,dtype=np.float64,copy=copy)
+	n = U.shape[0]
+
+	mu = np.zeros(U.shape[1])
+	for a in xrange(0,n,chunk):
+		mu += U[a:a+chunk].sum(0)
+	mu /= n
+	sd = np.zeros(U.shape[1])
+	for a in xrange(0,n,chunk):
+		sd += ((U[a:a+chunk]-mu)**2).sum(0)
+	sd = np.sqrt(sd/n)
+	clip_lo = mu-25*sd
+	clip_hi = mu+25*sd
+
+	np.clip(U,clip_lo,clip_hi,out=U)
+
+	scale_min = np.min(U,0)
+	scale_range = np.max(U,0) - scale_min
+
+	U -= scale_min
+	U /= scale_range
+
+	# uncomment below for proportional transformation
+	#U *= scale_range/np.max(scale_range)
+
+	return U,{'clip_lo':clip_lo,'clip_hi':clip_hi,'scale_min':scale_min,'scale_range':scale_range}
+
+def quantize(U,levels=256,chunk=65536):
+	"""
+		per-dimension uint8 codes of U, code = round((u-lo)/scale); returns [codes,lo,scale]
+	"""
+	lo = np.asarray(np.min(U,0),dtype=np.float64)
+	scale = (np.asarray(np.max(U,0),dtype=np.float64)-lo)/(levels-1)
+	scale[scale == 0] = 1
+
+	codes = np.empty(U.shape,dtype=np.uint8)
+	for a in xrange(0,U.shape[0],chunk):
+		codes[a:a+chunk] = np.rint((np.asarray(U[a:a+chunk],dtype=np.float64)-lo)/scale)
+	return [codes,lo,scale]
+
+class QuantizedMatrix(object):
+	"""
+		uint8 codes standing in for U in a backend: indexing rows (U[rows,:], U[a:b])
+		decodes them to float64, so backends use it like the array it approximates
+	"""
+
+	dtype = np.dtype(np.float64)
+
+	def __init__(self,codes,lo,scale):
+		self.codes = codes
+		self.lo = lo
+		self.scale = scale
+		self.shape = codes.shape
+		self.error = scale/2 # largest decoding error per dimension
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self,key):
+		return self.codes[key]*self.scale+self.lo
+
+	def __array__(self,dtype=None):
+		return np.asarray(self[:],dtype=dtype or self.dtype)
+
+def compact_ids(artist_list):
+	"""
+		artist ids as the smallest integer array that holds them, when every id is a
+		decimal number; otherwise unchanged
+	"""
+	if artist_list.dtype.kind in 'iu':
+		ids = artist_list
+	elif all(str(a).isdigit() for a in artist_list):
+		ids = np.array([int(a) for a in artist_list],dtype=np.int64)
+	else:
+		return artist_list
+	if len(ids) and ids.min() >= 0 and ids.max() < 2**31:
+		return ids.astype(np.int32)
+	return ids.astype(np.int64)
+
+def load_artist_list(path):
+	""" the artist ids from an npz, as strings or, with MODEL_COMPACT_IDS, integers """
+	artist_list = np.load(path)['arr_0']
+	if artist_list.dtype == object:
+		artist_list = np.array([str(a) for a in artist_list])
+	if config.MODEL_COMPACT_IDS:
+		artist_list = compact_ids(artist_list)
+	return artist_list
+
+def apply_normalization(V,norm):
+	""" put raw embedding vectors through the transformation normalize_embedding applied to U """
+	V = np.clip(np.atleast_2d(np.asarray(V,dtype=np.float64)),norm['clip_lo'],norm['clip_hi'])
+	return (V-norm['scale_min'])/norm['scale_range']
+
+def drop_self(dist,inxes,rows,k):
+	"""
+		remove each query's own row from k+1 neighbour results, leaving k per row
+
+		an exact duplicate can push the search point itself out of the results; the
+		farthest neighbour is dropped instead in that case
+	"""
+	keep = inxes != rows[:,None]
+	keep[keep.all(1),-1] = False
+	return [dist[keep].reshape(len(rows),k),inxes[keep].reshape(len(rows),k)]
+
+_table_source = None # (tree,U) inherited by the forked neighbour table workers
+
+def _neighbor_chunk(bounds):
+	tree,U = _table_source
+	rows = np.arange(bounds[0],bounds[1])
+	k = bounds[2]
+	[dist,inxes] = tree.query(U[rows,:],k=k+1)
+	[dist,inxes] = drop_self(dist,inxes,rows,k)
+	return [dist.astype(np.float32),inxes.astype(np.int32)]
+
+def neighbor_table(tree,U,k,chunk=65536,processes=None):
+	"""
+		the k nearest neighbours (excluding itself) of every row of U, computed in
+		parallel chunks; returns float32 distances and int32 rows, both shaped (N,k)
+	"""
+	global _table_source
+	_table_source = (tree,U)
+
+	n = U.shape[0]
+	chunks = [(a,min(a+chunk,n),k) for a in xrange(0,n,chunk)]
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		parts = pool.map(_neighbor_chunk,chunks)
+	finally:
+		pool.close()
+		pool.join()
+		_table_source = None
+
+	return [np.vstack([p[0] for p in parts]),np.vstack([p[1] for p in parts])]
+
+def grid_cells(points,step):
+	"""
+		key of the cell of a grid with spacing step over [0,1]^d that each point falls
+		in, as one int64 per point; points outside [0,1] go to the nearest edge cell
+	"""
+	points = np.clip(np.atleast_2d(np.asarray(points,dtype=np.float64)),0,1)
+	side = int(np.ceil(1.0/step))
+	cells = np.minimum((points/step).astype(np.int64),side-1)
+	return np.ravel_multi_index(tuple(cells.T),(side,)*points.shape[1])
+
+def grid_centers(keys,step,d):
+	""" the centre, in [0,1]^d, of each grid cell key """
+	side = int(np.ceil(1.0/step))
+	cells = np.array(np.unravel_index(np.asarray(keys,dtype=np.int64),(side,)*d)).T
+	return (cells+0.5)*step
+
+def resolve_artifact(path):
+	"""
+		an artifact path is either a single version directory (it has a meta.json)
+		or a root directory whose CURRENT file names the live version
+	"""
+	if os.path.exists(os.path.join(path,'meta.json')):
+		return path
+	with open(os.path.join(path,'CURRENT')) as f:
+		return os.path.join(path,f.read().strip())
+
+def artifact_meta(path):
+	""" the meta.json of the artifact at path (see resolve_artifact) """
+	with open(os.path.join(resolve_artifact(path),'meta.json')) as f:
+		return json.load(f)
+
+def check_storage(storage):
+	""" raise ValueError unless U can be held as storage with config.ANN_BACKEND """
+	if storage not in STORAGE:
+		raise ValueError('unknown storage %r (choose from %s)' % (storage,', '.join(STORAGE)))
+	if storage != 'float64' and config.ANN_BACKEND == 'exact':
+		# the exact backend's tree always holds float64 coordinates, so a smaller U comes on top of them
+		raise ValueError('storage %r needs a non-exact ANN_BACKEND; the exact backend keeps a float64 copy of U' % storage)
+
+def build_artifact(out_dir,U_path=None,otherdata_path=None,neighbor_k=None,hot_cells=None,storage=None,delta_path=None):
+	"""
+		run the startup work of ArtistRecommender once, offline, and write the result to
+		out_dir/<version>/ so that workers can memory-map it instead of recomputing
+
+		neighbor_k (default config.NEIGHBOR_TABLE_K) is the width of the precomputed
+		neighbour table; 0 skips it
+
+		hot_cells (default config.SEARCHNEAR_HOT_CELLS) is the number of the most crowded
+		SEARCHNEAR_GRID_STEP cells whose searchnear answer is precomputed; 0 skips it
+
+		storage (default config.MODEL_STORAGE) is how U is written: 'float64', 'float32',
+		or 'uint8', which adds per-dimension uint8 codes for the backend to scan next to
+		a float32 U for re-ranking
+
+		delta_path names an embedding_delta file (see delta.py) whose rows are folded
+		into U before anything is built; the last seq folded in is recorded as delta_seq,
+		so the delta feed only replays newer rows onto the artifact
+
+		returns the path of the version directory
+	"""
+	if neighbor_k is None:
+		neighbor_k = config.NEIGHBOR_TABLE_K
+	if hot_cells is None:
+		hot_cells = config.SEARCHNEAR_HOT_CELLS
+	grid_step = config.SEARCHNEAR_GRID_STEP
+	storage = storage or config.MODEL_STORAGE
+	check_storage(storage)
+	U_path = U_path or config.U_path
+	otherdata_path = otherdata_path or config.otherdata_path
+
+	version = model_version([U_path,otherdata_path])
+
+	U = np.load(U_path)['arr_0']
+	artist_list = load_artist_list(otherdata_path)
+	delta_seq = 0
+	if delta_path:
+		[U,artist_list,delta_seq] = fold_delta(U,artist_list,read_delta(delta_path))
+		if config.MODEL_COMPACT_IDS:
+			artist_list = compact_ids(artist_list)
+		if delta_seq:
+			version = '%s+%d' % (version,delta_seq)
+	U,norm = normalize_embedding(U,copy=False)
+
+	target = os.path.join(out_dir,version)
+	tmp = target+'.tmp-%d' % os.getpid()
+	os.makedirs(tmp)
+
+	np.save(os.path.join(tmp,'U.npy'),U if storage == 'float64' else U.astype(np.float32))
+	quantizer = None
+	if storage == 'uint8':
+		[codes,lo,scale] = quantize(U)
+		np.save(os.path.join(tmp,'U_codes.npy'),codes)
+		quantizer = {'lo':lo.tolist(),'scale':scale.tolist()}
+	np.save(os.path.join(tmp,'artist_list.npy'),artist_list)
+	np.save(os.path.join(tmp,'id_order.npy'),np.argsort(artist_list,kind='mergesort'))
+
+	if config.ANN_BACKEND != 'exact':
+		make_backend(config.ANN_BACKEND,U,**config.ANN_PARAMS).save(tmp)
+
+	# no tree is written: an unpickled cKDTree holds a private copy of U, while one built
+	# at load time over the mapped U shares its pages. This one only answers the queries below
+	tree = cKDTree(U) if neighbor_k > 0 or (hot_cells > 0 and grid_step > 0) else None
+
+	if neighbor_k > 0:
+		[dist,inxes] = neighbor_table(tree,U,neighbor_k)
+		np.save(os.path.join(tmp,'neighbor_dist.npy'),dist)
+		np.save(os.path.join(tmp,'neighbors.npy'),inxes)
+
+	Umin = np.min(U,0)
+	Urange = np.max(U,0) - Umin
+
+	grid_k = 0
+	if hot_cells > 0 and grid_step > 0:
+		grid_k = config.SEARCHNEAR_K
+		keys,counts = np.unique(grid_cells((U-Umin)/Urange,grid_step),return_counts=True)
+		keys = np.sort(keys[np.argsort(-counts,kind='mergesort')[:hot_cells]])
+		[dist,inxes] = tree.query(Umin+grid_centers(keys,grid_step,U.shape[1])*Urange,k=grid_k,**PARALLEL_QUERY)
+		np.save(os.path.join(tmp,'grid_cells.npy'),keys)
+		np.save(os.path.join(tmp,'grid_neighbors.npy'),inxes.reshape(len(keys),grid_k).astype(np.int32))
+		np.save(os.path.join(tmp,'grid_dist.npy'),dist.reshape(len(keys),grid_k).astype(np.float32))
+
+	meta = {
+		'format':ARTIFACT_FORMAT,
+		'version':version,
+		'built_at':time.time(),
+		'sources':[os.path.abspath(U_path),os.path.abspath(otherdata_path)]+([os.path.abspath(delta_path)] if delta_path else []),
+		'delta_seq':delta_seq,
+		'n_artists':int(U.shape[0]),
+		'n_dims':int(U.shape[1]),
+		'storage':storage,
+		'quantizer':quantizer,
+		'neighbor_k':int(neighbor_k),
+		'grid_step':grid_step,
+		'grid_k':int(grid_k),
+		'Umin':Umin.tolist(),
+		'Urange':Urange.tolist(),
+		'normalization':dict((k,v.tolist()) for k,v in norm.items())
+	}
+	with open(os.path.join(tmp,'meta.json'),'w') as f:
+		json.dump(meta,f,indent=1)
+
+	if os.path.exists(target):
+		shutil.rmtree(target)
+	os.rename(tmp,target)
+
+	# point CURRENT at the new version atomically
+	with open(os.path.join(out_dir,'CURRENT.tmp'),'w') as f:
+		f.write(version)
+	os.rename(os.path.join(out_dir,'CURRENT.tmp'),os.path.join(out_dir,'CURRENT'))
+
+	return target
+
+def _is_mapped(a):
+	""" whether an array's memory belongs to a memory-mapped file """
+	while a is not None:
+		if isinstance(a,mmap.mmap) or getattr(a,'_mmap',None) is not None:
+			return True
+		a = getattr(a,'base',None)
+	return False
+
+class UnknownArtistError(KeyError):
+	""" raised when an artist id is not part of the model """
+	pass
+
+class RegionTooLargeError(ValueError):
+	""" raised when a radius or box query would gather more artists than allowed """
+	pass
+
+class ModelValidationError(ValueError):
+	""" raised when a newly loaded model is not fit to replace the live one """
+	pass
+
+def _check_region(rows,max_rows):
+	if max_rows is not None and len(rows) > max_rows:
+		raise RegionTooLargeError('the region holds more than %d artists' % max_rows)
 
 class ArtistRecommender(object):
 
-	def __init__(self):
+	neighbors = None # optional (N,K) table of precomputed neighbour rows, see build_artifact
+	neighbor_dist = None
+	grid_keys = None # optional sorted keys of precomputed searchnear cells, see build_artifact
 
-		self.U = np.load(config.U_path)['arr_0']
-		
-		# transform dimensions of U to be from 0 to 1
-		
-		# move outliers
-		
-		self.Umax = np.mean(self.U,0)+25*np.std(self.U,0)
-		self.Umin = np.mean(self.U,0)-25*np.std(self.U,0)
-		
-		ndims=self.U.shape[1]
-		
-		for d in xrange(0,ndims):		
-			self.U[ self.U[:,d]<self.Umin[d], d] = self.Umin[d]
-			self.U[ self.U[:,d]>self.Umax[d], d] = self.Umax[d]
-		
-		self.Umax = np.max(self.U,0)
-		self.Umin = np.min(self.U,0)
-		self.Urange = self.Umax - self.Umin
-		
-		self.U = (self.U-self.Umin)/(self.Umax-self.Umin)
-		
-		# uncomment below for proportional transformation
-		#self.U = (self.U-self.Umin)/np.max(self.Urange)
-		
-		self.Umax = np.max(self.U,0)
-		self.Umin = np.min(self.U,0)
-		self.Urange = self.Umax - self.Umin
-				
-		self.K = cKDTree(self.U)
-		self.artist_list = np.load(config.otherdata_path)['arr_0']
+	def __init__(self,artifact_path=None):
+
+		started = time.time()
+
+		artifact_path = artifact_path or getattr(config,'MODEL_ARTIFACT_PATH','')
+
+		if artifact_path:
+			self._load_artifact(resolve_artifact(artifact_path))
+		else:
+			self._load_npz()
+
+		self._finish_loading(started)
+
+	@classmethod
+	def from_arrays(cls,U,artist_list,normalization,version,bounds=None):
+		"""
+			a recommender over an already normalized float64 U, e.g. a compacted one;
+			bounds=(Umin,Urange) keeps the [0,1] space of the recommender it replaces
+		"""
+		started = time.time()
+		self = cls.__new__(cls)
+		self.normalization = normalization
+		self._set_arrays(U,artist_list,bounds)
+		self.version = version
+		self._finish_loading(started)
+		return self
+
+	def _finish_loading(self,started):
+		if not hasattr(self,'_id_order'):
+			self._id_order = np.argsort(self.artist_list,kind='mergesort')
+		self._sorted_ids = self.artist_list[self._id_order]
+
+		self.delta = DeltaIndex.empty(self.U.shape[0],self.U.shape[1],self.artist_list.dtype)
+		self._delta_lock = threading.Lock()
+
+		self.loaded_at = time.time()
+		self.load_seconds = self.loaded_at - started
+		metrics.record('recommender','build',self.load_seconds)
+
+	def _load_npz(self):
+		""" build everything from the raw npz files named in config """
+
+		U,self.normalization = normalize_embedding(np.load(config.U_path)['arr_0'],copy=False)
+		self._set_arrays(U,load_artist_list(config.otherdata_path))
+		self.version = model_version([config.U_path,config.otherdata_path])
+
+	def _set_arrays(self,U,artist_list,bounds=None):
+		""" hold a normalized float64 U in the configured storage and index it """
+		if bounds is None:
+			self.Umin = np.min(U,0)
+			self.Urange = np.max(U,0) - self.Umin
+		else:
+			self.Umin,self.Urange = bounds
+		self.Umax = self.Umin + self.Urange
+
+		self.storage = config.MODEL_STORAGE
+		check_storage(self.storage)
+		self.U = U if self.storage == 'float64' else U.astype(np.float32)
+		self.search_U = QuantizedMatrix(*quantize(U)) if self.storage == 'uint8' else self.U
+
+		self._make_backend(U)
+		self.artist_list = artist_list
+
+	def _load_artifact(self,path):
+		""" memory-map a prebuilt artifact written by build_artifact """
+
+		with open(os.path.join(path,'meta.json')) as f:
+			meta = json.load(f)
+
+		if meta['format'] != ARTIFACT_FORMAT:
+			raise ValueError('unsupported artifact format %r in %s' % (meta['format'],path))
+
+		# embedding_delta rows up to this seq are already part of U
+		self.delta_seq = meta.get('delta_seq',0)
+
+		self.storage = meta.get('storage','float64')
+		check_storage(self.storage)
+		self.U = np.load(os.path.join(path,'U.npy'),mmap_mode='r')
+		self.search_U = self.U
+		if self.storage == 'uint8':
+			# the codes are scanned by every query, so they are kept in memory
+			q = meta['quantizer']
+			self.search_U = QuantizedMatrix(np.load(os.path.join(path,'U_codes.npy')),np.array(q['lo']),np.array(q['scale']))
+		self.artist_list = np.load(os.path.join(path,'artist_list.npy'),mmap_mode='r')
+		self._id_order = np.load(os.path.join(path,'id_order.npy'),mmap_mode='r')
+
+		self.Umin = np.array(meta['Umin'])
+		self.Urange = np.array(meta['Urange'])
+		self.Umax = self.Umin + self.Urange
+		self.normalization = dict((k,np.array(v)) for k,v in meta['normalization'].items())
+
+		self._make_backend(self.U,path=path)
+
+		if meta.get('neighbor_k',0) > 0:
+			self.neighbors = np.load(os.path.join(path,'neighbors.npy'),mmap_mode='r')
+			self.neighbor_dist = np.load(os.path.join(path,'neighbor_dist.npy'),mmap_mode='r')
+
+		if meta.get('grid_k',0) > 0:
+			self.grid_step = meta['grid_step']
+			self.grid_keys = np.load(os.path.join(path,'grid_cells.npy'))
+			self.grid_neighbors = np.load(os.path.join(path,'grid_neighbors.npy'),mmap_mode='r')
+			self.grid_dist = np.load(os.path.join(path,'grid_dist.npy'),mmap_mode='r')
+
+		self.version = meta['version']
+		self.artifact_path = path
+
+	def _make_backend(self,exact_U,path=None):
+		"""
+			the exact backend is a tree over the exact U (it keeps float64 coordinates
+			whatever the storage), built in every process that loads a model: over a
+			mapped float64 U the coordinates stay shared pages and only the tree's index
+			is private. Other backends scan search_U, and re-rank their candidates
+			against U when search_U is quantized
+		"""
+		if config.ANN_BACKEND == 'exact':
+			self.backend = ExactBackend(exact_U)
+			return
+
+		params = dict(config.ANN_PARAMS)
+		if path is not None:
+			params['path'] = path
+		self.backend = make_backend(config.ANN_BACKEND,self.search_U,**params)
+		if self.search_U is not self.U:
+			self.backend = RerankBackend(self.backend,self.U,self.search_U.error,config.MODEL_RERANK_SHORTLIST)
+
+	def memory_report(self):
+		"""
+			bytes held per component; mapped arrays are pages of the artifact files, loaded
+			on demand and shared by every worker, the rest is private to this process
+		"""
+		components = {
+			'U':self.U,
+			'search_U':self.search_U.codes if self.search_U is not self.U else None,
+			'artist_list':self.artist_list,
+			'id_order':self._id_order,
+			'sorted_ids':self._sorted_ids,
+			'neighbors':self.neighbors,
+			'neighbor_dist':self.neighbor_dist
+		}
+		if self.grid_keys is not None:
+			components.update({'grid_keys':self.grid_keys,'grid_neighbors':self.grid_neighbors,'grid_dist':self.grid_dist})
+		components.update(self.backend.arrays())
+		components.update({'delta.U':self.delta.U,'delta.ids':self.delta.ids,'delta.hidden':self.delta.hidden})
+
+		report = {'storage':self.storage,'components':{},'private_bytes':0,'mapped_bytes':0}
+		for name,a in components.items():
+			if a is None:
+				continue
+			mapped = _is_mapped(a)
+			report['components'][name] = {'bytes':int(a.nbytes),'dtype':str(a.dtype),'shape':list(a.shape),'mapped':mapped}
+			if name != 'U' and np.may_share_memory(a,self.U):
+				# e.g. a tree built straight over a float64 U holds no copy of it
+				report['components'][name]['shares'] = 'U'
+				continue
+			report['mapped_bytes' if mapped else 'private_bytes'] += int(a.nbytes)
+		return report
+
+	def validate(self,live=None,sample=32,chunk=65536):
+		"""
+			check that this model can serve: consistent shapes (and the same number of
+			dimensions as the live model), unique ids, finite coordinates, and a backend
+			that finds a sample of rows at distance 0 from themselves
+
+			raises ModelValidationError
+		"""
+		n = self.U.shape[0]
+		if self.U.ndim != 2 or n == 0:
+			raise ModelValidationError('U has shape %r' % (self.U.shape,))
+		if len(self.artist_list) != n:
+			raise ModelValidationError('%d rows in U but %d artist ids' % (n,len(self.artist_list)))
+		if live is not None and self.U.shape[1] != live.U.shape[1]:
+			raise ModelValidationError('%d dimensions, the live model has %d' % (self.U.shape[1],live.U.shape[1]))
+		if n > 1 and (self._sorted_ids[1:] == self._sorted_ids[:-1]).any():
+			raise ModelValidationError('duplicate artist ids')
+		for a in xrange(0,n,chunk):
+			if not np.isfinite(self.U[a:a+chunk]).all():
+				raise ModelValidationError('U has non-finite values')
+
+		rows = np.unique(np.linspace(0,n-1,min(n,sample)).astype(np.int64))
+		[dist,inxes] = self.backend.query(np.asarray(self.U[rows],dtype=np.float64),1)
+		if np.mean(dist[:,0] <= 1e-6) < 0.9:
+			raise ModelValidationError('the %s backend does not find rows of U next to themselves' % self.backend.name)
+
+	def info(self):
+		""" describe which model this instance holds and when it was loaded """
+		return {
+			'version':self.version,
+			'loaded_at':self.loaded_at,
+			'load_seconds':self.load_seconds,
+			'n_artists':int(self.U.shape[0]),
+			'n_dims':int(self.U.shape[1]),
+			'storage':self.storage,
+			'delta_rows':len(self.delta),
+			'pid':os.getpid()
+		}
 
 	def mapped(self,x,xmin=0,xmax=1):
 		"""
@@ -49,39 +565,353 @@ class ArtistRecommender(object):
 		"""
 		return xmin+u*(xmax-xmin)/self.Urange
 
+	def _coerce_ids(self,artist_ids):
+		"""
+			ids usually arrive as strings from the request, so they are coerced to the
+			dtype of artist_list; returns the keys and a mask of the ids that could be
+		"""
+		kind = self._sorted_ids.dtype.kind
+		coerce = int if kind in 'iu' else (unicode if kind == 'U' else str)
+
+		valid = np.ones(len(artist_ids),dtype=bool)
+		keys = []
+		for j,a in enumerate(artist_ids):
+			try:
+				keys.append(coerce(a))
+			except (TypeError,ValueError):
+				valid[j] = False
+				keys.append(None)
+		return [keys,valid]
+
+	def _main_rows_of(self,keys,valid):
+		""" rows of the main index for coerced keys, by binary search over the sorted ids """
+		if len(self._sorted_ids) == 0:
+			return np.zeros(len(keys),dtype=np.int64)-1
+		placeholder = self._sorted_ids[0]
+		keys = np.array([k if v else placeholder for k,v in zip(keys,valid)])
+
+		pos = np.searchsorted(self._sorted_ids,keys)
+		pos = np.minimum(pos,len(self._sorted_ids)-1)
+		found = valid & (self._sorted_ids[pos] == keys)
+
+		return np.where(found,self._id_order[pos],-1)
+
+	def rows_of(self,artist_ids,delta=None):
+		"""
+			rows for a sequence of artist ids, -1 for ids that are not in the model
+
+			artists in the delta buffer have rows numbered from len(U) (see delta.py)
+		"""
+		artist_ids = list(artist_ids)
+		if len(artist_ids) == 0:
+			return np.zeros(0,dtype=np.int64)
+
+		if delta is None:
+			delta = self.delta
+		[keys,valid] = self._coerce_ids(artist_ids)
+		rows = self._main_rows_of(keys,valid)
+
+		if delta.changes:
+			rows[delta.is_hidden(rows)] = -1
+			for j,k in enumerate(keys):
+				if valid[j] and k in delta.rows:
+					rows[j] = delta.n_main+delta.rows[k]
+
+		return rows
+
+	def row_of(self,artistId):
+		""" row of U for a single artist id; raises UnknownArtistError if it is not in the model """
+		inx = self.rows_of([artistId])[0]
+		if inx < 0:
+			raise UnknownArtistError(artistId)
+		return inx
+
+	def points_of(self,rows,delta=None):
+		""" normalized vectors of rows, which may include delta rows """
+		if delta is None:
+			delta = self.delta
+		rows = np.asarray(rows)
+		if len(delta) == 0:
+			return self.U[rows]
+		inmain = rows < delta.n_main
+		out = np.empty(rows.shape+(self.U.shape[1],))
+		out[inmain] = self.U[rows[inmain]]
+		out[~inmain] = delta.U[rows[~inmain]-delta.n_main]
+		return out
+
+	def ids_of(self,rows,delta=None):
+		""" artist ids of rows, which may include delta rows """
+		if delta is None:
+			delta = self.delta
+		rows = np.asarray(rows)
+		if len(delta) == 0:
+			return self.artist_list[rows]
+		inmain = rows < delta.n_main
+		out = np.empty(rows.shape,dtype=np.result_type(self.artist_list.dtype,delta.ids.dtype))
+		out[inmain] = self.artist_list[rows[inmain]]
+		out[~inmain] = delta.ids[rows[~inmain]-delta.n_main]
+		return out
+
+	def _visible_knn(self,points,k,delta):
+		"""
+			the backend's k nearest main rows that are not hidden, missing ones at distance inf
+
+			a few extra neighbours are asked for to make up for hidden rows, and points that
+			still come up short are asked again, wider, rather than making every query pay
+			for the whole hidden set
+		"""
+		n_hidden = delta.hidden_main
+		if n_hidden == 0:
+			return self.backend.query(points,k)
+
+		dist = np.empty((len(points),k))
+		dist.fill(np.inf)
+		inxes = np.empty((len(points),k),dtype=np.int64)
+		inxes.fill(delta.n_main+len(delta))
+
+		todo = np.arange(len(points))
+		fetch = k+min(n_hidden,max(k,16))
+		while len(todo):
+			fetch = min(fetch,delta.n_main)
+			[d,inx] = self.backend.query(points[todo],fetch)
+			d = np.array(d,dtype=np.float64)
+			d[delta.is_hidden(inx)] = np.inf
+			top = np.argsort(d,1,kind='mergesort')[:,:k]
+			j = np.arange(len(todo))[:,None]
+			d = d[j,top]
+			inx = inx[j,top]
+			m = d.shape[1]
+			dist[todo,:m] = d
+			inxes[todo,:m] = inx
+
+			short = np.isinf(d).sum(1)+(k-m) > 0
+			if fetch >= delta.n_main or not short.any():
+				break
+			todo = todo[short]
+			fetch *= 4
+
+		inxes[np.isinf(dist)] = delta.n_main+len(delta)
+		return [dist,inxes]
+
+	def _knn(self,points,k,delta):
+		"""
+			the backend's k nearest rows merged with a brute force scan of the delta buffer,
+			skipping hidden rows; missing neighbours get distance inf
+		"""
+		if delta.changes == 0:
+			return self.backend.query(points,k)
+
+		points = np.atleast_2d(points)
+		[dist,inxes] = self._visible_knn(points,k,delta)
+		dist = np.hstack([dist,delta.distances(points)])
+		inxes = np.hstack([inxes,np.tile(delta.n_main+np.arange(len(delta)),(len(points),1))])
+		dist[delta.is_hidden(inxes)] = np.inf
+
+		top = np.argsort(dist,1,kind='mergesort')[:,:k]
+		j = np.arange(len(points))[:,None]
+		dist = dist[j,top]
+		inxes = inxes[j,top]
+		inxes[np.isinf(dist)] = delta.n_main+len(delta)
+		return [dist,inxes]
+
+	def _ball(self,centre,r,p,delta):
+		""" rows within Minkowski p-distance r of centre in U-space, delta included, hidden skipped """
+		rows = self.backend.ball(centre,r,p)
+		if delta.changes == 0:
+			return rows
+
+		diff = np.abs(delta.U-centre)
+		d = diff.max(1) if p == np.inf else (diff**p).sum(1)**(1.0/p)
+		rows = np.concatenate([rows,delta.n_main+np.flatnonzero(d <= r)])
+		return rows[~delta.is_hidden(rows)]
+
+	def update_artists(self,artist_ids,vectors):
+		"""
+			add or replace artists without rebuilding the index: the raw vectors are put
+			through the normalization of the main index and kept in the delta buffer
+		"""
+		with self._delta_lock:
+			[keys,valid] = self._coerce_ids(list(artist_ids))
+			U = apply_normalization(vectors,self.normalization)[valid]
+			keys = [k for k,v in zip(keys,valid) if v]
+			self.delta = self.delta.changed(keys,U,self._main_rows_of(keys,np.ones(len(keys),dtype=bool)))
+
+	def remove_artists(self,artist_ids):
+		""" hide artists from every query until the next rebuild """
+		with self._delta_lock:
+			[keys,valid] = self._coerce_ids(list(artist_ids))
+			keys = [k for k,v in zip(keys,valid) if v]
+			self.delta = self.delta.changed(keys,None,self._main_rows_of(keys,np.ones(len(keys),dtype=bool)))
+
+	def compacted(self,version):
+		""" a new recommender with the delta buffer folded into its main index """
+		delta = self.delta
+		keep = np.flatnonzero(~delta.is_hidden(np.arange(delta.n_main)))
+		live = np.array(sorted(delta.rows.values()),dtype=np.int64)
+
+		U = np.vstack([np.asarray(self.U[keep],dtype=np.float64),delta.U[live]])
+		artist_list = np.concatenate([self.artist_list[keep],delta.ids[live]])
+
+		new = ArtistRecommender.from_arrays(U,artist_list,self.normalization,version,bounds=(self.Umin,self.Urange))
+		# still the artifact it started from, as far as the model watcher is concerned
+		new.artifact_path = getattr(self,'artifact_path',None)
+		return new
+
 	def getlocationof(self,artistId):
-		inx = self.artist_list.tolist().index(artistId)
-		searchpoint = self.U[ int(inx) ,: ]
+		inx = self.row_of(artistId)
+		searchpoint = self.points_of([inx])[0]
 		
 		searchpoint = self.unmapped(searchpoint)
 		
 		return searchpoint
 
+	@metrics.timed('recommender')
 	def searchnear(self,searchpoint,k=5):
 
 		searchpoint = self.mapped(searchpoint)
+		delta = self.delta
 
-		[dist,inxes] = self.K.query(searchpoint,k=k)
+		[dist,inxes] = self._knn(searchpoint,k,delta)
+		dist = dist[0]
+		inxes = inxes[0]
 
-		points = self.U[inxes,:]
+		points = self.points_of(inxes,delta)
 		
-		return [dist,self.artist_list[inxes],points]
+		return [dist,self.ids_of(inxes,delta),points]
+
+	@metrics.timed('recommender')
+	def searchnear_cell(self,cell,step,k=5):
+		"""
+			searchnear from the centre of a grid cell (see grid_cells), so that every point
+			in the cell gets the same answer; cells precomputed by build_artifact are
+			served straight from the table
+		"""
+		if self.grid_keys is not None and step == self.grid_step and k <= self.grid_neighbors.shape[1] and self.delta.changes == 0:
+			j = np.searchsorted(self.grid_keys,cell)
+			if j < len(self.grid_keys) and self.grid_keys[j] == cell:
+				inxes = np.asarray(self.grid_neighbors[j,:k],dtype=np.int64)
+				dist = np.asarray(self.grid_dist[j,:k],dtype=np.float64)
+				return [dist,self.artist_list[inxes],self.U[inxes,:]]
+
+		return self.searchnear(grid_centers([cell],step,self.U.shape[1])[0],k)
+
+	@metrics.timed('recommender')
+	def within_radius(self,searchpoint,radius,max_rows=None):
+		"""
+			every artist within radius of searchpoint, both in [0,1] space, nearest first;
+			RegionTooLargeError if more than max_rows candidates are found
+
+			returns [dist,rows]
+		"""
+		searchpoint = np.asarray(searchpoint,dtype=np.float64)
+		delta = self.delta
+
+		# the ball is stretched by Urange in U-space, so search the ball that encloses it and filter
+		rows = self._ball(self.mapped(searchpoint),radius*np.max(self.Urange),2,delta)
+		_check_region(rows,max_rows)
+		dist = np.sqrt(((self.unmapped(self.points_of(rows,delta))-searchpoint)**2).sum(1))
+
+		keep = np.flatnonzero(dist <= radius)
+		keep = keep[np.argsort(dist[keep],kind='mergesort')]
+		return [dist[keep],rows[keep]]
+
+	@metrics.timed('recommender')
+	def within_box(self,lo,hi,max_rows=None):
+		"""
+			every artist inside the axis-aligned box lo <= x <= hi of [0,1] space, nearest
+			to the centre of the box first; RegionTooLargeError if more than max_rows
+			candidates are found
+
+			returns [dist,rows] where dist is the distance to the centre
+		"""
+		lo = np.asarray(lo,dtype=np.float64)
+		hi = np.asarray(hi,dtype=np.float64)
+		centre = (lo+hi)/2
+		delta = self.delta
+
+		# the smallest cube (p=inf ball) around the centre that holds the box, then the exact bounds
+		rows = self._ball(self.mapped(centre),np.max((hi-lo)/2*self.Urange),np.inf,delta)
+		_check_region(rows,max_rows)
+		x = self.unmapped(self.points_of(rows,delta))
+
+		keep = np.flatnonzero(((x >= lo) & (x <= hi)).all(1))
+		dist = np.sqrt(((x[keep]-centre)**2).sum(1))
+		order = np.argsort(dist,kind='mergesort')
+		return [dist[order],rows[keep[order]]]
 
+	@metrics.timed('recommender')
 	def recommend(self,artistId,k=5):
 
-		inx = self.artist_list.tolist().index(artistId)
-		searchpoint = self.U[ int(inx) ,: ]
-		
-		[dist,inxes] = self.K.query(searchpoint,k=k+1) # get the closest k+1 points since we're going to remove the searchpoint itself
+		[dist,ids,points,found] = self.recommend_many([artistId],k=k)
 
-		# find everything not equal to the search point in the results
-		i=np.where(inxes!=inx)[0]
+		if not found[0]:
+			raise UnknownArtistError(artistId)
 
-		# grab everything not at the position of the search point in the results
-		inxes=inxes[i]
-		dist=dist[i]
-		points = self.U[inxes,:]
-		
-		points = [self.unmapped(p) for p in points]
-		
-		return [dist,self.artist_list[inxes],points]
+		return [dist[0],ids[0],points[0]]
+
+	@metrics.timed('recommender')
+	def recommend_many(self,artist_ids,k=5):
+		"""
+			k nearest neighbours for each of a batch of artists in one parallel tree query
+
+			returns [dist,ids,points,found] where found is a boolean mask over artist_ids and
+			dist, ids and points have one row per found artist, in input order
+		"""
+		delta = self.delta
+		rows = self.rows_of(artist_ids,delta)
+		found = rows >= 0
+		rows = rows[found]
+
+		if len(rows) == 0:
+			return [np.zeros((0,k)),self.artist_list[:0].reshape(0,k),np.zeros((0,k,self.U.shape[1])),found]
+
+		if self.neighbors is not None and k <= self.neighbors.shape[1] and delta.changes == 0:
+			# served straight from the precomputed table
+			inxes = np.asarray(self.neighbors[rows,:k],dtype=np.int64)
+			dist = np.asarray(self.neighbor_dist[rows,:k],dtype=np.float64)
+		else:
+			# get the closest k+1 points since we're going to remove each search point itself
+			[dist,inxes] = self._knn(self.points_of(rows,delta),k+1,delta)
+			[dist,inxes] = drop_self(dist,inxes,rows,k)
+
+		points = self.unmapped(self.points_of(inxes,delta))
+
+		return [dist,self.ids_of(inxes,delta),points,found]
+
+	@metrics.timed('recommender')
+	def recommend_for_seeds(self,artist_ids,k=5):
+		"""
+			k artists close to a whole set of seed artists, e.g. the three on the favorites form
+
+			the candidates are the neighbours of the seeds' centroid plus the neighbours of
+			every seed, all found in one tree query; they are ranked by their mean distance
+			to the seeds, so an artist near all of them beats one right next to a single seed.
+			the seeds themselves are never returned
+
+			returns [score,ids,points,found] where score is the mean distance and found is a
+			boolean mask over artist_ids
+		"""
+		delta = self.delta
+		rows = self.rows_of(artist_ids,delta)
+		found = rows >= 0
+		rows = np.unique(rows[found])
+
+		if len(rows) == 0:
+			return [np.zeros(0),self.artist_list[:0],np.zeros((0,self.U.shape[1])),found]
+
+		seeds = np.asarray(self.points_of(rows,delta),dtype=np.float64)
+		queries = np.vstack([seeds.mean(0),seeds])
+
+		# every query may return all the seeds, so ask for that many more
+		[dist,inxes] = self._knn(queries,k+len(rows),delta)
+
+		candidates = np.unique(inxes[~np.isinf(dist)])
+		candidates = candidates[(candidates < delta.n_main+len(delta)) & ~np.in1d(candidates,rows)]
+
+		diff = np.asarray(self.points_of(candidates,delta),dtype=np.float64)[:,None,:] - seeds[None,:,:]
+		score = np.sqrt((diff**2).sum(2)).mean(1)
+
+		best = np.argsort(score,kind='mergesort')[:k]
+		inxes = candidates[best]
+
+		return [score[best],self.ids_of(inxes,delta),self.unmapped(self.points_of(inxes,delta)),found]
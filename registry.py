@@ -0,0 +1,112 @@
+"""
+Versioned recommender registry
+
+Holds the live ArtistRecommender and replaces it without a restart: a new
+version is loaded next to the live one (in a background thread), validated,
+and swapped in with a single assignment. Requests lease the version they
+started with (see get_recommender in reco.py), so a request never mixes two
+models; a retired version is dropped once its last lease is released.
+
+ModelWatcher polls the CURRENT file of an artifact root written by
+build_model.py and loads whatever version it points at.
+"""
+
+import os
+import sys
+import threading
+from background import Refreshing
+from recommender import ArtistRecommender, resolve_artifact
+
+class ModelRegistry(object):
+
+	def __init__(self,load=ArtistRecommender):
+		self._load = load
+		self._current = None
+		self._leases = {} # id(recommender) -> [recommender,count]
+		self._lock = threading.Lock()
+		self._swap_lock = threading.Lock()
+		self._on_swap = []
+
+	@property
+	def loaded(self):
+		return self._current is not None
+
+	def current(self):
+		""" the live recommender, loaded on first use """
+		if self._current is None:
+			with self._swap_lock:
+				if self._current is None:
+					self._current = self._load()
+		return self._current
+
+	def acquire(self):
+		""" the live recommender, held until release() so that it outlives a swap """
+		rec = self.current()
+		with self._lock:
+			entry = self._leases.setdefault(id(rec),[rec,0])
+			entry[1] += 1
+		return rec
+
+	def release(self,rec):
+		with self._lock:
+			entry = self._leases.get(id(rec))
+			if entry is None:
+				return
+			entry[1] -= 1
+			if entry[1] <= 0:
+				# the last reference the registry had to a retired version goes with it
+				del self._leases[id(rec)]
+
+	def on_swap(self,fn):
+		""" call fn(new,old) after every swap """
+		self._on_swap.append(fn)
+		return fn
+
+	def swap(self,new,validate=True):
+		""" validate new against the live recommender and make it live; returns the old one """
+		if validate:
+			new.validate(self._current)
+		with self._swap_lock:
+			old = self._current
+			self._current = new
+		for fn in self._on_swap:
+			try:
+				fn(new,old)
+			except Exception:
+				print "model swap hook failed:", sys.exc_info()[1]
+		return old
+
+	def load(self,path=None):
+		""" load the model at path next to the live one, then validate and swap it in """
+		new = self._load(path)
+		self.swap(new)
+		return new
+
+	def info(self):
+		""" the live version and the versions still held by requests """
+		with self._lock:
+			leased = [{'version':rec.version,'leases':n} for rec,n in self._leases.values()]
+		return {'version':self._current.version if self._current is not None else None,'leased':leased}
+
+class ModelWatcher(Refreshing):
+	""" loads the version named by root/CURRENT whenever it changes """
+
+	def __init__(self,registry,root,refresh_interval=60):
+		self.registry = registry
+		self.root = root
+		self.refresh_interval = refresh_interval
+		self.failed = None # the last path that failed to load or validate, not retried
+
+	def refresh(self):
+		if not os.path.exists(os.path.join(self.root,'CURRENT')):
+			return
+		path = resolve_artifact(self.root)
+		live = self.registry.current()
+		if os.path.abspath(path) == os.path.abspath(getattr(live,'artifact_path','')) or path == self.failed:
+			return
+		try:
+			self.registry.load(path)
+		except Exception:
+			self.failed = path
+			raise
+		self.failed = None
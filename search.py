@@ -0,0 +1,189 @@
+"""
+In-memory artist name search
+
+Built from ArtistAlias (joined with Artists for popularity) and answered in
+process, in order of preference:
+
+	exact		the alias with case and spaces ignored, like arthash()
+	phonetic	the Soundex codes of the alias words, for misspellings
+	trigram		the aliases sharing the most character trigrams with the query
+
+Within each tier artists are ranked by popularity. prefix() serves autocomplete
+from the sorted normalized aliases.
+"""
+
+import bisect
+import collections
+import threading
+import numpy as np
+from background import Refreshing
+
+_SOUNDEX = {}
+for _letters,_code in [('BFPV','1'),('CGJKQSXZ','2'),('DT','3'),('L','4'),('MN','5'),('R','6')]:
+	for _c in _letters:
+		_SOUNDEX[_c] = _code
+
+def normalize(name):
+	""" case and spaces do not matter when comparing names """
+	return name.lower().replace(' ','')
+
+def soundex(word):
+	""" American Soundex code of a single word, '' if it has no letters """
+	letters = [c for c in word.upper() if c.isalpha()]
+	if len(letters) == 0:
+		return ''
+	codes = []
+	last = _SOUNDEX.get(letters[0],'')
+	for c in letters[1:]:
+		code = _SOUNDEX.get(c,'')
+		if code and code != last:
+			codes.append(code)
+		if c not in 'HW':
+			last = code
+	return (letters[0]+''.join(codes)+'000')[:4]
+
+def phonetic_key(name):
+	return ''.join(soundex(w) for w in name.split())
+
+def trigrams(norm):
+	padded = '$'+norm+'$'
+	return set(padded[i:i+3] for i in xrange(len(padded)-2))
+
+class ArtistSearchIndex(Refreshing):
+
+	def __init__(self,connect,refresh_interval=3600,min_similarity=0.3,max_posting=50000,chunk=50000):
+		self.connect = connect
+		self.refresh_interval = refresh_interval
+		self.min_similarity = min_similarity
+		self.max_posting = max_posting # trigrams shared by more aliases than this are too common to rank by
+		self.chunk = chunk
+		self._index = None
+		self._refresh_lock = threading.Lock()
+
+	@property
+	def loaded(self):
+		return self._index is not None
+
+	def _fetch(self):
+		""" (artistId,artistAlias,artistPopularityAll) for every alias """
+		conn = self.connect()
+		try:
+			cur = conn.cursor()
+			cur.execute("select a.artistId, a.artistAlias, b.artistPopularityAll from ArtistAlias as a join Artists as b on a.artistId = b.artistId;")
+			while True:
+				rows = cur.fetchmany(self.chunk)
+				if not rows:
+					break
+				for row in rows:
+					yield row
+		finally:
+			conn.close()
+
+	def refresh(self):
+		with self._refresh_lock:
+			self._index = self.build(self._fetch())
+			return self._index
+
+	def build(self,rows):
+		""" build all lookup structures from (artistId,alias,popularity) rows; aliases are ordered by popularity """
+		rows = [(str(aid),alias,pop or 0) for aid,alias,pop in rows if alias]
+		rows.sort(key=lambda r:-r[2])
+
+		ids = np.array([r[0] for r in rows],dtype=object)
+		norms = [normalize(r[1]) for r in rows]
+
+		exact = collections.defaultdict(list)
+		phonetic = collections.defaultdict(list)
+		postings = collections.defaultdict(list)
+		ngram_counts = np.zeros(len(rows),dtype=np.int32)
+
+		for j,(r,norm) in enumerate(zip(rows,norms)):
+			exact[norm].append(j)
+			key = phonetic_key(r[1])
+			if key:
+				phonetic[key].append(j)
+			grams = trigrams(norm)
+			ngram_counts[j] = len(grams)
+			for gram in grams:
+				postings[gram].append(j)
+
+		# prefix search walks the aliases in sorted order; the position in rows is kept for ranking
+		by_name = sorted(xrange(len(norms)),key=norms.__getitem__)
+
+		return {
+			'ids':ids,
+			'exact':dict(exact),
+			'phonetic':dict(phonetic),
+			'postings':dict((g,np.array(p,dtype=np.int32)) for g,p in postings.iteritems()),
+			'ngram_counts':ngram_counts,
+			'sorted_names':[norms[j] for j in by_name],
+			'sorted_rank':np.array(by_name,dtype=np.int64)
+		}
+
+	def _trigram_matches(self,index,norm):
+		""" alias positions ordered by trigram similarity, then popularity """
+		grams = trigrams(norm)
+		lists = [index['postings'][g] for g in grams if g in index['postings']]
+		common = [p for p in lists if len(p) <= self.max_posting]
+		lists = common or lists
+		if len(lists) == 0:
+			return []
+
+		cand,shared = np.unique(np.concatenate(lists),return_counts=True)
+		similarity = shared/(len(grams)+index['ngram_counts'][cand]-shared).astype(np.float64)
+		keep = similarity >= self.min_similarity
+		cand = cand[keep]
+		similarity = similarity[keep]
+
+		# positions already run in popularity order, so sort by similarity with position as the tie break
+		return cand[np.lexsort((cand,-similarity))].tolist()
+
+	def search(self,name,N=20,feelinglucky=False):
+		"""
+			up to N distinct artist ids for a name: exact matches, then phonetic, then trigram
+			with feelinglucky only the best id is returned, or None
+		"""
+		index = self._index
+		norm = normalize(name)
+
+		found = []
+		seen = set()
+		tiers = [
+			lambda: index['exact'].get(norm,[]),
+			lambda: index['phonetic'].get(phonetic_key(name),[]),
+			lambda: self._trigram_matches(index,norm)
+		]
+		for tier in tiers:
+			for j in tier():
+				aid = index['ids'][j]
+				if aid not in seen:
+					seen.add(aid)
+					found.append(aid)
+					if feelinglucky:
+						return aid
+					if len(found) >= N:
+						return found
+		return None if feelinglucky else found
+
+	def prefix(self,text,N=10):
+		""" up to N distinct artist ids with an alias starting with text, most popular first """
+		index = self._index
+		norm = normalize(text)
+		if len(norm) == 0:
+			return []
+
+		names = index['sorted_names']
+		lo = bisect.bisect_left(names,norm)
+		hi = bisect.bisect_left(names,norm+u'\uffff')
+
+		rank = np.sort(index['sorted_rank'][lo:hi])
+		found = []
+		seen = set()
+		for j in rank:
+			aid = index['ids'][j]
+			if aid not in seen:
+				seen.add(aid)
+				found.append(aid)
+				if len(found) >= N:
+					break
+		return found
@@ -0,0 +1,82 @@
+"""
+Home page snapshot
+
+The candidate lists shown on the home page (trending and popular songs and
+artists in SubTables) change maybe hourly, so they are loaded on a schedule
+together with their sampling weights. A home page hit then only draws a
+weighted sample from memory.
+"""
+
+import threading
+import numpy as np
+from background import Refreshing
+from db import fetchall
+
+QUERIES = {
+	'tren_song':"select youtubeId,songName,url from trenSong order by viewCount desc limit 30;",
+	'tren_artist':"select distinct artistName, artistId from recArtist order by artistPopularityRecent Desc limit 50;",
+	'popu_song':"select youtubeId,songName,url from popuSong order by viewCount desc limit 30;",
+	'popu_artist':"select distinct artistName, artistId from popuArtist group by artistName order by artistPopularityAll Desc limit 50;"
+}
+
+def song_item(row):
+	return {'youtubeId':row[0],'songName':row[1],'url':row[2]}
+
+def artist_item(row):
+	return {'name':row[0],'id':row[1]}
+
+class WeightedList(object):
+	""" items with linearly decreasing weights, the first being the most likely """
+
+	def __init__(self,items):
+		self.items = np.empty(len(items),dtype=object)
+		for j,item in enumerate(items):
+			self.items[j] = item
+
+		n = len(items)
+		w = 1.2*n - np.arange(n)
+		self.p = w/w.sum()
+
+	def sample(self,n):
+		""" n distinct items drawn by weight """
+		n = min(n,len(self.items))
+		if n == 0:
+			return []
+		return self.items[np.random.choice(len(self.items),n,replace=False,p=self.p)].tolist()
+
+class HomeSnapshot(Refreshing):
+
+	def __init__(self,connection,refresh_interval=300,on_refresh=None):
+		self.connection = connection # returns a context manager yielding a SubTables connection
+		self.refresh_interval = refresh_interval
+		self.on_refresh = on_refresh
+		self.lists = None
+		self._refresh_lock = threading.Lock()
+
+	@property
+	def loaded(self):
+		return self.lists is not None
+
+	def refresh(self):
+		with self._refresh_lock:
+			with self.connection() as db:
+				rows = dict((name,fetchall(db,q,label=name)) for name,q in QUERIES.items())
+
+			self.lists = {
+				'tren_song':WeightedList([song_item(r) for r in rows['tren_song']]),
+				'tren_artist':WeightedList([artist_item(r) for r in rows['tren_artist']]),
+				'popu_song':WeightedList([song_item(r) for r in rows['popu_song']]),
+				'popu_artist':WeightedList([artist_item(r) for r in rows['popu_artist']])
+			}
+
+		if self.on_refresh is not None:
+			self.on_refresh(self)
+
+	def artist_names(self):
+		""" names of every candidate artist, e.g. for prefetching their covers """
+		return [a['name'] for key in ('tren_artist','popu_artist') for a in self.lists[key].items]
+
+	def sample(self,n):
+		""" n items of every list """
+		lists = self.lists
+		return dict((name,l.sample(n)) for name,l in lists.items())
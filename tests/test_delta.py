@@ -0,0 +1,180 @@
+"""
+The delta buffer against brute force: after artists are added, updated and
+removed, and after the buffer is compacted or replayed onto a newly built
+model, recommend, searchnear, radius and box queries must answer exactly what a
+cKDTree over the same artists answers.
+
+    python -m unittest discover tests
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy.spatial import cKDTree
+import config
+from benchmarks.synthetic import make_embedding, write_model
+from recommender import ArtistRecommender, UnknownArtistError, apply_normalization, build_artifact
+from delta import DeltaFeed, append_delta
+
+K = 10
+
+class DeltaTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix='reco-test-')
+		self.saved = dict((k,getattr(config,k)) for k in ['U_path','otherdata_path','MODEL_ARTIFACT_PATH','DELTA_PATH','ANN_BACKEND','MODEL_STORAGE','MODEL_COMPACT_IDS'])
+		U,ids = make_embedding(3000,seed=1)
+		write_model(self.workdir,U,ids)
+		config.U_path = os.path.join(self.workdir,'U.npz')
+		config.otherdata_path = os.path.join(self.workdir,'ids.npz')
+		config.MODEL_ARTIFACT_PATH = ''
+		config.DELTA_PATH = ''
+		config.ANN_BACKEND = 'exact'
+		config.MODEL_STORAGE = 'float64'
+		config.MODEL_COMPACT_IDS = False
+
+		self.delta_path = os.path.join(self.workdir,'delta.db')
+		self.rng = np.random.RandomState(2)
+		self.raw = collections.OrderedDict(zip(ids,U)) # artist id -> raw vector, what the model should hold
+		self.rec = ArtistRecommender()
+
+	def tearDown(self):
+		for k,v in self.saved.items():
+			setattr(config,k,v)
+		shutil.rmtree(self.workdir,ignore_errors=True)
+
+	def add(self,ids,vectors):
+		append_delta(self.delta_path,ids,vectors)
+		for a,v in zip(ids,vectors):
+			self.raw.pop(a,None)
+			self.raw[a] = v
+
+	def remove(self,ids):
+		append_delta(self.delta_path,ids)
+		for a in ids:
+			self.raw.pop(a,None)
+
+	def some_raw_vectors(self,n):
+		""" vectors near existing artists, so that they show up in each other's results """
+		base = np.array(self.raw.values()[:200])
+		return base[self.rng.randint(len(base),size=n)]+self.rng.randn(n,base.shape[1])*0.05
+
+	def reference(self,rec):
+		""" [ids,U-space points] of the artists rec should hold """
+		ids = np.array(self.raw.keys())
+		return [ids,apply_normalization(np.array(self.raw.values()),rec.normalization)]
+
+	def assertMatchesBruteForce(self,rec):
+		[ids,points] = self.reference(rec)
+		self.assertEqual(sorted(rec.ids_of(np.arange(rec.U.shape[0]+len(rec.delta)))[~rec.delta.is_hidden(np.arange(rec.U.shape[0]+len(rec.delta)))].tolist()),sorted(ids.tolist()))
+		tree = cKDTree(points)
+
+		# searchnear from random points of [0,1] space
+		for x in self.rng.rand(20,points.shape[1]):
+			[dist,found,_] = rec.searchnear(x,K)
+			[want_dist,want] = tree.query(rec.mapped(x),k=K)
+			np.testing.assert_allclose(dist,want_dist)
+			self.assertEqual(sorted(found.tolist()),sorted(ids[want].tolist()))
+
+		# recommend, excluding the artist itself
+		for j in self.rng.randint(len(ids),size=20):
+			[dist,found,_] = rec.recommend(ids[j],K)
+			[want_dist,want] = tree.query(points[j],k=K+1)
+			keep = want != j
+			np.testing.assert_allclose(dist,want_dist[keep][:K])
+			self.assertEqual(sorted(found.tolist()),sorted(ids[want[keep][:K]].tolist()))
+
+		# radius and box in [0,1] space
+		unit = rec.unmapped(points)
+		for x in unit[self.rng.randint(len(ids),size=10)]:
+			[dist,rows] = rec.within_radius(x,0.05)
+			d = np.sqrt(((unit-x)**2).sum(1))
+			self.assertEqual(sorted(rec.ids_of(rows).tolist()),sorted(ids[d <= 0.05].tolist()))
+			np.testing.assert_allclose(dist,np.sort(d[d <= 0.05]))
+
+			[dist,rows] = rec.within_box(x-0.04,x+0.06)
+			inside = ((unit >= x-0.04) & (unit <= x+0.06)).all(1)
+			self.assertEqual(sorted(rec.ids_of(rows).tolist()),sorted(ids[inside].tolist()))
+
+	def feed(self,holder,compact_rows=0):
+		def set_recommender(new):
+			holder[0] = new
+		return DeltaFeed(self.delta_path,lambda: holder[0],set_recommender,compact_rows=compact_rows)
+
+	def test_add_update_remove(self):
+		holder = [self.rec]
+		feed = self.feed(holder)
+		ids = self.raw.keys()
+
+		self.add(['new%d' % j for j in range(50)],self.some_raw_vectors(50))
+		feed.refresh()
+		self.assertMatchesBruteForce(self.rec)
+
+		# re-embed main artists and delta artists, then remove some of each
+		self.add(ids[:30]+['new%d' % j for j in range(10)],self.some_raw_vectors(40))
+		self.remove(ids[30:60]+['new%d' % j for j in range(40,50)])
+		feed.refresh()
+		self.assertMatchesBruteForce(self.rec)
+		self.assertRaises(UnknownArtistError,self.rec.row_of,ids[40])
+		self.assertRaises(UnknownArtistError,self.rec.row_of,'new45')
+
+		# a removed artist can come back
+		self.add([ids[40]],self.some_raw_vectors(1))
+		feed.refresh()
+		self.assertMatchesBruteForce(self.rec)
+
+	def test_many_hidden_rows(self):
+		# queries ask the tree for more neighbours than they return to skip hidden rows
+		self.remove(self.raw.keys()[::3])
+		self.feed([self.rec]).refresh()
+		self.assertMatchesBruteForce(self.rec)
+
+	def test_compaction(self):
+		holder = [self.rec]
+		feed = self.feed(holder,compact_rows=60)
+		ids = self.raw.keys()
+
+		self.add(['new%d' % j for j in range(40)]+ids[:20],self.some_raw_vectors(60))
+		self.remove(ids[20:30])
+		feed.refresh()
+		compacted = holder[0]
+		self.assertIsNot(compacted,self.rec)
+		self.assertEqual(compacted.delta.changes,0)
+		self.assertEqual(compacted.U.shape[0],len(self.raw))
+		self.assertMatchesBruteForce(compacted)
+
+		# rows queued after the compaction go into the new model's buffer
+		self.add(['later'],self.some_raw_vectors(1))
+		self.remove([ids[50]])
+		feed.refresh()
+		self.assertIs(holder[0],compacted)
+		self.assertMatchesBruteForce(compacted)
+
+	def test_replay_onto_rebuilt_model(self):
+		holder = [self.rec]
+		feed = self.feed(holder)
+		ids = self.raw.keys()
+
+		self.add(['new%d' % j for j in range(20)],self.some_raw_vectors(20))
+		self.remove(ids[:10])
+		feed.refresh()
+
+		# build_model.py --delta folds everything queued so far into a new version
+		path = build_artifact(os.path.join(self.workdir,'model'),neighbor_k=0,hot_cells=0,delta_path=self.delta_path)
+		self.add(['after%d' % j for j in range(5)],self.some_raw_vectors(5))
+		self.remove([ids[10],'new0'])
+
+		rebuilt = ArtistRecommender(path)
+		self.assertEqual(rebuilt.delta_seq,30)
+		holder[0] = rebuilt
+		feed.refresh()
+		# only the rows queued after the build were replayed
+		self.assertEqual(rebuilt.delta.changes,7)
+		self.assertEqual(feed.seq,37)
+		self.assertMatchesBruteForce(rebuilt)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,137 @@
+"""
+Leases on recommender versions: a request keeps the version it started with
+through a swap, and the registry lets go of a retired version once the last
+lease on it is released.
+
+    python -m unittest discover tests
+"""
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import weakref
+import numpy as np
+import config
+from benchmarks.synthetic import make_embedding, write_model
+from recommender import build_artifact
+from registry import ModelRegistry, ModelWatcher
+
+try:
+	import MySQLdb
+except ImportError:
+	# reco only needs the module to import; these tests never query MySQL
+	from benchmarks.standins import SqliteMySQLdb
+	sys.modules['MySQLdb'] = SqliteMySQLdb({})
+import reco
+
+class Model(object):
+	""" stands in for ArtistRecommender """
+
+	def __init__(self,version):
+		self.version = version
+
+	def validate(self,live=None):
+		pass
+
+class LeaseTest(unittest.TestCase):
+
+	def test_lease_outlives_swap(self):
+		registry = ModelRegistry(load=lambda path=None: Model('v1'))
+		held = registry.acquire()
+		ref = weakref.ref(held)
+
+		old = registry.swap(Model('v2'))
+		self.assertIs(old,held)
+		del old
+		self.assertEqual(registry.current().version,'v2')
+		self.assertEqual(registry.info()['leased'],[{'version':'v1','leases':1}])
+
+		# a second request gets the new version, the first still has its own
+		other = registry.acquire()
+		self.assertEqual(other.version,'v2')
+		self.assertEqual(held.version,'v1')
+		registry.release(other)
+
+		registry.release(held)
+		del held
+		gc.collect()
+		self.assertEqual(registry.info()['leased'],[])
+		self.assertIsNone(ref())
+
+	def test_leases_are_counted(self):
+		registry = ModelRegistry(load=lambda path=None: Model('v1'))
+		a = registry.acquire()
+		b = registry.acquire()
+		registry.swap(Model('v2'))
+		registry.release(a)
+		self.assertEqual(registry.info()['leased'],[{'version':'v1','leases':1}])
+		registry.release(b)
+		self.assertEqual(registry.info()['leased'],[])
+
+class RequestLeaseTest(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = reco.registry
+		reco.registry = ModelRegistry(load=lambda path=None: Model('v1'))
+
+	def tearDown(self):
+		reco.registry = self.saved
+
+	def test_request_keeps_its_version_until_teardown(self):
+		registry = reco.registry
+		with reco.app.test_request_context('/json/recommend/id'):
+			held = reco.get_recommender()
+			registry.swap(Model('v2'))
+			self.assertIs(reco.get_recommender(),held)
+			self.assertEqual(registry.info()['leased'],[{'version':'v1','leases':1}])
+		self.assertEqual(registry.info()['leased'],[])
+
+		with reco.app.test_request_context('/json/recommend/id'):
+			self.assertEqual(reco.get_recommender().version,'v2')
+
+class WatcherTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix='reco-test-')
+		self.saved = dict((k,getattr(config,k)) for k in ['U_path','otherdata_path','MODEL_ARTIFACT_PATH','ANN_BACKEND','MODEL_STORAGE'])
+		config.ANN_BACKEND = 'exact'
+		config.MODEL_STORAGE = 'float64'
+		config.MODEL_ARTIFACT_PATH = ''
+
+	def tearDown(self):
+		for k,v in self.saved.items():
+			setattr(config,k,v)
+		shutil.rmtree(self.workdir,ignore_errors=True)
+
+	def build(self,seed):
+		U,ids = make_embedding(1000,seed=seed)
+		source = os.path.join(self.workdir,'source%d' % seed)
+		os.makedirs(source)
+		write_model(source,U,ids)
+		return build_artifact(os.path.join(self.workdir,'model'),os.path.join(source,'U.npz'),os.path.join(source,'ids.npz'),neighbor_k=0,hot_cells=0)
+
+	def test_watcher_swaps_while_leased(self):
+		first = self.build(1)
+		registry = ModelRegistry()
+		registry.load(first)
+		watcher = ModelWatcher(registry,os.path.join(self.workdir,'model'))
+
+		held = registry.acquire()
+		point = np.zeros(5)+0.5
+		before = held.searchnear(point,5)
+
+		self.build(2)
+		watcher.refresh()
+		self.assertNotEqual(registry.current().version,held.version)
+
+		# the leased version still answers, from its own files
+		after = held.searchnear(point,5)
+		self.assertEqual(after[1].tolist(),before[1].tolist())
+		registry.release(held)
+		self.assertEqual(registry.info()['leased'],[])
+
+if __name__ == "__main__":
+	unittest.main()